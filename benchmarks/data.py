@@ -0,0 +1,54 @@
+"""Synthetic teams, games and bids for the benchmarks."""
+import random
+import time
+
+import fakes  # noqa: F401 puts the package on sys.path
+
+from vcg.bid import Bid
+from vcg.game import Game
+from vcg.stats import GameStats
+
+OPTION_NAMES = ['option%d' % i for i in range(47)]
+
+
+def make_bids(bids_per_game, options_per_game, rng):
+    options = OPTION_NAMES[:options_per_game]
+    return [Bid(user='user%d' % i,
+                option=rng.choice(options) if options else None,
+                amount=rng.randint(0, 1000)) for i in range(bids_per_game)]
+
+
+def make_game(team, name, bids_per_game, options_per_game, end_date, rng, utc_offset='0'):
+    game = Game(team=team, name=name, creator='creator', start_date=int(time.time()) - 3600,
+                end_date=end_date, options=OPTION_NAMES[:options_per_game] or None,
+                bids=[], utc_offset=utc_offset)
+    game.bids = make_bids(bids_per_game, options_per_game, rng)
+    game.stats = GameStats.new(game.options)
+    for bid in game.bids:
+        game.stats.replace_bid(bid)
+    return game
+
+
+def make_db_game(team, name, bids_per_game, options_per_game, end_date, rng):
+    return make_game(team, name, bids_per_game, options_per_game, end_date, rng).to_json_encoded()
+
+
+def populate(storage, teams=1, games_per_team=1, bids_per_game=10, options_per_game=0, ended=False, seed=0):
+    # fills the store through the storage interface, returns list of (team_id, game name)
+    rng = random.Random(seed)
+    now = int(time.time())
+    end_date = now - 60 if ended else now + 86400
+    games = []
+    for t in range(teams):
+        team = 'T%05d' % t
+        add_team(storage, team)
+        for g in range(games_per_team):
+            name = 'game%d' % g
+            storage.create_game(make_db_game(team, name, bids_per_game, options_per_game, end_date, rng))
+            games.append((team, name))
+    return games
+
+
+def add_team(storage, team, utc_offset='0'):
+    storage.put_settings({'team_id': team, 'utc_offset': utc_offset, 'joined': 0})
+    storage.put_oauth({'team_id': team, 'webhook_url': 'https://hooks.example/' + team})
@@ -0,0 +1,810 @@
+"""In-process stand-ins for DynamoDB and the Slack webhook endpoint.
+
+They implement the subset of the boto3 resource api the handlers use, store
+numbers as Decimal like DynamoDB does and count every call, so benchmarks
+can report DynamoDB round trips per request. Reads also tally the read
+capacity units DynamoDB would charge for them and the bytes they return.
+Tables can be given a write capacity, writes beyond it are throttled.
+Items created in active_games are recorded in its stream, like DynamoDB
+Streams with NEW_IMAGE records.
+"""
+import copy
+import json
+import math
+import numbers
+import os
+import re
+import sys
+import threading
+import time
+import types
+from collections import defaultdict
+from decimal import Decimal
+
+PACKAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'gamesofni')
+if PACKAGE_DIR not in sys.path:
+    sys.path.insert(0, PACKAGE_DIR)
+
+
+def install_config():
+    try:
+        import config
+    except ImportError:
+        config = types.ModuleType('config')
+        config.slack_token = 'benchmark'
+        config.aws_account = '000000000000'
+        config.oauth = {'client_id': '', 'client_secret': ''}
+        sys.modules['config'] = config
+    return config
+
+
+def to_dynamo(value):
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, numbers.Integral) or isinstance(value, Decimal):
+        return Decimal(value)
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamo(v) for v in value]
+    return value
+
+
+def to_attribute_values(item):
+    # imported here like botocore in client_error
+    from boto3.dynamodb.types import TypeSerializer
+    serializer = TypeSerializer()
+    return dict((name, serializer.serialize(value)) for name, value in item.items())
+
+
+def client_error(code, operation, message=''):
+    # imported here so that importing fakes doesn't preload botocore for startup.py
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def check_placeholders(operation, names, values, *expressions):
+    # dynamodb rejects requests that define names or values no expression uses
+    if any(expression is not None and hasattr(expression, 'get_expression') for expression in expressions):
+        return
+    used = set(re.findall(r'[#:][\w]+', ' '.join(expression for expression in expressions if expression)))
+    unused = [placeholder for placeholder in list(names or {}) + list(values or {}) if placeholder not in used]
+    if unused:
+        raise client_error('ValidationException', operation,
+                           'Value provided in ExpressionAttributeNames/Values unused in expressions: ' +
+                           ', '.join(sorted(unused)))
+
+
+def split_path(path, names):
+    return [names.get(part, part) for part in path.strip().split('.')]
+
+
+def get_path(item, parts):
+    value = item
+    for part in parts:
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def set_path(item, parts, value, operation):
+    parent = get_path(item, parts[:-1]) if len(parts) > 1 else item
+    if not isinstance(parent, dict):
+        raise client_error('ValidationException', operation,
+                           'The document path provided in the update expression is invalid for update')
+    parent[parts[-1]] = value
+
+
+def remove_path(item, parts):
+    parent = get_path(item, parts[:-1]) if len(parts) > 1 else item
+    if isinstance(parent, dict):
+        parent.pop(parts[-1], None)
+
+
+def copy_paths(source, paths):
+    result = {}
+    for parts in paths:
+        value = get_path(source, parts)
+        if value is None:
+            continue
+        target = result
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = copy.deepcopy(value)
+    return result
+
+
+def item_size(item):
+    # near enough to dynamodb's sum of attribute name and value lengths
+    return len(json.dumps(item, default=str, separators=(',', ':')))
+
+
+def project(item, projection, names):
+    if not projection:
+        return copy.deepcopy(item)
+    return copy_paths(item, [split_path(path, names) for path in projection.split(',')])
+
+
+def evaluate(condition, item, names=None, values=None):
+    # evaluates boto3.dynamodb.conditions objects and condition expression strings
+    if not hasattr(condition, 'get_expression'):
+        return ConditionParser(condition, names or {}, values or {}).evaluate(item)
+    expression = condition.get_expression()
+    operator = expression['operator']
+    values = expression['values']
+    if operator == 'AND':
+        return evaluate(values[0], item) and evaluate(values[1], item)
+    if operator == 'OR':
+        return evaluate(values[0], item) or evaluate(values[1], item)
+    if operator == 'NOT':
+        return not evaluate(values[0], item)
+
+    value = get_path(item, values[0].name.split('.'))
+    operands = [to_dynamo(operand) for operand in values[1:]]
+    if operator == 'attribute_exists':
+        return value is not None
+    if operator == 'attribute_not_exists':
+        return value is None
+    if operator == 'attribute_type':
+        return dynamo_type(value) == operands[0]
+    if value is None:
+        return False
+    if operator == '=':
+        return value == operands[0]
+    if operator == '<>':
+        return value != operands[0]
+    if operator == '<':
+        return value < operands[0]
+    if operator == '<=':
+        return value <= operands[0]
+    if operator == '>':
+        return value > operands[0]
+    if operator == '>=':
+        return value >= operands[0]
+    if operator == 'BETWEEN':
+        return operands[0] <= value <= operands[1]
+    if operator == 'begins_with':
+        return value.startswith(operands[0])
+    if operator == 'contains':
+        return operands[0] in value
+    if operator == 'IN':
+        return value in operands[0]
+    raise NotImplementedError('condition operator ' + operator)
+
+
+class ConditionParser(object):
+    # recursive descent over the condition expression grammar: comparisons, functions,
+    # AND / OR / NOT and parentheses
+    TOKENS = re.compile(r'\s*(<>|<=|>=|[=<>(),]|[^\s=<>(),]+)')
+    COMPARISONS = {'=': lambda a, b: a == b, '<>': lambda a, b: a != b, '<': lambda a, b: a < b,
+                   '<=': lambda a, b: a <= b, '>': lambda a, b: a > b, '>=': lambda a, b: a >= b}
+
+    def __init__(self, expression, names, values):
+        self.tokens = self.TOKENS.findall(expression)
+        self.names = names
+        self.values = {k: to_dynamo(v) for k, v in values.items()}
+        self.position = 0
+
+    def evaluate(self, item):
+        self.item = item
+        self.position = 0
+        result = self.disjunction()
+        if self.position != len(self.tokens):
+            raise NotImplementedError('condition expression near ' + ' '.join(self.tokens[self.position:]))
+        return result
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and (token or '').upper() != expected:
+            raise NotImplementedError('expected ' + expected + ' in condition expression, got ' + str(token))
+        self.position += 1
+        return token
+
+    def disjunction(self):
+        result = self.conjunction()
+        while (self.peek() or '').upper() == 'OR':
+            self.take()
+            result = self.conjunction() or result
+        return result
+
+    def conjunction(self):
+        result = self.negation()
+        while (self.peek() or '').upper() == 'AND':
+            self.take()
+            result = self.negation() and result
+        return result
+
+    def negation(self):
+        if (self.peek() or '').upper() == 'NOT':
+            self.take()
+            return not self.negation()
+        if self.peek() == '(':
+            self.take()
+            result = self.disjunction()
+            self.take(')')
+            return result
+        if self.tokens[self.position + 1:self.position + 2] == ['('] and self.peek() != 'size':
+            return self.function()
+        left = self.operand()
+        operator = self.take()
+        right = self.operand()
+        if left is None or right is None:
+            return False
+        return self.COMPARISONS[operator](left, right)
+
+    def function(self):
+        name = self.take()
+        self.take('(')
+        path = self.path(self.take())
+        arguments = []
+        while self.peek() == ',':
+            self.take()
+            arguments.append(self.values[self.take()])
+        self.take(')')
+        value = get_path(self.item, path)
+        if name == 'attribute_exists':
+            return value is not None
+        if name == 'attribute_not_exists':
+            return value is None
+        if name == 'attribute_type':
+            return dynamo_type(value) == arguments[0]
+        if value is None:
+            return False
+        if name == 'contains':
+            return arguments[0] in value
+        if name == 'begins_with':
+            return value.startswith(arguments[0])
+        raise NotImplementedError('condition function ' + name)
+
+    def operand(self):
+        token = self.take()
+        if token == 'size':
+            self.take('(')
+            value = get_path(self.item, self.path(self.take()))
+            self.take(')')
+            return Decimal(len(value)) if value is not None else None
+        if token.startswith(':'):
+            return self.values[token]
+        return get_path(self.item, self.path(token))
+
+    def path(self, token):
+        return split_path(token, self.names)
+
+
+def dynamo_type(value):
+    if isinstance(value, bool):
+        return 'BOOL'
+    if isinstance(value, Decimal):
+        return 'N'
+    if isinstance(value, dict):
+        return 'M'
+    if isinstance(value, list):
+        return 'L'
+    if isinstance(value, (set, frozenset)):
+        return 'SS'
+    if value is None:
+        return None
+    return 'S'
+
+
+def split_top_level(text, separator=','):
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        if char == separator and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current)
+    return parts
+
+
+def find_top_level(text, operator):
+    depth = 0
+    for i, char in enumerate(text):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif depth == 0 and text.startswith(operator, i):
+            return i
+    return -1
+
+
+class UpdateExpressionEvaluator(object):
+    # SET (with if_not_exists, list_append, + and -), REMOVE and ADD clauses
+    CLAUSES = re.compile(r'\b(SET|REMOVE|ADD|DELETE)\b', re.I)
+
+    def __init__(self, expression, names, values):
+        self.names = names or {}
+        self.values = {k: to_dynamo(v) for k, v in (values or {}).items()}
+        self.actions = []
+        tokens = self.CLAUSES.split(expression)
+        for clause, body in zip(tokens[1::2], tokens[2::2]):
+            for action in split_top_level(body):
+                self.actions.append((clause.upper(), action.strip()))
+
+    def apply(self, item, operation):
+        updated = []
+        for clause, action in self.actions:
+            if clause == 'SET':
+                path, value = action.split('=', 1)
+                parts = split_path(path, self.names)
+                set_path(item, parts, self.operand(value.strip(), item), operation)
+            elif clause == 'REMOVE':
+                parts = split_path(action, self.names)
+                remove_path(item, parts)
+            elif clause == 'ADD':
+                path, value = action.split()
+                parts = split_path(path, self.names)
+                current = get_path(item, parts)
+                increment = self.values[value]
+                if isinstance(increment, (set, frozenset)):
+                    set_path(item, parts, set(current or set()) | set(increment), operation)
+                else:
+                    set_path(item, parts, (current or Decimal(0)) + increment, operation)
+            else:
+                raise NotImplementedError('update clause ' + clause)
+            updated.append(parts)
+        return updated
+
+    def operand(self, text, item):
+        text = text.strip()
+        for operator in (' + ', ' - '):
+            position = find_top_level(text, operator)
+            if position >= 0:
+                left = self.operand(text[:position], item)
+                right = self.operand(text[position + len(operator):], item)
+                return left + right if operator == ' + ' else left - right
+        if text.startswith('if_not_exists('):
+            path, default = split_top_level(text[len('if_not_exists('):-1])
+            value = get_path(item, split_path(path, self.names))
+            return copy.deepcopy(value) if value is not None else self.operand(default, item)
+        if text.startswith('list_append('):
+            first, second = split_top_level(text[len('list_append('):-1])
+            return (self.operand(first, item) or []) + (self.operand(second, item) or [])
+        if text.startswith(':'):
+            return copy.deepcopy(self.values[text])
+        return copy.deepcopy(get_path(item, split_path(text, self.names)))
+
+
+def serialized(method):
+    # conditional writes are atomic in dynamodb, the stand-ins check and write under one lock
+    def locked(self, *args, **kwargs):
+        with self.resource.write_lock:
+            return method(self, *args, **kwargs)
+    return locked
+
+
+class FakeTable(object):
+    def __init__(self, resource, name, hash_key, range_key=None, indexes=None):
+        self.resource = resource
+        self.name = name
+        self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.indexes = indexes or {}
+        self.items = {}
+
+    def count(self, operation):
+        self.resource.count(operation)
+
+    def key_of(self, item):
+        return item[self.hash_key], item.get(self.range_key) if self.range_key else None
+
+    def write(self, key, item):
+        # items new to a table with a stream are recorded for FakeStreamsClient
+        if key not in self.items and self.name in self.resource.STREAMS:
+            self.resource.streams[self.name].append(copy.deepcopy(item))
+        self.items[key] = item
+
+    def check(self, condition, item, operation, names=None, values=None):
+        if condition is not None and not evaluate(condition, item or {}, names, values):
+            raise client_error('ConditionalCheckFailedException', operation, 'The conditional request failed')
+
+    @serialized
+    def put_item(self, Item, ConditionExpression=None, ReturnValues='NONE', ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, **kwargs):
+        self.count('put_item')
+        self.resource.consume_write(self.name, 1, 'PutItem')
+        item = to_dynamo(Item)
+        key = self.key_of(item)
+        old = self.items.get(key)
+        self.check(ConditionExpression, old, 'PutItem', ExpressionAttributeNames, ExpressionAttributeValues)
+        self.resource.check_size(item, 'PutItem')
+        self.write(key, item)
+        return {'Attributes': copy.deepcopy(old)} if ReturnValues == 'ALL_OLD' and old else {}
+
+    def get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, ConsistentRead=False):
+        self.count('get_item')
+        check_placeholders('GetItem', ExpressionAttributeNames, None, ProjectionExpression)
+        item = self.items.get(self.key_of(to_dynamo(Key)))
+        if item is None:
+            self.resource.count_read([], [], ConsistentRead)
+            return {}
+        projected = project(item, ProjectionExpression, ExpressionAttributeNames or {})
+        self.resource.count_read([item], [projected], ConsistentRead)
+        return {'Item': projected}
+
+    @serialized
+    def delete_item(self, Key, ConditionExpression=None, ReturnValues='NONE', ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, **kwargs):
+        self.count('delete_item')
+        self.resource.consume_write(self.name, 1, 'DeleteItem')
+        key = self.key_of(to_dynamo(Key))
+        old = self.items.get(key)
+        self.check(ConditionExpression, old, 'DeleteItem', ExpressionAttributeNames, ExpressionAttributeValues)
+        self.items.pop(key, None)
+        return {'Attributes': copy.deepcopy(old)} if ReturnValues == 'ALL_OLD' and old else {}
+
+    @serialized
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None,
+                    ConditionExpression=None, ReturnValues='NONE', **kwargs):
+        self.count('update_item')
+        self.resource.consume_write(self.name, 1, 'UpdateItem')
+        check_placeholders('UpdateItem', ExpressionAttributeNames, ExpressionAttributeValues,
+                           UpdateExpression, ConditionExpression)
+        key_item = to_dynamo(Key)
+        key = self.key_of(key_item)
+        old = self.items.get(key)
+        self.check(ConditionExpression, old, 'UpdateItem', ExpressionAttributeNames, ExpressionAttributeValues)
+
+        item = copy.deepcopy(old) if old is not None else dict(key_item)
+        expression = UpdateExpressionEvaluator(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        updated = expression.apply(item, 'UpdateItem')
+        self.resource.check_size(item, 'UpdateItem')
+        self.write(key, item)
+
+        if ReturnValues == 'ALL_OLD':
+            return {'Attributes': copy.deepcopy(old)} if old else {}
+        if ReturnValues == 'ALL_NEW':
+            return {'Attributes': copy.deepcopy(item)}
+        if ReturnValues == 'UPDATED_OLD':
+            return {'Attributes': copy_paths(old or {}, updated)}
+        if ReturnValues == 'UPDATED_NEW':
+            return {'Attributes': copy_paths(item, updated)}
+        return {}
+
+    def query(self, KeyConditionExpression, IndexName=None, ExclusiveStartKey=None, FilterExpression=None,
+              ProjectionExpression=None, ExpressionAttributeNames=None, Limit=None, ScanIndexForward=True,
+              ConsistentRead=False, **kwargs):
+        self.count('query')
+        if IndexName is not None:
+            hash_key, range_key = self.indexes[IndexName]
+        else:
+            hash_key, range_key = self.hash_key, self.range_key
+        items = [item for item in self.items.values()
+                 if hash_key in item and evaluate(KeyConditionExpression, item)]
+        if range_key:
+            items.sort(key=lambda item: (item.get(range_key), self.key_of(item)), reverse=not ScanIndexForward)
+        response = self.page(items, ExclusiveStartKey, Limit, FilterExpression, ProjectionExpression,
+                             ExpressionAttributeNames, (hash_key, range_key))
+        self.resource.count_read(response.pop('ScannedItems'), response['Items'], ConsistentRead)
+        return response
+
+    def scan(self, ExclusiveStartKey=None, FilterExpression=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None, Limit=None, ConsistentRead=False, **kwargs):
+        self.count('scan')
+        items = sorted(self.items.values(), key=self.key_of)
+        response = self.page(items, ExclusiveStartKey, Limit, FilterExpression, ProjectionExpression,
+                             ExpressionAttributeNames, (self.hash_key, self.range_key))
+        self.resource.count_read(response.pop('ScannedItems'), response['Items'], ConsistentRead)
+        return response
+
+    def page(self, items, start_key, limit, filter_expression, projection, names, index_keys):
+        if start_key is not None:
+            start = self.key_of(to_dynamo(start_key))
+            positions = [i for i, item in enumerate(items) if self.key_of(item) == start]
+            items = items[positions[0] + 1:] if positions else items
+
+        sizes = [size for size in (limit, self.resource.page_size) if size]
+        page_size = min(sizes) if sizes else len(items)
+        page, rest = items[:page_size], items[page_size:]
+
+        response = {'Items': [project(item, projection, names or {}) for item in page
+                              if filter_expression is None or evaluate(filter_expression, item)],
+                    'ScannedItems': page}
+        response['Count'] = len(response['Items'])
+        if rest and page:
+            last = page[-1]
+            last_key = {self.hash_key: last[self.hash_key]}
+            if self.range_key:
+                last_key[self.range_key] = last[self.range_key]
+            for key in index_keys:
+                if key:
+                    last_key[key] = last[key]
+            response['LastEvaluatedKey'] = copy.deepcopy(last_key)
+        return response
+
+
+class FakeClient(object):
+    def __init__(self, resource):
+        self.resource = resource
+
+    def describe_table(self, TableName):
+        table = {'TableName': TableName, 'TableStatus': 'ACTIVE'}
+        if TableName in self.resource.STREAMS:
+            table['LatestStreamArn'] = stream_arn(TableName)
+        return {'Table': table}
+
+    def query(self, TableName, **kwargs):
+        return self.resource.Table(TableName).query(**kwargs)
+
+    def get_item(self, TableName, **kwargs):
+        return self.resource.Table(TableName).get_item(**kwargs)
+
+    def update_item(self, TableName, **kwargs):
+        return self.resource.Table(TableName).update_item(**kwargs)
+
+    @serialized
+    def batch_write_item(self, RequestItems):
+        self.resource.count('batch_write_item')
+        for table_name, requests in RequestItems.items():
+            if len(requests) > 25:
+                raise client_error('ValidationException', 'BatchWriteItem',
+                                   'Too many items requested for the BatchWriteItem call')
+            self.resource.consume_write(table_name, len(requests), 'BatchWriteItem')
+            table = self.resource.Table(table_name)
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = to_dynamo(request['PutRequest']['Item'])
+                    self.resource.check_size(item, 'BatchWriteItem')
+                    table.write(table.key_of(item), item)
+                else:
+                    table.items.pop(table.key_of(to_dynamo(request['DeleteRequest']['Key'])), None)
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems):
+        self.resource.count('batch_get_item')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            if len(request['Keys']) > 100:
+                raise client_error('ValidationException', 'BatchGetItem', 'Too many items requested')
+            table = self.resource.Table(table_name)
+            found = []
+            for key in request['Keys']:
+                item = table.items.get(table.key_of(to_dynamo(key)))
+                if item is not None:
+                    found.append(project(item, request.get('ProjectionExpression'),
+                                         request.get('ExpressionAttributeNames', {})))
+                    # every item of a batch is charged on its own
+                    self.resource.count_read([item], found[-1:], request.get('ConsistentRead', False))
+            responses[table_name] = found
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    @serialized
+    def transact_write_items(self, TransactItems):
+        # every condition is checked before anything is written, all or nothing
+        self.resource.count('transact_write_items')
+        for request in TransactItems:
+            # transactions take twice the capacity of plain writes
+            self.resource.consume_write(list(request.values())[0]['TableName'], 2, 'TransactWriteItems')
+        operations = []
+        reasons = []
+        for request in TransactItems:
+            (kind, operation), = request.items()
+            table = self.resource.Table(operation['TableName'])
+            names = operation.get('ExpressionAttributeNames', None)
+            values = operation.get('ExpressionAttributeValues', None)
+            condition = operation.get('ConditionExpression', None)
+            check_placeholders('TransactWriteItems', names, values, operation.get('UpdateExpression', None),
+                               condition)
+            key = table.key_of(to_dynamo(operation['Item'] if kind == 'Put' else operation['Key']))
+            old = table.items.get(key)
+            item = None
+            if condition is not None and not evaluate(condition, old or {}, names, values):
+                reason = {'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'}
+                if old is not None and operation.get('ReturnValuesOnConditionCheckFailure', 'NONE') == 'ALL_OLD':
+                    # returned as attribute values, the resource's client only deserializes responses
+                    reason['Item'] = to_attribute_values(old)
+                reasons.append(reason)
+                continue
+            if kind == 'Put':
+                item = to_dynamo(operation['Item'])
+            elif kind == 'Update':
+                item = copy.deepcopy(old) if old is not None else to_dynamo(operation['Key'])
+                UpdateExpressionEvaluator(operation['UpdateExpression'], names, values).apply(item,
+                                                                                              'TransactWriteItems')
+            if item is not None and item_size(item) > self.resource.item_size_limit:
+                reasons.append({'Code': 'ValidationError',
+                                'Message': 'Item size has exceeded the maximum allowed size'})
+            else:
+                reasons.append({'Code': 'None'})
+            operations.append((kind, table, key, item))
+        if any(reason['Code'] != 'None' for reason in reasons):
+            error = client_error('TransactionCanceledException', 'TransactWriteItems',
+                                 'Transaction cancelled, please refer cancellation reasons for specific reasons')
+            error.response['CancellationReasons'] = reasons
+            raise error
+
+        for kind, table, key, item in operations:
+            if kind == 'Delete':
+                table.items.pop(key, None)
+            elif item is not None:
+                table.write(key, item)
+        return {}
+
+
+class FakeStreamsClient(object):
+    # a stream of one shard that never closes, of the items created in its table. an iterator
+    # is the position of the next record
+    SHARD_ID = 'shardId-00000000000000000000-00000000'
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def get_records_of(self, arn):
+        return self.resource.streams[arn.rsplit('/', 3)[1]]
+
+    def describe_stream(self, StreamArn, ExclusiveStartShardId=None, **kwargs):
+        self.resource.count('describe_stream')
+        shards = [] if ExclusiveStartShardId else [{'ShardId': self.SHARD_ID,
+                                                    'SequenceNumberRange': {'StartingSequenceNumber': '0'}}]
+        return {'StreamDescription': {'StreamArn': StreamArn, 'StreamStatus': 'ENABLED', 'Shards': shards}}
+
+    def get_shard_iterator(self, StreamArn, ShardId, ShardIteratorType, **kwargs):
+        self.resource.count('get_shard_iterator')
+        position = len(self.get_records_of(StreamArn)) if ShardIteratorType == 'LATEST' else 0
+        return {'ShardIterator': StreamArn + '#' + str(position)}
+
+    def get_records(self, ShardIterator, Limit=1000):
+        self.resource.count('get_records')
+        arn, position = ShardIterator.rsplit('#', 1)
+        items = self.get_records_of(arn)[int(position):int(position) + Limit]
+        records = [{'eventName': 'INSERT', 'dynamodb': {'NewImage': to_attribute_values(item)}} for item in items]
+        return {'Records': records, 'NextShardIterator': arn + '#' + str(int(position) + len(items))}
+
+
+def stream_arn(table_name):
+    return 'arn:aws:dynamodb:us-east-1:000000000000:table/' + table_name + '/stream/2020-01-01T00:00:00.000'
+
+
+class Meta(object):
+    pass
+
+
+class FakeDynamoResource(object):
+    SCHEMA = {
+        'active_games': ('team_id', 'name', {'end_date-index': ('index', 'end_date')}),
+        'completed_games': ('id', None, {}),
+        'bids': ('game', 'user', {}),
+        'completed_bids': ('id', 'user', {}),
+        'team_summaries': ('team_id', None, {}),
+        'settings': ('team_id', None, {}),
+        'oauth': ('team_id', None, {}),
+        'rate_limits': ('team_id', None, {}),
+    }
+    STREAMS = ('active_games',)
+    ITEM_SIZE_LIMIT = 400 * 1024
+
+    def __init__(self, page_size=None, write_capacity=None):
+        self.page_size = page_size
+        self.item_size_limit = self.ITEM_SIZE_LIMIT
+        # {table name: write units a second}, tables left out are on demand. unused capacity
+        # is kept for a second, like a provisioned table's burst but shorter
+        self.write_capacity = write_capacity or {}
+        self.write_buckets = {}
+        # writes and their call counts may come from several threads
+        self.lock = threading.Lock()
+        self.write_lock = threading.RLock()
+        self.calls = defaultdict(int)
+        self.read_units = 0
+        self.bytes_read = 0
+        self.throttled = 0
+        self.tables = {}
+        self.streams = dict((name, []) for name in self.STREAMS)
+        for name, (hash_key, range_key, indexes) in self.SCHEMA.items():
+            self.tables[name] = FakeTable(self, name, hash_key, range_key, indexes)
+        self.meta = Meta()
+        self.meta.client = FakeClient(self)
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+
+    def count_read(self, items, returned, consistent):
+        # read capacity is charged per 4 KB of the whole items read, projected or not, and
+        # halved for eventually consistent reads. a read that finds nothing still costs a unit
+        units = max(1, int(math.ceil(sum(item_size(item) for item in items) / 4096.0)))
+        with self.lock:
+            self.read_units += units if consistent else units / 2.0
+            self.bytes_read += sum(item_size(item) for item in returned)
+
+    def check_size(self, item, operation):
+        if item_size(item) > self.item_size_limit:
+            raise client_error('ValidationException', operation, 'Item size has exceeded the maximum allowed size')
+
+    def consume_write(self, table_name, units, operation):
+        capacity = self.write_capacity.get(table_name, None)
+        if capacity is None:
+            return
+        now = time.time()
+        with self.lock:
+            available, last = self.write_buckets.get(table_name, (capacity, now))
+            available = min(capacity, available + (now - last) * capacity)
+            if available < units:
+                self.write_buckets[table_name] = (available, now)
+                self.throttled += 1
+                raise client_error('ProvisionedThroughputExceededException', operation,
+                                   'The level of configured provisioned throughput for the table was exceeded')
+            self.write_buckets[table_name] = (available - units, now)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        self.calls.clear()
+        self.read_units = 0
+        self.bytes_read = 0
+        self.throttled = 0
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_write_item(self, RequestItems):
+        return self.meta.client.batch_write_item(RequestItems)
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, text='ok'):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {}
+
+
+class FakeWebhookSession(object):
+    def __init__(self):
+        self.posts = []
+
+    def post(self, url, data=None, timeout=None, **kwargs):
+        self.posts.append((url, data))
+        return FakeResponse()
+
+
+def install(page_size=None, write_capacity=None):
+    # points the handler modules at fresh stand-ins, returns (dynamodb, webhook session)
+    install_config()
+    import db
+    import storage
+    from storage.dynamodb import DynamoDbStorage
+
+    resource = FakeDynamoResource(page_size=page_size, write_capacity=write_capacity)
+    db.resource = resource
+    db.streams_client = FakeStreamsClient(resource)
+    db.tables = {}
+    storage.storage = DynamoDbStorage()
+    return resource, install_session()
+
+
+def install_sqlite(path):
+    # points the handler modules at a sqlite database in path, returns (storage, webhook session)
+    install_config()
+    import storage
+    from storage.sqlite import SqliteStorage
+
+    storage.storage = SqliteStorage(path)
+    return storage.storage, install_session()
+
+
+def install_session():
+    import cache
+    import notifications
+    from admission import admission
+
+    cache.settings_cache.clear()
+    cache.webhook_cache.clear()
+    admission.clear()
+    session = FakeWebhookSession()
+    notifications.session = session
+    return session
@@ -0,0 +1,185 @@
+"""Peak memory and time of the vcg code paths on one large game.
+
+Every case runs in a child process of its own, so that one case's garbage
+doesn't count against the next. Peak is how far the child's resident set grew
+while the case ran, sampled every millisecond from /proc (linux), and where
+tracemalloc is available (python 3) also the peak and the retained size of
+the python allocations the case made:
+
+    python benchmarks/memory.py --bids 50000 --options-per-game 3
+
+The game is read like DynamoDB returns it, numbers as Decimal, either with a
+map of all its bids (games stored before bids were items of their own) or
+with its bids streamed from separate items.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from multiprocessing import Process, Queue
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import data
+
+from vcg.codec import decode_bid  # noqa: E402
+from vcg.completed_game import CompletedGame  # noqa: E402
+from vcg.game import Game  # noqa: E402
+
+
+def write_game(path, bids, options_per_game, seed):
+    game = data.make_game('T0', 'large', bids, options_per_game, int(time.time()) + 3600, random.Random(seed))
+    with open(path, 'w') as f:
+        json.dump(game.to_json_encoded(), f)
+
+
+def load_inputs(path):
+    # (game item with a bids map, game item without one, the bids as items of their own).
+    # read straight into Decimals, so that no garbage is left for the cases to reuse
+    # unnoticed by the resident set size
+    with open(path) as f:
+        embedded = json.load(f, parse_int=Decimal)
+    bid_items = list(embedded['bids'].values())
+    separate = dict(embedded)
+    del separate['bids']
+    return embedded, separate, bid_items
+
+
+def parse_game(embedded, separate, bid_items):
+    return Game.parse_game(embedded)
+
+
+def short_info(embedded, separate, bid_items):
+    game = Game.parse_game(embedded)
+    return game, game.get_short_info() + game.get_bids_count_info()
+
+
+def all_bids(embedded, separate, bid_items):
+    game = Game.parse_game(embedded)
+    return game, game.bids
+
+
+def finalize_embedded(embedded, separate, bid_items):
+    return CompletedGame.finalize_game(Game.parse_game(embedded))
+
+
+def finalize_without_stats(embedded, separate, bid_items):
+    embedded = dict(embedded)
+    del embedded['stats']
+    return CompletedGame.finalize_game(Game.parse_game(embedded))
+
+
+def finalize_streamed(embedded, separate, bid_items):
+    return CompletedGame.finalize_game(Game.parse_game(separate, lambda team, name: iter(bid_items)))
+
+
+def decode_all(embedded, separate, bid_items):
+    # the floor: every stored bid decoded into plain dicts
+    return [decode_bid(stored_bid) for stored_bid in embedded['bids'].values()]
+
+
+CASES = [
+    ('Game.parse_game', parse_game),
+    ('Game.get_short_info', short_info),
+    ('Game.bids', all_bids),
+    ('codec.decode_bid all', decode_all),
+    ('finalize_game', finalize_embedded),
+    ('finalize_game no stats', finalize_without_stats),
+    ('finalize_game streamed', finalize_streamed),
+]
+
+
+PAGE_KIB = os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+def get_rss_kib():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_KIB
+
+
+class RssSampler(threading.Thread):
+    # the highest resident set size seen until stopped
+    def __init__(self, interval=0.001):
+        super(RssSampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.peak = get_rss_kib()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak = max(self.peak, get_rss_kib())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, get_rss_kib())
+        return self.peak
+
+
+def measure(case, path, results):
+    inputs = load_inputs(path)
+    gc.collect()
+    rss_before = get_rss_kib()
+    sampler = RssSampler()
+    sampler.start()
+    if tracemalloc is not None:
+        tracemalloc.start()
+    started = time.time()
+    result = case(*inputs)
+    elapsed = time.time() - started
+    measured = {'seconds': elapsed, 'peak_rss_kib': sampler.stop() - rss_before}
+    if tracemalloc is not None:
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        measured.update({'peak_traced_kib': peak / 1024.0, 'retained_traced_kib': retained / 1024.0})
+    del result
+    results.put(measured)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bids', type=int, default=50000)
+    parser.add_argument('--options-per-game', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as json to this file')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='gamesofni-memory-')
+    path = os.path.join(directory, 'game.json')
+    write_game(path, args.bids, args.options_per_game, args.seed)
+    results = []
+    try:
+        for name, case in CASES:
+            queue = Queue()
+            child = Process(target=measure, args=(case, path, queue))
+            child.start()
+            measured = queue.get()
+            child.join()
+            measured['name'] = name
+            results.append(measured)
+            print('%-24s bids %6d options %2d  %9.1f ms  peak rss %8d KiB%s' % (
+                name, args.bids, args.options_per_game, measured['seconds'] * 1000, measured['peak_rss_kib'],
+                '  peak traced %9.1f KiB  retained %9.1f KiB' % (measured['peak_traced_kib'],
+                                                                 measured['retained_traced_kib'])
+                if 'peak_traced_kib' in measured else ''))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'params': vars(args), 'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Game.parse_game benchmark for the legacy and the native bid encodings.
+
+    python benchmarks/parse_game.py --sizes 10 1000 50000 --output parse_game.json
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'gamesofni'))
+
+from vcg.game import Game  # noqa: E402
+from vcg.codec import encode_bid  # noqa: E402
+
+
+def make_db_game(bids_count, codec, options=('red', 'green', 'blue')):
+    bids = {}
+    for i in range(bids_count):
+        user = 'user%d' % i
+        option = options[i % len(options)] if options else None
+        if codec == 'legacy':
+            json_bid = {'user': user, 'amount': i % 97}
+            if option:
+                json_bid['option'] = option
+            bids[user] = str(json_bid)
+        else:
+            # mimic what boto3 hands back for a native map
+            json_bid = encode_bid(user, Decimal(i % 97), option)
+            json_bid['v'] = Decimal(json_bid['v'])
+            bids[user] = json_bid
+
+    return {
+        'team_id': 'TBENCH',
+        'name': 'bench',
+        'creator': 'bench_user',
+        'start_date': Decimal(1500000000),
+        'end_date': Decimal(1500086400),
+        'utc_offset': '0',
+        'options': json.dumps(list(options)) if codec == 'legacy' else list(options),
+        'bids': bids,
+    }
+
+
+def bench(bids_count, codec, repeat):
+    db_game = make_db_game(bids_count, codec)
+    number = max(1, 20000 // max(bids_count, 1))
+    best = min(timeit.repeat(lambda: Game.parse_game(db_game), number=number, repeat=repeat))
+    return best / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='*', type=int, default=[10, 1000, 50000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write results as json to this file')
+    args = parser.parse_args()
+
+    results = []
+    for bids_count in args.sizes:
+        legacy = bench(bids_count, 'legacy', args.repeat)
+        native = bench(bids_count, 'native', args.repeat)
+        results.append({'bids': bids_count, 'legacy_seconds': legacy, 'native_seconds': native})
+        print('%6d bids  legacy %10.3f ms  native %10.3f ms  speedup %5.1fx' % (
+            bids_count, legacy * 1000, native * 1000, legacy / native))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,337 @@
+"""Record-and-replay load generator for lambda_handler.
+
+Events are read from a recording or synthesized from a workload profile and
+replayed in-process against lambda_handler, with DynamoDB and the Slack
+webhooks replaced by the stand-ins from fakes.py (or --storage sqlite).
+Throughput, p50/p95/p99 latency and DynamoDB calls per request are reported
+for every route.
+
+Recordings are json lines of scrubbed events, written by the handler when
+EVENT_RECORD_PATH is set. Payload logs work too, their 'Received event'
+lines are picked up (see PAYLOAD_LOG_SAMPLE_RATE):
+
+    python benchmarks/replay.py --events events.jsonl --rate 50
+    python benchmarks/replay.py --events events.jsonl --speed 10
+    python benchmarks/replay.py --profile bid=80,create_game=5,info=15 --requests 2000 --concurrency 8
+
+A noisy neighbour: one team sends --noisy-share of the synthesized events,
+the tables get --write-capacity units a second and teams are admitted at
+--admission-rate commands a second (see admission.py). Latency is then also
+reported for the noisy team and for the others, along with the commands told
+to try again later:
+
+    python benchmarks/replay.py --profile bid=90,info=10 --requests 3000 --concurrency 8 \
+        --noisy-share 0.8 --write-capacity 200 --admission-rate 20
+
+With --rate or --speed requests are started on schedule whether or not earlier
+ones finished (open loop) and latency counts from the scheduled start, so time
+spent queued for a worker is included. Otherwise --concurrency workers send
+requests back to back (closed loop). DynamoDB calls are counted per request
+when requests run one at a time (--concurrency 1), otherwise only in total.
+"""
+import argparse
+import json
+import logging
+import math
+import random
+import shutil
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import fakes
+import data
+
+fakes.install_config()
+
+import config  # noqa: E402
+import lambda_handler  # noqa: E402
+import storage  # noqa: E402
+
+RECEIVED_EVENT = 'Received event: '
+ROUTES = ['bid', 'create_game', 'info', 'set_timezone', 'scheduled']
+
+
+class Context(object):
+    def __init__(self, request_id):
+        self.aws_request_id = request_id
+
+
+def load_events(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('{'):
+                events.append(json.loads(line))
+            elif RECEIVED_EVENT in line:
+                events.append(json.loads(line.split(RECEIVED_EVENT, 1)[1]))
+    return events
+
+
+def prepare_events(events, teams):
+    # recordings are scrubbed and come from other teams: tokens are restored and every
+    # recorded team is mapped onto one of the populated teams
+    team_map = {}
+    prepared = []
+    for event in events:
+        event = dict(event)
+        event.pop('recorded', None)
+        event.pop('request_id', None)
+        if 'token' in event:
+            event['token'] = str(config.slack_token)
+        if event.get('source', None) == 'aws.events':
+            event['account'] = str(config.aws_account)
+        if 'team_id' in event:
+            if event['team_id'] not in team_map:
+                team_map[event['team_id']] = 'T%05d' % (len(team_map) % teams)
+            event['team_id'] = team_map[event['team_id']]
+        prepared.append(event)
+    return prepared
+
+
+def get_offsets(events, rate, speed):
+    # seconds from the start of the replay at which every event is sent, None for closed loop
+    if rate:
+        return [i / float(rate) for i in range(len(events))]
+    if speed:
+        recorded = [event.get('recorded', None) for event in events]
+        if None in recorded:
+            raise SystemExit('--speed needs recorded timestamps, replay with --rate instead')
+        return [(at - recorded[0]) / float(speed) for at in recorded]
+    return None
+
+
+def parse_profile(profile):
+    weights = {}
+    for part in profile.split(','):
+        route, _, weight = part.partition('=')
+        if route not in ROUTES:
+            raise SystemExit('unknown route in profile: ' + route)
+        weights[route] = float(weight or 1)
+    return weights
+
+
+def synthesize_events(weights, requests, teams, games_per_team, options_per_game, users, seed, noisy_share=None):
+    # with noisy_share the first team sends that share of the events, the others the rest
+    rng = random.Random(seed)
+    routes = sorted(weights)
+    total = sum(weights.values())
+    options = data.OPTION_NAMES[:options_per_game]
+    events = []
+    for i in range(requests):
+        pick = rng.uniform(0, total)
+        for route in routes:
+            pick -= weights[route]
+            if pick <= 0:
+                break
+        if noisy_share:
+            team = 0 if rng.random() < noisy_share else rng.randrange(1, teams)
+        else:
+            team = rng.randrange(teams)
+        slash = {'token': str(config.slack_token), 'team_id': 'T%05d' % team,
+                 'team_domain': 'replay', 'user_name': 'user%d' % rng.randrange(users)}
+        if route == 'bid':
+            text = 'game%d %d' % (rng.randrange(games_per_team), rng.randint(0, 1000))
+            events.append(dict(slash, command='/bid', text=text + (' ' + rng.choice(options) if options else '')))
+        elif route == 'create_game':
+            events.append(dict(slash, command='/create_game', text='replay%d 31-12-37 12:00 red green' % i))
+        elif route == 'info':
+            events.append(dict(slash, resource='/info', command='/info', text=''))
+        elif route == 'set_timezone':
+            events.append(dict(slash, command='/set_timezone', text='utc+%d' % rng.randint(0, 12)))
+        else:
+            events.append({'source': 'aws.events', 'account': str(config.aws_account)})
+    return events
+
+
+def install_storage(args, directory):
+    # returns the fake dynamodb resource, None with sqlite
+    if args.storage == 'sqlite':
+        resource = None
+        store, session = fakes.install_sqlite(directory + '/replay.db')
+    else:
+        resource, session = fakes.install()
+        store = storage.get_storage()
+    data.populate(store, teams=args.teams, games_per_team=args.games_per_team,
+                  bids_per_game=args.bids_per_game, options_per_game=args.options_per_game)
+    if resource is not None and args.write_capacity:
+        # rate_limits stays on demand
+        resource.write_capacity = dict((name, args.write_capacity) for name in resource.SCHEMA
+                                       if name != 'rate_limits')
+    if args.admission_rate:
+        config.admission_rate = args.admission_rate
+        config.admission_burst = args.admission_burst
+    return resource
+
+
+def replay(events, offsets, concurrency, resource):
+    # returns [(route, team, latency seconds, dynamodb calls or None, failed, told to try again)]
+    # and the elapsed seconds
+    count_calls = resource is not None and concurrency == 1
+    results = []
+    results_lock = threading.Lock()
+
+    def send(i, scheduled):
+        event = events[i]
+        started = time.time()
+        calls = resource.total_calls() if count_calls else None
+        failed = False
+        response = None
+        try:
+            response = lambda_handler.lambda_handler(dict(event), Context('replay-%d' % i))
+        except Exception:
+            failed = True
+        rejected = isinstance(response, dict) and 'please try again in' in response.get('text', '')
+        finished = time.time()
+        if count_calls:
+            calls = resource.total_calls() - calls
+        # open loop latency includes the time spent waiting for a free worker
+        latency = finished - (scheduled if scheduled is not None else started)
+        with results_lock:
+            results.append((lambda_handler.get_route(event), event.get('team_id', None), latency, calls, failed,
+                            rejected))
+
+    pool = ThreadPool(concurrency)
+    started = time.time()
+    for i in range(len(events)):
+        scheduled = None
+        if offsets is not None:
+            scheduled = started + offsets[i]
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        pool.apply_async(send, (i, scheduled))
+    pool.close()
+    pool.join()
+    return results, time.time() - started
+
+
+def percentile(sorted_values, p):
+    # nearest rank
+    return sorted_values[max(0, min(len(sorted_values) - 1, int(math.ceil(p / 100.0 * len(sorted_values))) - 1))]
+
+
+def summarize_group(group_results, elapsed):
+    latencies = sorted(latency for route, team, latency, calls, failed, rejected in group_results)
+    calls = [calls for route, team, latency, calls, failed, rejected in group_results if calls is not None]
+    stats = {
+        'requests': len(group_results),
+        'errors': sum(1 for route, team, latency, calls, failed, rejected in group_results if failed),
+        'rejected': sum(1 for route, team, latency, calls, failed, rejected in group_results if rejected),
+        'throughput_per_second': len(group_results) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+    if calls:
+        stats['dynamodb_calls_per_request'] = sum(calls) / float(len(calls))
+    return stats
+
+
+def summarize(results, elapsed, resource, noisy_team=None):
+    by_route = {}
+    by_team = {}
+    for result in results:
+        route, team = result[:2]
+        by_route.setdefault(route, []).append(result)
+        if noisy_team is not None and team is not None:
+            by_team.setdefault('noisy team' if team == noisy_team else 'other teams', []).append(result)
+
+    summary = {'requests': len(results), 'elapsed_seconds': elapsed,
+               'throughput_per_second': len(results) / elapsed,
+               'routes': dict((route, summarize_group(group, elapsed)) for route, group in by_route.items())}
+    if by_team:
+        summary['teams'] = dict((team, summarize_group(group, elapsed)) for team, group in by_team.items())
+    if resource is not None:
+        summary['dynamodb_calls'] = dict(resource.calls)
+        summary['dynamodb_calls_per_request'] = resource.total_calls() / float(max(len(results), 1))
+        summary['dynamodb_read_units'] = resource.read_units
+        summary['dynamodb_bytes_read'] = resource.bytes_read
+        summary['dynamodb_throttled'] = resource.throttled
+    return summary
+
+
+def print_summary(summary):
+    print('%-16s %8s %7s %8s %10s %9s %9s %9s %9s %10s' % (
+        'route', 'requests', 'errors', 'rejected', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'db calls'))
+    groups = [summary['routes'][route] for route in sorted(summary['routes'], key=str)]
+    names = sorted(summary['routes'], key=str)
+    if 'teams' in summary:
+        names += sorted(summary['teams'])
+        groups += [summary['teams'][team] for team in sorted(summary['teams'])]
+    for name, stats in zip(names, groups):
+        calls = stats.get('dynamodb_calls_per_request', None)
+        print('%-16s %8d %7d %8d %10.1f %9.3f %9.3f %9.3f %9.3f %10s' % (
+            name, stats['requests'], stats['errors'], stats['rejected'], stats['throughput_per_second'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms'], stats['max_ms'],
+            '%.2f' % calls if calls is not None else '-'))
+    print('%d requests in %.3fs, %.1f req/s%s%s' % (
+        summary['requests'], summary['elapsed_seconds'], summary['throughput_per_second'],
+        ', %.2f dynamodb calls per request' % summary['dynamodb_calls_per_request']
+        if 'dynamodb_calls_per_request' in summary else '',
+        ', %d throttled' % summary['dynamodb_throttled'] if summary.get('dynamodb_throttled', None) else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--events', help='recorded events, json lines or payload logs')
+    source.add_argument('--profile', help='synthesize events, e.g. bid=80,create_game=5,info=15')
+    parser.add_argument('--requests', type=int, default=1000, help='number of synthesized events')
+    parser.add_argument('--users', type=int, default=50, help='distinct bidders of synthesized events')
+    parser.add_argument('--seed', type=int, default=0)
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument('--rate', type=float, help='requests per second')
+    pace.add_argument('--speed', type=float, help='replay recorded timing this many times faster')
+    parser.add_argument('--concurrency', type=int, default=1, help='requests in flight at most')
+    parser.add_argument('--teams', type=int, default=3)
+    parser.add_argument('--games-per-team', type=int, default=10)
+    parser.add_argument('--bids-per-game', type=int, default=10)
+    parser.add_argument('--options-per-game', type=int, default=0)
+    parser.add_argument('--storage', default='dynamodb', choices=['dynamodb', 'sqlite'])
+    parser.add_argument('--noisy-share', type=float, help='share of synthesized events sent by the first team')
+    parser.add_argument('--write-capacity', type=float, help='write units a second of every table but rate_limits')
+    parser.add_argument('--admission-rate', type=float, help='commands a second admitted per team')
+    parser.add_argument('--admission-burst', type=int, default=10, help='commands a team may send at once')
+    parser.add_argument('--output', help='write the summary as json to this file')
+    args = parser.parse_args()
+    if args.profile and args.speed:
+        parser.error('--speed replays recorded timing, use --rate with --profile')
+    if args.noisy_share and (args.events or args.teams < 2):
+        parser.error('--noisy-share synthesizes events of at least two teams')
+
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    if args.events:
+        events = load_events(args.events)
+        offsets = get_offsets(events, args.rate, args.speed)
+        events = prepare_events(events, args.teams)
+    else:
+        events = synthesize_events(parse_profile(args.profile), args.requests, args.teams, args.games_per_team,
+                                   args.options_per_game, args.users, args.seed, args.noisy_share)
+        offsets = get_offsets(events, args.rate, None)
+    if not events:
+        raise SystemExit('no events to replay')
+
+    directory = tempfile.mkdtemp(prefix='gamesofni-replay-')
+    try:
+        resource = install_storage(args, directory)
+        if resource is not None:
+            resource.reset_calls()
+        results, elapsed = replay(events, offsets, args.concurrency, resource)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    summary = summarize(results, elapsed, resource, 'T%05d' % 0 if args.noisy_share else None)
+    summary['params'] = dict((name, value) for name, value in vars(args).items() if name != 'output')
+    print_summary(summary)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
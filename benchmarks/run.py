@@ -0,0 +1,229 @@
+"""Benchmark suite for the vcg hot paths and the lambda_handler routes.
+
+DynamoDB and the Slack webhooks are replaced by the in-process stand-ins
+from fakes.py, so results measure our own code and report DynamoDB round
+trips per operation. With --storage sqlite the handlers run against the
+sqlite backend in a temporary directory instead. Results are written as json and can be compared
+against an earlier run to catch regressions:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --output after.json --compare before.json
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import fakes
+import data
+
+fakes.install_config()
+
+import config  # noqa: E402
+import lambda_handler  # noqa: E402
+import storage  # noqa: E402
+from vcg.bid import Bid  # noqa: E402
+from vcg.completed_game import CompletedGame  # noqa: E402
+from vcg.game import Game  # noqa: E402
+
+
+class Context(object):
+    aws_request_id = 'benchmark'
+
+
+def slash_event(team, **kwargs):
+    event = {'token': str(config.slack_token), 'team_id': team, 'team_domain': 'bench',
+             'user_name': 'bench_user'}
+    event.update(kwargs)
+    return event
+
+
+def measure(run, setup, repeat, min_sample_seconds=0.01):
+    # returns per-call timings of run(state) and the stand-in calls made by it,
+    # fast calls without stand-ins are looped so every sample lasts min_sample_seconds
+    timings, calls, reads, posts = [], [], [], []
+    number = None
+    for _ in range(repeat):
+        state = setup()
+        session = state.get('session') if isinstance(state, dict) else None
+        resource = state.get('resource') if session is not None else None
+        if resource is not None:
+            resource.reset_calls()
+        if session is not None:
+            number = 1
+        elif number is None:
+            started = time.time()
+            run(state)
+            number = max(1, int(min_sample_seconds / max(time.time() - started, 1e-7)))
+
+        started = time.time()
+        for _ in range(number):
+            run(state)
+        timings.append((time.time() - started) / number)
+        if resource is not None:
+            calls.append(dict(resource.calls))
+            reads.append((resource.read_units, resource.bytes_read))
+        if session is not None:
+            posts.append(len(session.posts))
+    timings.sort()
+    result = {'median_seconds': timings[len(timings) // 2], 'min_seconds': timings[0]}
+    if calls:
+        result['dynamodb_calls'] = calls[-1]
+        result['dynamodb_read_units'], result['dynamodb_bytes_read'] = reads[-1]
+    if posts:
+        result['webhook_posts'] = posts[-1]
+    return result
+
+
+def vcg_cases(games_per_team, bids_per_game, options_per_game):
+    rng = random.Random(0)
+    db_game = data.make_db_game('T0', 'bench', bids_per_game, options_per_game, int(time.time()) + 3600, rng)
+    db_games = [data.make_db_game('T0', 'bench%d' % i, bids_per_game, options_per_game,
+                                  int(time.time()) + 3600, rng) for i in range(games_per_team)]
+    command = 'bench 10' + (' option0' if options_per_game else '')
+
+    yield 'vcg.parse_game', lambda state: Game.parse_game(db_game), lambda: None
+    yield 'vcg.finalize_game', lambda game: CompletedGame.finalize_game(game), lambda: Game.parse_game(db_game)
+    yield 'vcg.get_active_games_info', lambda state: Game.get_active_games_info(db_games), lambda: None
+    yield 'vcg.get_completed_games_messages', CompletedGame.get_completed_games_messages, \
+        lambda: CompletedGame.get_completed_games([Game.parse_game(db_game) for db_game in db_games])
+    yield 'vcg.bid_parse_from_command', lambda state: Bid.parse_from_command(command, 'bench_user'), lambda: None
+
+
+def handler_cases(teams, games_per_team, bids_per_game, options_per_game, backend, directory):
+    databases = itertools.count()
+
+    def populated(ended=False, summarized=False):
+        def setup():
+            if backend == 'sqlite':
+                resource = None
+                path = os.path.join(directory, 'bench%d.db' % next(databases))
+                store, session = fakes.install_sqlite(path)
+            else:
+                resource, session = fakes.install()
+                store = storage.get_storage()
+            games = data.populate(store, teams=teams, games_per_team=games_per_team,
+                                  bids_per_game=bids_per_game, options_per_game=options_per_game, ended=ended)
+            if summarized:
+                # steady state, an earlier /info already built the team's summary
+                store.get_team_summary('T00000')
+            return {'resource': resource, 'session': session, 'games': games}
+        return setup
+
+    bid_text = 'game0 10' + (' option0' if options_per_game else '')
+    batch_bid_text = '; '.join('game%d 10' % i + (' option0' if options_per_game else '')
+                               for i in range(min(games_per_team, 5)))
+
+    def bid(state):
+        lambda_handler.lambda_handler(slash_event('T00000', command='/bid', text=bid_text,
+                                                  user_name='new_bidder'), Context())
+
+    def batch_bid(state):
+        lambda_handler.lambda_handler(slash_event('T00000', command='/bid', text=batch_bid_text,
+                                                  user_name='new_bidder'), Context())
+
+    def info(state):
+        lambda_handler.lambda_handler(slash_event('T00000', resource='/info'), Context())
+
+    def create_game(state):
+        lambda_handler.lambda_handler(slash_event('T00000', command='/create_game',
+                                                  text='new_game 31-12-37 12:00 red green'), Context())
+
+    def scheduled(state):
+        lambda_handler.lambda_handler({'source': 'aws.events', 'account': str(config.aws_account)}, Context())
+
+    yield 'handler./bid', bid, populated()
+    yield 'handler./bid batch', batch_bid, populated()
+    yield 'handler./info', info, populated(summarized=True)
+    yield 'handler./create_game', create_game, populated()
+    yield 'handler.scheduled', scheduled, populated(ended=True)
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if before is None:
+            continue
+        ratio = result['median_seconds'] / max(before['median_seconds'], 1e-9)
+        calls_before = sum(before.get('dynamodb_calls', {}).values())
+        calls_after = sum(result.get('dynamodb_calls', {}).values())
+        if ratio > 1 + threshold or calls_after > calls_before:
+            regressions.append((result, ratio, calls_before, calls_after))
+    for result, ratio, calls_before, calls_after in regressions:
+        print('REGRESSION %-28s %s  time x%.2f  dynamodb calls %d -> %d' % (
+            result['name'], json.dumps(result['params'], sort_keys=True), ratio, calls_before, calls_after))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', nargs='*', default=['vcg', 'handler'], choices=['vcg', 'handler'])
+    parser.add_argument('--teams', type=int, default=3)
+    parser.add_argument('--games-per-team', nargs='*', type=int, default=[10])
+    parser.add_argument('--bids-per-game', nargs='*', type=int, default=[10, 1000])
+    parser.add_argument('--options-per-game', nargs='*', type=int, default=[0, 5])
+    parser.add_argument('--storage', default='dynamodb', choices=['dynamodb', 'sqlite'],
+                        help='backend the handler suite runs against')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--compare', help='json results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative slowdown')
+    args = parser.parse_args()
+
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    directory = tempfile.mkdtemp(prefix='gamesofni-bench-')
+    try:
+        results = run_cases(args, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        'meta': {'python': platform.python_version(), 'created': int(time.time()), 'repeat': args.repeat},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        sys.exit(1)
+
+
+def run_cases(args, directory):
+    results = []
+    for games, bids, options in itertools.product(args.games_per_team, args.bids_per_game, args.options_per_game):
+        params = {'teams': args.teams, 'games_per_team': games, 'bids_per_game': bids,
+                  'options_per_game': options}
+        cases = []
+        if 'vcg' in args.suites:
+            cases += [(name, run, setup, params) for name, run, setup in vcg_cases(games, bids, options)]
+        if 'handler' in args.suites:
+            handler_params = dict(params, storage=args.storage)
+            cases += [(name, run, setup, handler_params) for name, run, setup in
+                      handler_cases(args.teams, games, bids, options, args.storage, directory)]
+
+        for name, run, setup, case_params in cases:
+            result = {'name': name, 'params': case_params}
+            result.update(measure(run, setup, args.repeat))
+            results.append(result)
+            print('%-28s games %4d bids %6d options %2d  median %9.3f ms  dynamodb calls %s  read units %s' % (
+                name, games, bids, options, result['median_seconds'] * 1000,
+                sum(result.get('dynamodb_calls', {}).values()) if 'dynamodb_calls' in result else '-',
+                result.get('dynamodb_read_units', '-')))
+    return results
+
+
+if __name__ == '__main__':
+    main()
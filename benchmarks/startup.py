@@ -0,0 +1,144 @@
+"""Cold start benchmark for lambda_handler.
+
+Every route is measured in a fresh interpreter: time to import
+lambda_handler, latency of the first (cold) call and median latency of
+the following (warm) calls. With --local DynamoDB and the webhooks are
+replaced by the in-process stand-ins from fakes.py, --storage sqlite runs
+against a sqlite database in a temporary directory instead.
+
+    python benchmarks/startup.py --local --repeat 5 --output startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.join(BENCHMARKS_DIR, os.pardir, 'gamesofni')
+
+ROUTES = ['info', 'bid', 'create_game', 'set_timezone', 'scheduled']
+
+CHILD = r'''
+import json
+import logging
+import sys
+import time
+
+logging.getLogger().addHandler(logging.NullHandler())
+sys.path.insert(0, %(package_dir)r)
+sys.path.insert(0, %(benchmarks_dir)r)
+import fakes
+config = fakes.install_config()
+
+
+class Context(object):
+    aws_request_id = 'startup-benchmark'
+
+
+def make_event(route):
+    slash = {'token': str(config.slack_token), 'team_id': 'T00000', 'team_domain': 'bench',
+             'user_name': 'bench_user'}
+    if route == 'info':
+        return dict(slash, resource='/info')
+    if route == 'bid':
+        return dict(slash, command='/bid', text='game0 10')
+    if route == 'create_game':
+        return dict(slash, command='/create_game', text='startup_bench 31-12-37 12:00')
+    if route == 'set_timezone':
+        return dict(slash, command='/set_timezone', text='utc+0')
+    return {'source': 'aws.events', 'account': str(config.aws_account)}
+
+
+route = %(route)r
+started = time.time()
+import lambda_handler
+imported = time.time()
+
+if %(sqlite_path)r:
+    import data
+    store, session = fakes.install_sqlite(%(sqlite_path)r)
+    data.populate(store, games_per_team=1, ended=route == 'scheduled')
+elif %(local)r:
+    import data
+    import storage
+    resource, session = fakes.install()
+    data.populate(storage.get_storage(), games_per_team=1, ended=route == 'scheduled')
+
+call_started = time.time()
+lambda_handler.lambda_handler(make_event(route), Context())
+first_call = time.time() - call_started
+
+warm = []
+for _ in range(%(warm_calls)d):
+    call_started = time.time()
+    lambda_handler.lambda_handler(make_event(route), Context())
+    warm.append(time.time() - call_started)
+warm.sort()
+
+print(json.dumps({
+    'route': route,
+    'import_seconds': imported - started,
+    'first_call_seconds': first_call,
+    'warm_call_seconds': warm[len(warm) // 2] if warm else None,
+    'modules_loaded': len(sys.modules),
+}))
+'''
+
+
+def run_route(route, warm_calls, local, sqlite_path=None):
+    code = CHILD % {'package_dir': os.path.abspath(PACKAGE_DIR), 'benchmarks_dir': BENCHMARKS_DIR,
+                    'route': route, 'warm_calls': warm_calls, 'local': local, 'sqlite_path': sqlite_path}
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--routes', nargs='*', default=ROUTES, choices=ROUTES)
+    parser.add_argument('--repeat', type=int, default=3, help='fresh interpreters per route')
+    parser.add_argument('--warm-calls', type=int, default=5)
+    parser.add_argument('--local', action='store_true', help='use in-process DynamoDB and webhook stand-ins')
+    parser.add_argument('--storage', default='dynamodb', choices=['dynamodb', 'sqlite'],
+                        help='with sqlite every run gets a fresh database')
+    parser.add_argument('--output', help='write results as json to this file')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='gamesofni-startup-')
+    try:
+        results = run_routes(args, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def run_routes(args, directory):
+    results = []
+    for route in args.routes:
+        runs = []
+        for run in range(args.repeat):
+            sqlite_path = os.path.join(directory, '%s%d.db' % (route, run)) if args.storage == 'sqlite' else None
+            runs.append(run_route(route, args.warm_calls, args.local, sqlite_path))
+        result = {'route': route}
+        for key in ('import_seconds', 'first_call_seconds', 'warm_call_seconds', 'modules_loaded'):
+            values = [run[key] for run in runs if run[key] is not None]
+            result[key] = median(values) if values else None
+        results.append(result)
+        print('%-14s import %7.1f ms  first call %7.1f ms  warm call %7.1f ms  modules %d' % (
+            route, result['import_seconds'] * 1000, result['first_call_seconds'] * 1000,
+            (result['warm_call_seconds'] or 0) * 1000, result['modules_loaded']))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import math
+import time
+
+from metrics import metrics
+from storage import get_storage
+from cache import TtlCache
+import config
+
+# slash commands of a team draw from the team's token bucket, shared by every container through
+# the storage's rate_limits (see Storage.take_token). a team gets config.admission_rate commands
+# a second on average and up to config.admission_burst at once, admission is off while
+# admission_rate is unset
+ADMISSION_BURST = 10
+# a team whose commands ran out of dynamodb capacity waits this long before the next one,
+# doubling with every throttled command in a row
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 30
+
+
+class Admission(object):
+    # what one container knows of the buckets, kept between invocations. a team whose bucket
+    # this container saw empty is turned away without asking the storage until it has a token again
+    def __init__(self):
+        self.full_at = TtlCache(ttl_seconds=60, max_size=4096)
+        self.backoffs = TtlCache(ttl_seconds=2 * BACKOFF_MAX_SECONDS, max_size=4096)
+
+    def admit(self, team_id, now=None):
+        # returns 0 when the command may go on, otherwise the seconds to wait before trying again
+        rate = getattr(config, 'admission_rate', None)
+        if not rate or not team_id:
+            return 0
+        team_id = str(team_id)
+        now = int((now if now is not None else time.time()) * 1000)
+
+        found, backoff = self.backoffs.lookup(team_id)
+        if found and backoff[1] > now:
+            metrics.count('admission_backed_off')
+            return to_seconds(backoff[1] - now)
+
+        interval = int(1000 / float(rate))
+        tolerance = interval * int(getattr(config, 'admission_burst', ADMISSION_BURST))
+        found, full_at = self.full_at.lookup(team_id)
+        if found and full_at + interval - now > tolerance:
+            metrics.count('admission_rejected')
+            return to_seconds(full_at + interval - tolerance - now)
+
+        taken = get_storage().take_token(team_id, now, interval, tolerance, full_at if found else None)
+        if taken is None:
+            # another container emptied it, it's at least this far ahead
+            self.full_at.put(team_id, now + tolerance - interval + 1)
+            metrics.count('admission_rejected')
+            return to_seconds(interval)
+        self.full_at.put(team_id, taken)
+        return 0
+
+    def throttled(self, team_id, now=None):
+        # the team's command ran out of capacity, returns the seconds it waits from now
+        team_id = str(team_id)
+        now = int((now if now is not None else time.time()) * 1000)
+        found, backoff = self.backoffs.lookup(team_id)
+        in_a_row = backoff[0] + 1 if found else 1
+        seconds = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (in_a_row - 1))
+        self.backoffs.put(team_id, (in_a_row, now + seconds * 1000))
+        metrics.count('throttled')
+        return seconds
+
+    def succeeded(self, team_id):
+        # a command went through, the next throttle starts backing off from the beginning
+        if team_id is not None:
+            self.backoffs.invalidate(str(team_id))
+
+    def clear(self):
+        self.full_at.clear()
+        self.backoffs.clear()
+
+
+def to_seconds(milliseconds):
+    return max(1, int(math.ceil(milliseconds / 1000.0)))
+
+
+admission = Admission()
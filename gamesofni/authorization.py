@@ -1,10 +1,15 @@
 import json
 import time
 import requests
-import boto3
 
+from metrics import metrics, log_payload
+from storage import get_storage
+import cache
 import config
 
+OAUTH_SECRET_FIELDS = ('access_token', 'webhook_url')
+OAUTH_NESTED_SECRET_FIELDS = (('incoming_webhook', 'url'), ('bot', 'bot_access_token'))
+
 
 def authorize(event, logger):
     try:
@@ -26,9 +31,10 @@ def authorize(event, logger):
                        + '&client_id=' + str(config.oauth['client_id']) \
                        + '&client_secret=' + str(config.oauth['client_secret']) \
                        + '&code=' + code
-        response = requests.post(oauth_url + oauth_params)
+        with metrics.span('slack.oauth_access'):
+            response = requests.post(oauth_url + oauth_params)
         params = json.loads(response.text)
-        logger.info('Got response from slack: ' + json.dumps(params))
+        log_payload(logger, 'Got response from slack', without_secrets(params))
 
         if not params.get('ok', False):
             raise OauthException('error when exchanging code for access_token')
@@ -36,15 +42,16 @@ def authorize(event, logger):
         if access_token is not None:
             params['webhook_url'] = params.get('incoming_webhook').get('url')
 
-            table_oauth = boto3.resource('dynamodb').Table('oauth')
-            response = table_oauth.put_item(Item=params)
-            logger.info('Put access token success response from db: ' + str(response))
+            storage = get_storage()
+            response = storage.put_oauth(params)
+            log_payload(logger, 'Put access token success response from db', response)
 
-            table_settings = boto3.resource('dynamodb').Table('settings')
             settings = {'team_id': params.get('team_id'),
                         'joined': int(time.time())}
-            response = table_settings.put_item(Item=settings)
-            logger.info('Saved settings success response from db: ' + str(response))
+            response = storage.put_settings(settings)
+            log_payload(logger, 'Saved settings success response from db', response)
+            cache.settings_cache.invalidate(str(params.get('team_id')))
+            cache.webhook_cache.invalidate(str(params.get('team_id')))
 
             return {'location': 'https://kurogitsune.github.io/gamesofni/landing.html'}
 
@@ -54,5 +61,14 @@ def authorize(event, logger):
                             '?requestId=' + str(event['request_id'])}
 
 
+def without_secrets(params):
+    # the tokens and the webhook url let anyone post to the team, they're left out of logs
+    logged = dict((key, value) for key, value in params.items() if key not in OAUTH_SECRET_FIELDS)
+    for key, field in OAUTH_NESTED_SECRET_FIELDS:
+        if isinstance(logged.get(key, None), dict):
+            logged[key] = dict((name, value) for name, value in logged[key].items() if name != field)
+    return logged
+
+
 class OauthException(Exception):
     pass
@@ -0,0 +1,52 @@
+import time
+from collections import OrderedDict
+
+
+class TtlCache(object):
+    # in-process cache living across warm invocations of the same container,
+    # entries expire after ttl_seconds and least recently used ones are evicted
+    def __init__(self, ttl_seconds, max_size):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            return False, None
+        self.entries[key] = entry
+        self.hits += 1
+        return True, entry[1]
+
+    def get_or_load(self, key, load):
+        found, value = self.lookup(key)
+        if not found:
+            value = load(key)
+            self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl_seconds, value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        # a fresh start, the stats count from here on
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries)}
+
+
+# other containers only see a change once their entry expires, so settings keep a short ttl
+settings_cache = TtlCache(ttl_seconds=60, max_size=1024)
+webhook_cache = TtlCache(ttl_seconds=600, max_size=1024)
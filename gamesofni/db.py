@@ -0,0 +1,43 @@
+import boto3
+from botocore.config import Config as ClientConfig
+
+import config
+
+# adaptive retries back off and slow this container's requests down while dynamodb throttles
+# them, instead of retrying at full speed, unless config.dynamodb_retry_mode says otherwise
+RETRY_MODE = 'adaptive'
+RETRY_ATTEMPTS = 3
+
+# shared across warm invocations of the same container
+resource = None
+streams_client = None
+tables = {}
+
+
+def get_client_config():
+    return ClientConfig(retries={
+        'mode': getattr(config, 'dynamodb_retry_mode', RETRY_MODE),
+        'max_attempts': int(getattr(config, 'dynamodb_retry_attempts', RETRY_ATTEMPTS))
+    })
+
+
+def get_resource():
+    global resource
+    if resource is None:
+        resource = boto3.resource('dynamodb', config=get_client_config())
+    return resource
+
+
+def get_streams_client():
+    # reads the tables' streams, only the expiry scheduler follows one
+    global streams_client
+    if streams_client is None:
+        streams_client = boto3.client('dynamodbstreams', config=get_client_config())
+    return streams_client
+
+
+def get_table(name):
+    table = tables.get(name, None)
+    if table is None:
+        table = tables[name] = get_resource().Table(name)
+    return table
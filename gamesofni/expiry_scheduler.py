@@ -0,0 +1,158 @@
+# long-running alternative to the minute-by-minute aws.events invocation, settles every
+# game within about a second of its end:
+#     python expiry_scheduler.py
+# run it with the deployment's config.py. games are leased to whoever settles them, the
+# aws.events rule may stay on at a lower rate as a backstop for when the scheduler is down
+import heapq
+import logging
+import signal
+import threading
+import time
+
+from metrics import metrics
+from scheduled import settle_due_games
+from storage import get_storage
+import config
+
+# games ending within the horizon are kept in a min-heap. games created by /create_game
+# reach it through the storage's watch_created_games, e.g. the active_games stream, and
+# the store is queried again every reconcile_seconds for what the feed missed, like games
+# created while the scheduler restarted. without a feed the store is queried every
+# refresh_seconds instead
+HORIZON_SECONDS = 300
+RECONCILE_SECONDS = 300
+REFRESH_SECONDS = 5
+# games that failed to settle are due again this much later
+RETRY_SECONDS = 30
+
+logger = logging.getLogger()
+
+
+class ExpiryScheduler(object):
+    def __init__(self, storage, horizon_seconds=HORIZON_SECONDS, refresh_seconds=REFRESH_SECONDS,
+                 reconcile_seconds=RECONCILE_SECONDS):
+        self.storage = storage
+        self.horizon_seconds = horizon_seconds
+        self.refresh_seconds = refresh_seconds
+        self.reconcile_seconds = reconcile_seconds
+        self.heap = []  # (due, team_id, name), due is the end_date unless settling failed before
+        self.due = {}  # (team_id, name) -> due of its heap entry
+        self.loaded_until = 0  # games ending before this were read from the store
+        self.next_refresh = 0
+        self.watching = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+
+    def add_game(self, team_id, name, due):
+        # safe to call from other threads of the same process, e.g. right after a game is created
+        key = (team_id, name)
+        with self.lock:
+            if self.due.get(key, None) == due:
+                return
+            self.due[key] = due
+            heapq.heappush(self.heap, (due, team_id, name))
+        self.wakeup.set()
+
+    def add_created_game(self, team_id, name, end_date):
+        # games ending later are read with the next query of the store
+        if end_date < self.loaded_until:
+            self.add_game(team_id, name, end_date)
+
+    def get_refresh_seconds(self):
+        return self.reconcile_seconds if self.watching else self.refresh_seconds
+
+    def refresh(self, now):
+        # set first, games created while the store is read come from the feed
+        refresh_seconds = self.get_refresh_seconds()
+        self.loaded_until = int(now) + self.horizon_seconds + refresh_seconds
+        with metrics.span('scheduler.refresh'):
+            games = self.storage.get_games_ending_before(self.loaded_until)
+        for team_id, name, end_date in games:
+            self.add_game(team_id, name, end_date)
+        with self.lock:
+            # unless the feed stopped meanwhile
+            self.next_refresh = now + self.get_refresh_seconds()
+
+    def watch(self):
+        try:
+            if self.storage.watch_created_games(self.add_created_game, self.stopped):
+                return
+        except Exception as e:
+            logger.exception(e)
+        logger.info('Not following created games, querying the store every ' + str(self.refresh_seconds) + 's')
+        with self.lock:
+            self.watching = False
+            self.next_refresh = 0
+        self.wakeup.set()
+
+    def pop_due(self, now):
+        # a game is settled once end_date < now, bids are accepted until then
+        keys = []
+        with self.lock:
+            while self.heap and self.heap[0][0] < int(now):
+                due, team_id, name = heapq.heappop(self.heap)
+                # entries replaced by a later one of the same game are skipped
+                if self.due.get((team_id, name), None) == due:
+                    del self.due[(team_id, name)]
+                    keys.append((team_id, name))
+        return keys
+
+    def settle(self, keys):
+        metrics.start('scheduler', 'scheduler-' + str(int(time.time())))
+        try:
+            metrics.count('games_due', len(keys))
+            settle_due_games(self.storage, logger, keys)
+        except Exception as e:
+            # the games stay in the store until they are settled
+            logger.exception(e)
+            retry_at = int(time.time()) + RETRY_SECONDS
+            for team_id, name in keys:
+                self.add_game(team_id, name, retry_at)
+        finally:
+            metrics.emit(logger)
+
+    def next_wakeup(self):
+        with self.lock:
+            if self.heap:
+                return min(self.next_refresh, self.heap[0][0] + 1)
+        return self.next_refresh
+
+    def run(self):
+        self.watching = True
+        watcher = threading.Thread(target=self.watch)
+        watcher.daemon = True
+        watcher.start()
+        while not self.stopped.is_set():
+            now = time.time()
+            if now >= self.next_refresh:
+                self.refresh(now)
+            keys = self.pop_due(now)
+            if keys:
+                self.settle(keys)
+                continue
+            self.wakeup.wait(max(0, self.next_wakeup() - time.time()))
+            self.wakeup.clear()
+        watcher.join()
+
+    def stop(self, *args):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    logger.setLevel(logging.INFO)
+    scheduler = ExpiryScheduler(get_storage(),
+                                getattr(config, 'scheduler_horizon_seconds', HORIZON_SECONDS),
+                                getattr(config, 'scheduler_refresh_seconds', REFRESH_SECONDS),
+                                getattr(config, 'scheduler_reconcile_seconds', RECONCILE_SECONDS))
+    signal.signal(signal.SIGTERM, scheduler.stop)
+    signal.signal(signal.SIGINT, scheduler.stop)
+    logger.info('Expiry scheduler started')
+    scheduler.run()
+    logger.info('Expiry scheduler stopped')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,55 +1,71 @@
-import json
 import time
 import re
+import json
 import logging
 
-import boto3
-from boto3.dynamodb.conditions import Key
-
 from vcg.game import Game
 from vcg.utils import VcgException
+from vcg import utils
 from vcg.bid import Bid
-from authorization import authorize
-from scheduled import scheduled_invocation
+from vcg.render import MRKDWN
+from metrics import metrics, log_payload, scrub_event, record_event
+from storage import get_storage, ConditionFailedException
+from admission import admission
+import cache
 import config
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+IANA_ZONE_REGEX = re.compile(r'^[A-Za-z_]+(/[A-Za-z0-9_+-]+)+$')  # e.g. Europe/Berlin, America/Argentina/Salta
+
 
 def lambda_handler(event, context):
+    metrics.start(get_route(event), context.aws_request_id)
     try:
-        logger.info('Received event:\n' + json.dumps(event))
+        return handle_event(event, context)
+    finally:
+        metrics.emit(logger)
+
+
+def get_route(event):
+    return event.get('resource', None) or event.get('command', None) or event.get('source', None)
+
+
+def handle_event(event, context):
+    try:
+        log_payload(logger, 'Received event', scrub_event(event))
+        record_event(event)
         event['request_id'] = context.aws_request_id
         resource = event.get('resource', None)
 
         if resource == '/oauth':
+            from authorization import authorize
             return authorize(event, logger)
 
         source = event.get('source', None)
         if source == 'aws.events':
             if str(config.aws_account) != str(event.get('account')):
                 return
+            from scheduled import scheduled_invocation
             return scheduled_invocation(logger)
 
         if event.get('token', None) != str(config.slack_token):
             return
 
-        if resource == '/info':
-            return get_current_games(event)
-
-        command = event.get('command', None)
+        # a team over its rate is told so right away, before any of its reads and writes
+        wait_seconds = admission.admit(event.get('team_id', None))
+        if wait_seconds:
+            return try_again(wait_seconds)
 
-        if command == '/bid':
-            return user_bid_invocation(event)
-
-        if command == '/create_game':
-            return user_create_game(event)
-
-        if command == '/set_timezone':
-            return set_time_zone(event)
+        response = handle_command(event)
+        admission.succeeded(event.get('team_id', None))
+        return response
 
     except Exception as e:
+        if event.get('team_id', None) is not None and get_storage().is_throttled(e):
+            logger.info('Throttled team ' + str(event.get('team_id')) + ': ' + str(e))
+            return try_again(admission.throttled(event.get('team_id')))
         logger.exception(e.message)
         return {
             'response_type': 'ephemeral',
@@ -60,46 +76,61 @@ def lambda_handler(event, context):
         }
 
 
+def handle_command(event):
+    if event.get('resource', None) == '/info':
+        return get_current_games(event)
+
+    command = event.get('command', None)
+
+    if command == '/bid':
+        return user_bid_invocation(event)
+
+    if command == '/create_game':
+        return user_create_game(event)
+
+    if command == '/set_timezone':
+        return set_time_zone(event)
+
+
+def try_again(seconds):
+    return {
+        'response_type': 'ephemeral',
+        'text': 'Your team is sending more commands than we can take right now, '
+                'please try again in ' + str(seconds) + (' seconds.' if seconds != 1 else ' second.')
+    }
+
+
 def set_time_zone(event):
-    timezone = event.get('text', None)
-    regex = '^utc([+-]\d\d?|0|$)$'  # accepts e.g. utc+3, utc-10, utc, utc0
+    timezone = (event.get('text', None) or '').strip()
+    regex = '^utc([+-]\d\d?(:\d\d)?|0|$)$'  # accepts e.g. utc+3, utc-10, utc+5:30, utc, utc0
     match = re.search(regex, timezone, re.I)
+    tz = (match.group(1) or '0') if match else timezone
 
-    if not match:
+    try:
+        if not match and not IANA_ZONE_REGEX.match(timezone):
+            raise VcgException('It seems you input timezone is in the wrong format.')
+        timezone_info = utils.get_timezone_info(tz)
+    except VcgException as e:
         return {
             'response_type': 'ephemeral',
-            'text': 'It seems you input timezone is in the wrong format. '
-                    '\nCorrect examples: utc+3 or utc-6 or utc+0' + command_info(event)
+            'text': str(e) +
+                    '\nCorrect examples: utc+3 or utc-6 or utc+5:30 or Europe/Berlin' + command_info(event)
         }
-    tz = match.group(1) if len(match.group(1)) > 0 else 0
-
-    table_settings = boto3.resource('dynamodb').Table('settings')
-    response = table_settings.update_item(
-        Key={'team_id': event.get('team_id')},
-        UpdateExpression='SET utc_offset = :offset, team_domain = :team_domain',
-        ExpressionAttributeValues={
-            ':offset': tz,
-            ':team_domain': event.get('team_domain'),
-        },
-        ReturnValues='UPDATED_NEW'
-    )
-
-    logger.info('Set timezone success response from db: ' + str(response))
+
+    response = get_storage().set_timezone(event.get('team_id'), tz, event.get('team_domain'))
+    log_payload(logger, 'Set timezone success response from db', response)
+    cache.settings_cache.invalidate(str(event.get('team_id')))
     return {
         'response_type': 'in_channel',
-        'text': 'You successfully set timezone as utc ' + str(tz) +
+        'text': 'You successfully set timezone as ' + timezone_info +
                 '\nYou can now create new games with /create_game command'
     }
 
 
 def get_current_games(event):
-    table_games = boto3.resource('dynamodb').Table('active_games')
-    response = table_games.query(
-        KeyConditionExpression=
-        Key('team_id').eq(str(event.get('team_id')))
-    )
-    db_games = response['Items']
-    logger.info('got success response from db: ' + str(db_games))
+    # the team's summary, names, dates and options of its games without their bids
+    db_games = get_storage().get_team_summary(event.get('team_id'))
+    log_payload(logger, 'got success response from db', db_games)
 
     if len(db_games) == 0:
         return {
@@ -107,45 +138,47 @@ def get_current_games(event):
             'text': 'There are no active games at this moment'
         }
 
-    message = Game.get_active_games_info(db_games)
-    return {
-        'response_type': 'ephemeral',
-        'text': message
-    }
+    command = event.get('command', None) or '/info'
+    with metrics.span('render.active_games'):
+        payload = Game.get_active_games_info(db_games, get_page_number(event),
+                                             getattr(config, 'message_format', MRKDWN),
+                                             lambda page: '_type ' + command + ' ' + str(page) + ' for more games_')
+    metrics.count('response_bytes', len(json.dumps(payload)))
+    return dict(payload, response_type='ephemeral')
+
+
+def get_page_number(event):
+    text = (event.get('text', None) or '').strip()
+    return int(text) if text.isdigit() and int(text) > 0 else 1
 
 
 def user_create_game(event):
     try:
-        table_settings = boto3.resource('dynamodb').Table('settings')
-        response = table_settings.query(
-            KeyConditionExpression=
-            Key('team_id').eq(str(event.get('team_id')))
-        )
-        db_settings = response['Items']
-        logger.info('got success response from db: ' + str(db_settings))
-
-        if len(db_settings) == 0:
+        db_settings = get_team_settings(event.get('team_id'))
+        if db_settings is None:
             raise VcgException('It seems there was an error during authorisation process. '
                                '\nPlease, authorise this application again by clicking on '
                                'add to slack button on our website.')
 
-        utc_offset_setting = db_settings[0].get('utc_offset', None)
-        if not utc_offset_setting:
+        utc_offset_setting = db_settings.get('utc_offset', None)
+        if utc_offset_setting is None:
             raise VcgException('It seems you haven\'t set up timezone setting yet. '
                                'Please, do so with /set_timezone command.')
 
-        game = Game.parse_from_command(event.get('text'), event.get('user_name'), event.get('team_id'), utc_offset_setting)
+        with metrics.span('parse.command'):
+            game = Game.parse_from_command(event.get('text'), event.get('user_name'), event.get('team_id'),
+                                           utc_offset_setting)
         db_games = get_active_game(event, game.name)
 
         if len(db_games) != 0:
-            raise VcgException('game with this name is already active '
-                               '\n' + Game.get_active_db_games_info(db_games))
-
-        table_games = boto3.resource('dynamodb').Table('active_games')
-        json_game = game.to_json_encoded()
-        json_game['index'] = 1  # TODO: test whether this hack is faster than scan
-        response = table_games.put_item(Item=json_game)
-        logger.info('Save created gave success response from db: ' + str(response))
+            raise already_active(db_games)
+
+        try:
+            response = get_storage().create_game(game.to_json_encoded())
+        except ConditionFailedException:
+            # created since it was checked for, or missed by the stale read
+            raise already_active(get_active_game(event, game.name, consistent=True))
+        log_payload(logger, 'Save created game success response from db', response)
         response = '*' + event.get('user_name') + '* created new game! \n' + \
                    game.get_short_info() + \
                    '\n_(type /bid to participate)_'
@@ -161,39 +194,23 @@ def user_create_game(event):
         }
 
 
+def already_active(db_games):
+    return VcgException('game with this name is already active '
+                        '\n' + Game.get_active_db_games_info(db_games))
+
+
 def user_bid_invocation(event):
     try:
-        bid = Bid.parse_from_command(event.get('text'), event.get('user_name'))
-
-        table_games = boto3.resource('dynamodb').Table('active_games')
-        db_games = get_active_game(event, bid.game_name)
-        if len(db_games) == 0:
-            raise VcgException('There is no game with the name you specified')
-
-        game = Game.parse_game(db_games[0])
-        if game.end_date < int(time.time()):
-            raise VcgException('This game has ended, you can\'t bid in it, sorry.')
-
-        if bid.option:
-            if not game.options or (bid.option not in game.options):
-                raise VcgException('There is no such option in this game you tried to bid for, ' + game.get_options_info())
-
-        else:
-            if game.options:
-                raise VcgException('We did not receive which option '
-                                   'you would like to bid for in this game, ' + game.get_options_info())
-
-        response = table_games.update_item(
-            Key={
-                'team_id': event.get('team_id'),
-                'name': bid.game_name
-            },
-            UpdateExpression='SET bids.' + bid.user + '= :item',
-            ExpressionAttributeValues={
-                ':item': bid.to_json_encoded(),
-            },
-            ReturnValues='UPDATED_NEW'
-        )
+        with metrics.span('parse.command'):
+            bids = Bid.parse_batch_from_command(event.get('text'), event.get('user_name'))
+        if len(bids) > 1:
+            return user_batch_bid(event, bids)
+
+        bid = bids[0]
+        try:
+            get_storage().put_bid(event.get('team_id'), bid, int(time.time()))
+        except ConditionFailedException:
+            explain_rejected_bid(event, bid)
 
         return {
             'response_type': 'ephemeral',
@@ -207,15 +224,67 @@ def user_bid_invocation(event):
         }
 
 
-def get_active_game(event, game_name):
-    table_games = boto3.resource('dynamodb').Table('active_games')
-    response = table_games.query(
-        KeyConditionExpression=
-        Key('team_id').eq(str(event.get('team_id'))) &
-        Key('name').eq(game_name)
-    )
-    db_games = response['Items']
-    logger.info('Read active games successfully from db: ' + str(db_games))
+def user_batch_bid(event, bids):
+    # every bid succeeds or fails on its own, the response tells how each went
+    metrics.count('batch_bids', len(bids))
+    results = get_storage().put_bids(event.get('team_id'), bids, int(time.time()))
+
+    lines = []
+    for bid, rejected in zip(bids, results):
+        if rejected is None:
+            lines.append('Ok, ' + bid.get_bid_response_info())
+            continue
+        try:
+            explain_rejected_bid(event, bid)
+        except VcgException as e:
+            lines.append('Something went wrong with your bid in game *' + bid.game_name + '*: ' + str(e))
+    return {
+        'response_type': 'ephemeral',
+        'text': '\n'.join(lines)
+    }
+
+
+def explain_rejected_bid(event, bid):
+    # only runs when the conditional write failed, to tell which check it was
+    db_games = get_active_game(event, bid.game_name)
+    if len(db_games) == 0:
+        raise VcgException('There is no game with the name you specified')
+
+    game = Game.parse_game(db_games[0])
+    if game.end_date <= int(time.time()):
+        raise VcgException('This game has ended, you can\'t bid in it, sorry.')
+
+    bid_options = bid.get_options()
+    if bid_options:
+        if not game.options or any(option not in game.options for option in bid_options):
+            raise VcgException('There is no such option in this game you tried to bid for, ' + game.get_options_info())
+
+    else:
+        if game.options:
+            raise VcgException('We did not receive which option '
+                               'you would like to bid for in this game, ' + game.get_options_info())
+
+    raise VcgException('the game changed while you were bidding, please try again')
+
+
+def get_team_settings(team_id):
+    return cache.settings_cache.get_or_load(str(team_id), load_team_settings)
+
+
+def load_team_settings(team_id):
+    db_settings = get_storage().get_settings(team_id)
+    log_payload(logger, 'got success response from db', db_settings)
+    return db_settings
+
+
+def get_active_game(event, game_name, consistent=False):
+    # the game's name, dates and options, without its bids map and aggregates. eventually
+    # consistent at half the read capacity by default: create_game itself turns down a name
+    # that's still active, a stale miss only costs the write, and a bid explained from a stale
+    # read ends in 'please try again'
+    db_game = get_storage().get_game_info(event.get('team_id'), game_name, consistent=consistent)
+    db_games = [db_game] if db_game is not None else []
+    log_payload(logger, 'Read active games successfully from db', db_games)
     return db_games
 
 
@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# share of invocations that log full payloads (events, db items) at info level
+PAYLOAD_LOG_SAMPLE_RATE = float(os.environ.get('PAYLOAD_LOG_SAMPLE_RATE', 0))
+# when set, every received event is appended to this file as a json line, benchmarks/replay.py
+# replays such recordings, as well as 'Received event' lines of payload logs
+EVENT_RECORD_PATH = os.environ.get('EVENT_RECORD_PATH', None)
+# secrets and one-off urls never leave the handler
+SCRUBBED_FIELDS = ('token', 'response_url')
+
+record_lock = threading.Lock()
+
+
+class InvocationMetrics(object):
+    # durations and counters of a single invocation, emitted as one json record
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start()
+
+    def start(self, route=None, request_id=None):
+        self.route = route
+        self.request_id = request_id
+        self.started = time.time()
+        self.spans = {}
+        self.counters = {}
+        self.log_payloads = random.random() < PAYLOAD_LOG_SAMPLE_RATE
+
+    @contextmanager
+    def span(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                span = self.spans.setdefault(name, [0, 0.0])
+                span[0] += 1
+                span[1] += elapsed
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self):
+        return {
+            'metrics': 'invocation',
+            'route': self.route,
+            'request_id': self.request_id,
+            'duration_ms': round((time.time() - self.started) * 1000, 3),
+            'spans': {name: {'count': count, 'ms': round(seconds * 1000, 3)}
+                      for name, (count, seconds) in self.spans.items()},
+            'counts': self.counters,
+        }
+
+    def emit(self, logger):
+        logger.info(json.dumps(self.record(), sort_keys=True))
+
+
+metrics = InvocationMetrics()
+
+
+def log_payload(logger, message, payload):
+    # payloads are only serialized when sampled or when debug logging is on
+    level = logging.INFO if metrics.log_payloads else logging.DEBUG
+    if logger.isEnabledFor(level):
+        logger.log(level, message + ': ' + json.dumps(payload, default=str, sort_keys=True))
+
+
+def scrub_event(event):
+    scrubbed = dict(event, **{field: '<scrubbed>' for field in SCRUBBED_FIELDS if field in event})
+    if isinstance(event.get('query', None), dict) and 'code' in event['query']:
+        # oauth redirects carry a one-time code
+        scrubbed['query'] = dict(event['query'], code='<scrubbed>')
+    return scrubbed
+
+
+def record_event(event):
+    if not EVENT_RECORD_PATH:
+        return
+    line = json.dumps(dict(scrub_event(event), recorded=round(time.time(), 3)), default=str, sort_keys=True)
+    with record_lock:
+        with open(EVENT_RECORD_PATH, 'a') as f:
+            f.write(line + '\n')
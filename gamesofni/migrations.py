@@ -0,0 +1,33 @@
+# one-off data migrations, run from this directory with the deployment's config.py:
+#     python migrations.py reshard [--shards N]
+#     python migrations.py summaries
+import argparse
+
+from storage.dynamodb import DynamoDbStorage, get_expiry_shards
+
+
+def reshard(args):
+    shards = args.shards or get_expiry_shards()
+    moved = DynamoDbStorage().reshard_games(shards)
+    print('Moved ' + str(moved) + ' active games into ' + str(shards) + ' expiry shards')
+
+
+def summaries(args):
+    teams = DynamoDbStorage().rebuild_team_summaries()
+    print('Rebuilt the active games summaries of ' + str(teams) + ' teams')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='data migrations for the dynamodb tables')
+    commands = parser.add_subparsers()
+    reshard_parser = commands.add_parser('reshard', help='spread active games over the end_date-index shards')
+    reshard_parser.add_argument('--shards', type=int, help='shard count to move to, defaults to config.expiry_shards')
+    reshard_parser.set_defaults(run=reshard)
+    summaries_parser = commands.add_parser('summaries', help='regenerate every team\'s active games summary')
+    summaries_parser.set_defaults(run=summaries)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
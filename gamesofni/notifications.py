@@ -0,0 +1,98 @@
+import json
+import random
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import metrics
+
+NOTIFY_CONCURRENCY = 16
+NOTIFY_ATTEMPTS = 3
+NOTIFY_TIMEOUT_SECONDS = (3.05, 5)  # (connect, read)
+BACKOFF_BASE_SECONDS = 0.2
+BACKOFF_MAX_SECONDS = 2
+
+session = None
+pool = None
+
+
+def get_session():
+    # one keep-alive session per container, reused across warm invocations
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=NOTIFY_CONCURRENCY)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+
+def get_pool():
+    # worker threads are kept between invocations, shutting a pool down
+    # waits on its handler thread which polls every 100ms
+    global pool
+    if pool is None:
+        pool = ThreadPool(NOTIFY_CONCURRENCY)
+    return pool
+
+
+def notify_teams(team_messages, team2url, logger):
+    # posts every team's messages concurrently, one team's messages in order,
+    # returns set of teams that were notified
+    deliveries = []
+    for team, payloads in team_messages.items():
+        url = team2url.get(team, None)
+        if url is None:
+            logger.error('No webhook url for team ' + str(team) + ', skipping notification')
+            continue
+        deliveries.append((team, url, payloads))
+
+    if not deliveries:
+        return set()
+
+    results = get_pool().map(lambda delivery: notify_team(delivery[0], delivery[1], delivery[2], logger),
+                             deliveries)
+
+    return set(team for (team, url, payloads), delivered in zip(deliveries, results) if delivered)
+
+
+def notify_team(team, url, payloads, logger):
+    # later messages aren't posted once one fails, they'd arrive out of order
+    return all(post_message(team, url, payload, logger) for payload in payloads)
+
+
+def post_message(team, url, payload, logger):
+    body = json.dumps(payload)
+    metrics.count('webhook_payload_bytes', len(body))
+    for attempt in range(NOTIFY_ATTEMPTS):
+        retry_after = None
+        try:
+            with metrics.span('webhook.post'):
+                response = get_session().post(url, data=body, timeout=NOTIFY_TIMEOUT_SECONDS)
+            if response.status_code < 400:
+                return True
+            if response.status_code != 429 and response.status_code < 500:
+                logger.error('Webhook for team ' + str(team) + ' rejected message: ' +
+                             str(response.status_code) + ' ' + response.text)
+                return False
+            retry_after = response.headers.get('Retry-After', None)
+            logger.info('Webhook for team ' + str(team) + ' responded ' + str(response.status_code))
+        except requests.RequestException as e:
+            logger.info('Webhook for team ' + str(team) + ' failed: ' + str(e))
+
+        if attempt + 1 < NOTIFY_ATTEMPTS:
+            time.sleep(get_backoff(attempt, retry_after))
+
+    logger.error('Giving up notifying team ' + str(team) + ' after ' + str(NOTIFY_ATTEMPTS) + ' attempts')
+    return False
+
+
+def get_backoff(attempt, retry_after):
+    try:
+        if retry_after is not None:
+            return min(BACKOFF_MAX_SECONDS, float(retry_after))
+    except ValueError:
+        pass
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
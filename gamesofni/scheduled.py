@@ -1,87 +1,173 @@
-import json
-import requests
 import time
-
-import boto3
-from boto3.dynamodb.conditions import Key
+import uuid
+from multiprocessing.pool import ThreadPool
 
 from vcg.game import Game
 from vcg.completed_game import CompletedGame
+from vcg.render import MRKDWN
+from notifications import notify_teams
+from metrics import metrics, log_payload
+from storage import get_storage
+import cache
+import config
 
+SETTLE_CONCURRENCY = 8
+# games are leased to one scheduler at a time, for longer than an invocation can run
+# unless config.settle_lease_seconds says otherwise
+SETTLE_LEASE_SECONDS = 900
 
-def scheduled_invocation(logger):
-    db_games = get_completed_games()
+pool = None
 
-    if len(db_games) == 0:
-        logger.info('Got 0 finished games from db')
-        return
 
-    games = [Game.parse_game(db_game) for db_game in db_games]
-    completed_games = CompletedGame.get_completed_games(games)
+def get_pool():
+    # kept between invocations, see notifications.get_pool
+    global pool
+    if pool is None:
+        pool = ThreadPool(SETTLE_CONCURRENCY)
+    return pool
+
+
+def scheduled_invocation(logger):
+    settle_completed_games(get_storage(), logger)
 
-    completed_game_items = [game.to_json_encoded() for game in completed_games]
-    logger.info('Got completed games from db: ' + str(completed_games))
 
-    insert_request_items = wrap_dynamo_batch_insert(completed_game_items, 'completed_games')
-    dynamodb = boto3.resource('dynamodb')
+def settle_completed_games(storage, logger):
+    # several of these may run at once, each settles the games it managed to lease
+    started = time.time()
+    owner = uuid.uuid4().hex
+    settled = 0
+    for db_games in storage.get_completed_games(int(started)):
+        if db_games:
+            settled += settle_games(db_games, storage, logger, owner)
 
-    response = dynamodb.batch_write_item(RequestItems=insert_request_items)
-    logger.info('Archiving completed games success response from db: ' + str(response))
+    if settled == 0:
+        logger.info('Got 0 finished games from db')
+        return 0
+    log_settled(logger, settled, started)
+    return settled
+
+
+def settle_due_games(storage, logger, keys):
+    # the (team_id, name) games are known to have ended, e.g. by the expiry scheduler, they're
+    # leased and read by key instead of reading the whole expiry index
+    started = time.time()
+    now = int(started)
+    with metrics.span('claim'):
+        claimed = storage.claim_games(keys, uuid.uuid4().hex, now, now + get_lease_seconds())
+    metrics.count('games_claimed', len(claimed))
+    if not claimed:
+        logger.info('Other schedulers hold or settled all ' + str(len(keys)) + ' due games')
+        return 0
+
+    with metrics.span('read.games'):
+        db_games = storage.get_games(list(claimed))
+    metrics.count('games_read', len(db_games))
+    settled = settle_claimed_games(db_games, claimed, storage, logger)
+    log_settled(logger, settled, started)
+    return settled
+
+
+def log_settled(logger, settled, started):
+    elapsed = max(time.time() - started, 1e-6)
+    logger.info('Settled ' + str(settled) + ' games in ' + '%.3f' % elapsed +
+                's (' + '%.1f' % (settled / elapsed) + ' games/sec)')
+
+
+def settle_games(db_games, storage, logger, owner):
+    now = int(time.time())
+    with metrics.span('claim'):
+        claimed = storage.claim_games([(db_game['team_id'], db_game['name']) for db_game in db_games],
+                                      owner, now, now + get_lease_seconds())
+    metrics.count('games_read', len(db_games))
+    metrics.count('games_claimed', len(claimed))
+    if not claimed:
+        logger.info('Other schedulers hold all ' + str(len(db_games)) + ' completed games of this page')
+        return 0
+    return settle_claimed_games([db_game for db_game in db_games if (db_game['team_id'], db_game['name']) in claimed],
+                                claimed, storage, logger)
+
+
+def settle_claimed_games(db_games, claimed, storage, logger):
+    # claimed is what claim_games returned for the games
+    with metrics.span('parse.games'):
+        games = [Game.parse_game(db_game, storage.get_game_bids) for db_game in db_games]
+
+    # a game leased before was left by a scheduler that stopped part way, if it got as far
+    # as archiving the game that outcome stands, the bids may be partly deleted since
+    retried = [CompletedGame.get_id(game) for game in games if claimed[(game.team, game.name)]]
+    archived = storage.get_archived_games(retried) if retried else {}
+    unsettled = [game for game in games if CompletedGame.get_id(game) not in archived]
+    metrics.count('bids_settled', sum(game.get_bids_count() for game in unsettled))
+
+    with metrics.span('settle'):
+        if any(game.bid_stream is not None for game in unsettled):
+            # games whose bids are items of their own read them while settling, concurrently
+            settled_games = get_pool().map(CompletedGame.finalize_game, unsettled)
+        else:
+            settled_games = CompletedGame.get_completed_games(unsettled)
+
+    settled_game_items = [game.to_json_encoded() for game in settled_games]
+    log_payload(logger, 'Got completed games from db', settled_game_items)
+
+    storage.archive_games(settled_game_items)
+    logger.info('Archived ' + str(len(settled_game_items)) + ' completed games')
+
+    completed_games = settled_games + \
+        [CompletedGame.parse_completed_game(game, archived[CompletedGame.get_id(game)]) for game in games
+         if CompletedGame.get_id(game) in archived]
+    unnotified_games = [completed_game for completed_game in completed_games
+                        if not archived.get(CompletedGame.get_id(completed_game.game), {}).get('notified', False)]
 
     completed_games_by_team = {}
-    for game in completed_games:
+    for game in unnotified_games:
         team_games = completed_games_by_team.get(game.game.team, [])
         team_games.append(game)
         completed_games_by_team[game.game.team] = team_games
 
     team_names = completed_games_by_team.keys()
 
-    team2url = get_access_codes(team_names, dynamodb, logger)
+    team2url = get_access_codes(team_names, storage, logger)
 
-    for team in team_names:
-        games_info = CompletedGame.get_completed_games_info(completed_games_by_team[team])
-        requests.post(team2url[team], data=json.dumps({'text': games_info}))
-
-    delete_request_items = wrap_dynamo_batch_delete(completed_games_by_team, 'active_games')
-    response = dynamodb.batch_write_item(RequestItems=delete_request_items)
-    logger.info('Deleted completed games from active_games table successfully: ' + str(response))
-
-
-def get_access_codes(team_names, dynamodb, logger):
-    response = dynamodb.meta.client.batch_get_item(RequestItems={
-        'oauth': {
-            'Keys': [{'team_id': team} for team in team_names],
-            'ProjectionExpression': 'team_id, webhook_url'
-        }
-    })
-    team2url = response['Responses']['oauth']
-    team2url = {team_info['team_id']: team_info['webhook_url'] for team_info in team2url}
-    logger.info('Got response from db team-url oauth: ' + str(team2url))
-    logger.info('UnprocessedKeys for team-url oauth: ' + str(response['UnprocessedKeys']))
-    return team2url
+    with metrics.span('render.completed_games'):
+        message_format = getattr(config, 'message_format', MRKDWN)
+        team_messages = {team: CompletedGame.get_completed_games_messages(completed_games_by_team[team],
+                                                                          message_format)
+                         for team in team_names}
+    with metrics.span('notify'):
+        notified = notify_teams(team_messages, team2url, logger)
+    logger.info('Notified ' + str(len(notified)) + ' of ' + str(len(team_messages)) + ' teams')
+    storage.mark_notified([dict(game.to_json_encoded(), notified=True) for game in unnotified_games
+                           if game.game.team in notified])
 
+    storage.delete_games([(game.game.team, game.game.name) for game in completed_games])
+    metrics.count('games_settled', len(completed_games))
+    logger.info('Deleted ' + str(len(completed_games)) + ' completed games from active_games table')
+    return len(completed_games)
 
-def get_completed_games():
-    table_games = boto3.resource('dynamodb').Table('active_games')
-    now = int(time.time())
-    response = table_games.query(
-        IndexName='end_date-index',
-        KeyConditionExpression=Key('index').eq(1) & Key('end_date').lt(now)
-    )
-    db_games = response['Items']
-    return db_games
-
-
-def wrap_dynamo_batch_insert(items, table_name):
-    items_array = []
-    for item in items:
-        items_array.append({'PutRequest': {'Item': item}})
-    return {table_name: items_array}
-
-
-def wrap_dynamo_batch_delete(completed_games_by_team, table_name):
-    items_array = []
-    for team, completed_games in completed_games_by_team.items():
-        for completed_game in completed_games:
-            items_array.append({'DeleteRequest': {'Key': {'team_id': team, 'name': completed_game.game.name}}})
-    return {table_name: items_array}
+
+def get_lease_seconds():
+    return int(getattr(config, 'settle_lease_seconds', SETTLE_LEASE_SECONDS))
+
+
+def get_access_codes(team_names, storage, logger):
+    team2url = {}
+    missing_teams = []
+    for team in team_names:
+        found, url = cache.webhook_cache.lookup(str(team))
+        if not found:
+            missing_teams.append(team)
+        elif url is not None:
+            team2url[team] = url
+
+    if missing_teams:
+        loaded = storage.get_webhook_urls(missing_teams)
+        log_payload(logger, 'Got response from db team-url oauth', loaded)
+        for team, url in loaded.items():
+            cache.webhook_cache.put(str(team), url)
+            if url is not None:
+                team2url[team] = url
+
+    # this call's lookups only, the cache's own stats run for the container's lifetime
+    metrics.count('webhook_cache_hits', len(team_names) - len(missing_teams))
+    metrics.count('webhook_cache_misses', len(missing_teams))
+    return team2url
@@ -0,0 +1,23 @@
+import config
+
+from .base import Storage, StorageException, ConditionFailedException  # noqa: F401
+
+# shared across warm invocations of the same container
+storage = None
+
+
+def get_storage():
+    # config.storage picks the backend, backends are imported lazily so that
+    # a dynamodb deployment never loads sqlite3 and a sqlite one never loads boto3
+    global storage
+    if storage is None:
+        backend = getattr(config, 'storage', 'dynamodb')
+        if backend == 'dynamodb':
+            from .dynamodb import DynamoDbStorage
+            storage = DynamoDbStorage()
+        elif backend == 'sqlite':
+            from .sqlite import SqliteStorage
+            storage = SqliteStorage(getattr(config, 'sqlite_path', 'gamesofni.db'))
+        else:
+            raise StorageException('unknown storage backend: ' + str(backend))
+    return storage
@@ -0,0 +1,149 @@
+class Storage(object):
+    # everything the handlers and the scheduler read or write, items are plain dicts
+    # shaped like the dynamodb items. games keep their bids as items of their own, read
+    # with get_game_bids, only games stored before that carry a {user: encoded bid} map
+
+    def get_team_games(self, team_id):
+        raise NotImplementedError
+
+    def get_team_summary(self, team_id):
+        # the team's active games with only what listing them takes, see to_summary_entry,
+        # sorted by name. backends without a stored summary read the games themselves
+        return sorted((to_summary_entry(item) for item in self.get_team_games(team_id)),
+                      key=lambda entry: entry['name'])
+
+    def get_game(self, team_id, name, consistent=True):
+        # returns the whole game item or None. eventually consistent reads, where the
+        # backend has them, may miss changes of the last second
+        raise NotImplementedError
+
+    def get_games(self, keys):
+        # returns the whole items of the (team_id, name) games that still exist, read consistently
+        games = (self.get_game(team_id, name) for team_id, name in keys)
+        return [game for game in games if game is not None]
+
+    def get_game_info(self, team_id, name, consistent=True):
+        # returns only the game's SUMMARY_FIELDS or None, what describing the game or
+        # checking a bid against it takes, without its bids and aggregates
+        item = self.get_game(team_id, name, consistent)
+        return to_summary_entry(item) if item is not None else None
+
+    def create_game(self, item):
+        # bids in the item, if any, are stored as items of their own
+        raise NotImplementedError
+
+    def get_game_bids(self, team_id, name):
+        # yields the encoded bids of a game without a bids map, read page by page
+        raise NotImplementedError
+
+    def put_bid(self, team_id, bid, now):
+        # stores the bid only if the game exists, ends after now and offers the bid's options,
+        # raises ConditionFailedException otherwise
+        raise NotImplementedError
+
+    def put_bids(self, team_id, bids, now):
+        # stores each bid like put_bid, bids are in different games and succeed or fail on their own.
+        # returns a list matching bids, None for a stored bid and the ConditionFailedException otherwise
+        return [self.try_put_bid(team_id, bid, now) for bid in bids]
+
+    def try_put_bid(self, team_id, bid, now):
+        try:
+            self.put_bid(team_id, bid, now)
+        except ConditionFailedException as e:
+            return e
+
+    def get_completed_games(self, now):
+        # yields pages of games that ended before now
+        raise NotImplementedError
+
+    def get_games_ending_before(self, end_date):
+        # returns (team_id, name, end_date) of every active game ending before end_date
+        raise NotImplementedError
+
+    def watch_created_games(self, add_game, stopped):
+        # calls add_game(team_id, name, end_date) for every game created from now on until the
+        # stopped event is set. backends that can't follow creations return False right away,
+        # their games are only found with get_games_ending_before
+        return False
+
+    def claim_games(self, keys, owner, now, until):
+        # leases the (team_id, name) games to owner until the given time, skipping games another
+        # owner holds an unexpired lease on. returns {key: True when the game had been leased
+        # before} for the games claimed
+        raise NotImplementedError
+
+    def get_archived_games(self, ids):
+        # returns {id: item} of the archived games among ids, items have at least
+        # the OUTCOME_FIELDS
+        raise NotImplementedError
+
+    def archive_games(self, items):
+        # bids of items without a bids map are archived under the item's id as well.
+        # archiving a game again replaces it
+        raise NotImplementedError
+
+    def mark_notified(self, items):
+        # archives the items again, once their teams were told, without touching their bids
+        raise NotImplementedError
+
+    def delete_games(self, keys):
+        # keys are (team_id, name) pairs, the games' bids are deleted first
+        raise NotImplementedError
+
+    def get_settings(self, team_id):
+        # returns the settings item or None
+        raise NotImplementedError
+
+    def put_settings(self, item):
+        raise NotImplementedError
+
+    def set_timezone(self, team_id, utc_offset, team_domain):
+        # returns the updated attributes
+        raise NotImplementedError
+
+    def put_oauth(self, item):
+        raise NotImplementedError
+
+    def get_webhook_urls(self, team_ids):
+        # returns {team_id: url or None when the team has none},
+        # teams that could not be read this time are left out
+        raise NotImplementedError
+
+    def take_token(self, team_id, now, interval, tolerance, full_at=None):
+        # takes a token from the team's bucket in rate_limits, kept as the time it's full again:
+        # every token taken moves that on by interval and it may run at most tolerance ahead of
+        # now. times are in milliseconds, full_at is the last one the caller saw and only picks
+        # the write to try first. returns the new time the bucket is full at, None when it's empty
+        raise NotImplementedError
+
+    def is_throttled(self, error):
+        # whether error means the backend was out of capacity, even after retrying
+        return False
+
+
+class StorageException(Exception):
+    pass
+
+
+class ConditionFailedException(StorageException):
+    pass
+
+
+SUMMARY_FIELDS = ('team_id', 'name', 'creator', 'start_date', 'end_date', 'utc_offset', 'options', 'units')
+# what CompletedGame.parse_completed_game restores a settled game from
+OUTCOME_FIELDS = ('id', 'option', 'winner', 'amount', 'message', 'winners', 'notified')
+
+
+def to_summary_entry(item):
+    # a game item without its bids, aggregates and bookkeeping, Game.parse_game reads it
+    return dict((field, item[field]) for field in SUMMARY_FIELDS if field in item)
+
+
+def bid_fits_game(bid, end_date, options, now):
+    # the checks every backend applies before storing a bid
+    if end_date <= now:
+        return False
+    bid_options = bid.get_options()
+    if bid_options:
+        return bool(options) and all(option in options for option in bid_options)
+    return not options
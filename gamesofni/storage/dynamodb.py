@@ -0,0 +1,918 @@
+import heapq
+import json
+import logging
+import random
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+from vcg.bid import Bid
+from vcg.codec import decode_bid, decode_options
+from vcg.stats import GameStats
+from metrics import metrics
+import config
+import db
+from .base import Storage, StorageException, ConditionFailedException, bid_fits_game, to_summary_entry, \
+    SUMMARY_FIELDS, OUTCOME_FIELDS
+
+BATCH_WRITE_LIMIT = 25  # dynamodb batch_write_item accepts at most 25 requests
+BATCH_GET_LIMIT = 100  # and batch_get_item at most 100 keys
+WRITE_CONCURRENCY = 4
+EXPIRY_SHARDS = 8  # partitions of end_date-index, unless config.expiry_shards says otherwise
+WRITE_ATTEMPTS = 8
+BID_ATTEMPTS = 5
+BACKOFF_BASE_SECONDS = 0.05
+BACKOFF_MAX_SECONDS = 5
+# a team's summary keeps every active game under SUMMARY_PREFIX + name, it's rebuilt from
+# active_games when it's missing or older than config.summary_max_age_seconds
+SUMMARY_PREFIX = 'game#'
+SUMMARY_MAX_AGE_SECONDS = 3600
+SUMMARY_REMOVE_LIMIT = 100
+SUMMARY_ATTEMPTS = 3
+# the stream of active_games is read every STREAM_POLL_SECONDS by watch_created_games,
+# its shards are listed again every STREAM_SHARDS_SECONDS or when one of them closes
+STREAM_POLL_SECONDS = 1
+STREAM_SHARDS_SECONDS = 60
+STREAM_RECORDS_LIMIT = 1000
+# every field encode_bid may store, a stored bid is compared field by field
+BID_FIELDS = ('v', 'user', 'amount', 'option', 'values')
+# what dynamodb answers when a table or the account is out of capacity
+THROTTLING_CODES = ('ProvisionedThroughputExceededException', 'ThrottlingException', 'RequestLimitExceeded')
+
+logger = logging.getLogger()
+
+
+class DynamoDbStorage(Storage):
+    def __init__(self):
+        self.write_pool = None
+        self.query_pool = None
+
+    def get_write_pool(self):
+        # kept between invocations, see notifications.get_pool
+        if self.write_pool is None:
+            self.write_pool = ThreadPool(WRITE_CONCURRENCY)
+        return self.write_pool
+
+    def get_query_pool(self):
+        if self.query_pool is None:
+            self.query_pool = ThreadPool(get_expiry_shards())
+        return self.query_pool
+
+    def get_team_games(self, team_id):
+        with metrics.span('dynamodb.active_games.query'):
+            response = db.get_table('active_games').query(
+                KeyConditionExpression=
+                Key('team_id').eq(str(team_id))
+            )
+        metrics.count('items_read', len(response['Items']))
+        return response['Items']
+
+    def get_team_summary(self, team_id):
+        # one read of a single item. games ended since it was written are still in it,
+        # listings leave them out by end_date
+        with metrics.span('dynamodb.team_summaries.get_item'):
+            item = db.get_table('team_summaries').get_item(Key={'team_id': team_id}, ConsistentRead=True).get('Item')
+        max_age = int(getattr(config, 'summary_max_age_seconds', SUMMARY_MAX_AGE_SECONDS))
+        if item is None or item.get('built', 0) < time.time() - max_age:
+            # a summary written only by create_game, without built, lacks the games before it
+            metrics.count('summaries_rebuilt')
+            return self.rebuild_team_summary(team_id, item or {})
+        return from_summary_item(item)
+
+    def rebuild_team_summary(self, team_id, summary=None):
+        # summary is the stored item as the caller just read it, {} when there's none. create_game
+        # and delete_games add to its version, the rebuilt one is only stored over the version
+        # read before active_games was queried, or the games they changed would be lost
+        for attempt in range(SUMMARY_ATTEMPTS):
+            if summary is None:
+                with metrics.span('dynamodb.team_summaries.get_item'):
+                    summary = db.get_table('team_summaries').get_item(
+                        Key={'team_id': team_id}, ConsistentRead=True,
+                        ProjectionExpression='#version', ExpressionAttributeNames={'#version': 'version'}
+                    ).get('Item', {})
+            version = summary.get('version', None)
+            summary = None
+
+            # only the summary's fields are read, the games' bids and aggregates stay behind
+            query = dict(to_projection(SUMMARY_FIELDS), KeyConditionExpression=Key('team_id').eq(str(team_id)),
+                         ConsistentRead=True)
+            item = {'team_id': team_id, 'built': int(time.time()), 'version': (version or 0) + 1}
+            while True:
+                with metrics.span('dynamodb.active_games.query'):
+                    response = db.get_table('active_games').query(**query)
+                metrics.count('items_read', len(response['Items']))
+                item.update((SUMMARY_PREFIX + game['name'], game) for game in response['Items'])
+                last_key = response.get('LastEvaluatedKey', None)
+                if not last_key:
+                    break
+                query['ExclusiveStartKey'] = last_key
+
+            try:
+                with metrics.span('dynamodb.team_summaries.put_item'):
+                    db.get_table('team_summaries').put_item(
+                        Item=item,
+                        ConditionExpression=Attr('version').not_exists() if version is None
+                        else Attr('version').eq(version)
+                    )
+                return from_summary_item(item)
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ConditionalCheckFailedException':
+                    # a game was created or settled meanwhile, the games are read again
+                    metrics.count('summary_conflicts')
+                    continue
+                # past the item size limit, listings read active_games every time
+                if code != 'ValidationException':
+                    raise
+                logger.info('Summary of team ' + str(team_id) + ' was not stored: ' + str(e))
+                return from_summary_item(item)
+
+        logger.info('Summary of team ' + str(team_id) + ' kept changing and was not stored')
+        return from_summary_item(item)
+
+    def rebuild_team_summaries(self):
+        # regenerates the summary of every team with active games
+        scan = {'ProjectionExpression': 'team_id'}
+        teams = set()
+        while True:
+            response = db.get_table('active_games').scan(**scan)
+            teams.update(item['team_id'] for item in response['Items'])
+            last_key = response.get('LastEvaluatedKey', None)
+            if not last_key:
+                break
+            scan['ExclusiveStartKey'] = last_key
+        for team_id in teams:
+            self.rebuild_team_summary(team_id)
+        return len(teams)
+
+    def get_game(self, team_id, name, consistent=True):
+        with metrics.span('dynamodb.active_games.get_item'):
+            item = db.get_table('active_games').get_item(Key={'team_id': str(team_id), 'name': name},
+                                                         ConsistentRead=consistent).get('Item')
+        metrics.count('items_read', 1 if item is not None else 0)
+        return item
+
+    def get_games(self, keys):
+        return batch_get_items(db.get_resource().meta.client, 'active_games',
+                               [{'team_id': team_id, 'name': name} for team_id, name in keys])
+
+    def get_game_info(self, team_id, name, consistent=True):
+        # a game's bids map and stats are left behind, for games stored with a bids map
+        # that's most of the item and of the read capacity
+        with metrics.span('dynamodb.active_games.get_item'):
+            item = db.get_table('active_games').get_item(Key={'team_id': str(team_id), 'name': name},
+                                                         ConsistentRead=consistent,
+                                                         **to_projection(SUMMARY_FIELDS)).get('Item')
+        metrics.count('items_read', 1 if item is not None else 0)
+        return item
+
+    def create_game(self, item):
+        # bids are items of their own in the bids table, keyed by game and user, the game
+        # is marked so that readers know not to look for a bids map in it. a game is only
+        # written when none of its name is active, the check before it may have read a stale copy
+        item = dict(item)
+        bids = item.pop('bids', None) or {}
+        item['index'] = get_expiry_shard(item['team_id'], item['name'], get_expiry_shards())
+        item['separate_bids'] = True
+        not_active = {'ConditionExpression': 'attribute_not_exists(#name)',
+                      'ExpressionAttributeNames': {'#name': 'name'}}
+        # the game and its entry in the team's summary are written together
+        client = db.get_resource().meta.client
+        response = None
+        try:
+            with metrics.span('dynamodb.active_games.transact_write_items'):
+                response = client.transact_write_items(TransactItems=[
+                    {'Put': dict(not_active, TableName='active_games', Item=item)},
+                    {'Update': {
+                        'TableName': 'team_summaries',
+                        'Key': {'team_id': item['team_id']},
+                        'UpdateExpression': 'SET #game = :game ADD #version :one',
+                        'ExpressionAttributeNames': {'#game': SUMMARY_PREFIX + item['name'], '#version': 'version'},
+                        'ExpressionAttributeValues': {':game': to_summary_entry(item), ':one': 1}
+                    }}
+                ])
+        except ClientError as e:
+            if is_cancelled_for(e, 'ConditionalCheckFailed'):
+                raise ConditionFailedException('game ' + item['name'] + ' is already active')
+            # the summary can't grow past the item size limit, it's dropped and the game stored alone.
+            # a transaction reports that as cancelled, with a reason for each of its writes
+            if not is_cancelled_for(e, 'ValidationError'):
+                raise
+            logger.info('Summary of team ' + str(item['team_id']) + ' was dropped: ' + str(e))
+        if response is None:
+            with metrics.span('dynamodb.team_summaries.delete_item'):
+                db.get_table('team_summaries').delete_item(Key={'team_id': item['team_id']})
+            try:
+                with metrics.span('dynamodb.active_games.put_item'):
+                    response = db.get_table('active_games').put_item(Item=item, **not_active)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                raise ConditionFailedException('game ' + item['name'] + ' is already active')
+
+        # the bids only go in once the game is known to be new, they'd be mixed into the active one
+        if bids:
+            game_key = get_game_key(item['team_id'], item['name'])
+            with metrics.span('dynamodb.bids.batch_write_item'):
+                self.batch_write(wrap_dynamo_batch_insert([dict(bid, game=game_key) for bid in bids.values()],
+                                                          'bids'))
+        return response
+
+    def get_game_bids(self, team_id, name):
+        client = db.get_resource().meta.client
+        for items in query_game_bids(client, team_id, name):
+            for item in items:
+                del item['game']
+                yield item
+
+    def put_bid(self, team_id, bid, now):
+        # round trips per path, each of them a transaction unless said otherwise:
+        #   - a first bid that can't change the top two: 1, see add_bid
+        #   - a changed bid that leaves the top two alone: 2, the first transaction fails on the bid's
+        #     condition and returns the old bid, the second one takes it out of the aggregates
+        #   - a bid that changes the top two, or any bid on a game that keeps a bids map: 2, the
+        #     failed transaction returns the game and the old bid and swap_bid writes over them.
+        #     3 when the old bid was in the top two and the new one isn't above it
+        #   - a rejected bid: 1, swap_bid turns it down over the game the transaction returned
+        # nothing is read unless what was returned changed before it could be written over.
+        # the resource's client is used, bids of one command are put from several threads
+        client = db.get_resource().meta.client
+        key = {'team_id': team_id, 'name': bid.game_name}
+        returned = self.add_bid(client, key, bid, now)
+        if returned is not None and 'game' not in returned and returned.get('bid', None) is not None:
+            returned = self.add_bid(client, key, bid, now, returned['bid'])
+        if returned is not None:
+            self.swap_bid(client, key, bid, now, returned)
+
+    def add_bid(self, client, key, bid, now, old_bid=None):
+        # one transaction: a conditional update that checks the game and adds the bid to the
+        # aggregates, and the bid's own item, over old_bid when it's known. it only goes through
+        # when the top two stay the same, otherwise what the failed conditions were checked
+        # against is returned as {'game': item or None, 'bid': old bid item or None}, with only
+        # what's known for sure. None once the bid is written
+        names = {'#stats': 'stats', '#version': 'version', '#separate_bids': 'separate_bids'}
+        values = {':one': 1}
+        condition = bid_condition(bid, now, names, values) + \
+            ' AND attribute_exists(#stats) AND attribute_exists(#separate_bids)'
+        update = 'ADD #stats.#version :one'
+        if old_bid is None:
+            names['#count'] = 'bids'
+            update += ', #stats.#count :one'
+        if bid.get_options():
+            # the old bid's amounts are taken out of the totals it was added to
+            totals = {}
+            old_values = Bid.parse_bid(decode_bid(old_bid)).get_values() if old_bid is not None else []
+            for option, amount in [(option, -amount) for option, amount in old_values] + list(bid.get_values()):
+                totals[option] = totals.get(option, 0) + amount
+            names['#totals'] = 'totals'
+            for i, option in enumerate(sorted(totals)):
+                names['#total%d' % i] = option
+                values[':amount%d' % i] = totals[option]
+                update += ', #stats.#totals.#total%d :amount%d' % (i, i)
+        else:
+            names['#floor'] = 'floor'
+            values[':amount'] = bid.amount
+            condition += ' AND #stats.#floor >= :amount'
+            if old_bid is not None:
+                # an old bid in the top two has to be swapped out of it
+                values[':old_amount'] = old_bid['amount']
+                condition += ' AND #stats.#floor > :old_amount'
+
+        bid_names = {}
+        bid_values = {}
+        if old_bid is None:
+            bid_condition_expression = 'attribute_not_exists(#user)'
+            bid_names['#user'] = 'user'
+        else:
+            # the old bid is still the one stored, every field a bid may be encoded with is compared
+            compared = []
+            for i, field in enumerate(BID_FIELDS):
+                bid_names['#field%d' % i] = field
+                if field in old_bid:
+                    bid_values[':field%d' % i] = old_bid[field]
+                    compared.append('#field%d = :field%d' % (i, i))
+                else:
+                    compared.append('attribute_not_exists(#field%d)' % i)
+            bid_condition_expression = ' AND '.join(compared)
+        bid_put = {
+            'TableName': 'bids',
+            'Item': to_bid_item(key['team_id'], bid),
+            'ConditionExpression': bid_condition_expression,
+            'ExpressionAttributeNames': bid_names,
+            'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+        }
+        if bid_values:
+            bid_put['ExpressionAttributeValues'] = bid_values
+
+        try:
+            with metrics.span('dynamodb.active_games.transact_write_items'):
+                client.transact_write_items(TransactItems=[
+                    {'Update': {
+                        'TableName': 'active_games',
+                        'Key': key,
+                        'UpdateExpression': update,
+                        'ConditionExpression': condition,
+                        'ExpressionAttributeNames': names,
+                        'ExpressionAttributeValues': values,
+                        'ReturnValuesOnConditionCheckFailure': 'ALL_OLD'
+                    }},
+                    {'Put': bid_put}
+                ])
+            return None
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = e.response.get('CancellationReasons', None) or []
+
+        returned = {}
+        if len(reasons) != 2:
+            return returned
+        game_reason, bid_reason = reasons
+        if game_reason.get('Code', None) == 'ConditionalCheckFailed':
+            returned['game'] = from_returned_item(game_reason)
+            if bid_reason.get('Code', None) == 'None':
+                # both conditions were checked, the bid's held
+                returned['bid'] = old_bid
+        if bid_reason.get('Code', None) == 'ConditionalCheckFailed':
+            returned['bid'] = from_returned_item(bid_reason)
+        return returned
+
+    def swap_bid(self, client, key, bid, now, returned=None):
+        # writes the aggregates over the version of the game they were computed from, the game
+        # and old bid a failed add_bid returned stand in for reading them on the first attempt.
+        # an old bid is only taken together with its game, a game read after it may already
+        # count a newer bid under the version that would be compared
+        for attempt in range(BID_ATTEMPTS):
+            known = (returned or {}) if attempt == 0 and 'game' in (returned or {}) else {}
+            if 'game' in known:
+                item = known['game']
+            else:
+                with metrics.span('dynamodb.active_games.get_item'):
+                    item = client.get_item(
+                    TableName='active_games',
+                        Key=key,
+                        ProjectionExpression='#end_date, #options, #stats, #separate_bids, #bids.#user',
+                        ExpressionAttributeNames={'#end_date': 'end_date', '#options': 'options', '#stats': 'stats',
+                                                  '#separate_bids': 'separate_bids', '#bids': 'bids',
+                                                  '#user': bid.user},
+                        ConsistentRead=True
+                    ).get('Item', None)
+            if item is None or not bid_fits_game(bid, item['end_date'], decode_options(item.get('options', None)), now):
+                raise ConditionFailedException('bid on ' + bid.game_name + ' was rejected')
+
+            separate_bids = item.get('separate_bids', False)
+            if separate_bids:
+                names = {}
+                values = {}
+                update = []
+                if 'bid' in known:
+                    old_bid = known['bid']
+                else:
+                    with metrics.span('dynamodb.bids.get_item'):
+                        old_bid = client.get_item(
+                            TableName='bids',
+                            Key={'game': get_game_key(key['team_id'], key['name']), 'user': bid.user},
+                            ConsistentRead=True
+                        ).get('Item', None)
+            else:
+                names = {'#bids': 'bids', '#user': bid.user}
+                values = {':item': bid.to_json_encoded()}
+                update = ['#bids.#user = :item']
+                old_bid = item.get('bids', {}).get(bid.user, None)
+            condition = bid_condition(bid, now, names, values)
+            stats = GameStats.decode(item.get('stats', None))
+            if stats is not None:
+                # games created before the aggregates existed are written without them
+                values[':version'] = stats.version
+                stats.replace_bid(bid, Bid.parse_bid(decode_bid(old_bid)) if old_bid is not None else None)
+                names.update({'#stats': 'stats', '#version': 'version'})
+                values[':stats'] = stats.encode()
+                condition += ' AND #stats.#version = :version'
+                update.append('#stats = :stats')
+
+            game_write = {
+                'TableName': 'active_games',
+                'Key': key,
+                'ConditionExpression': condition,
+                'ExpressionAttributeNames': names,
+                'ExpressionAttributeValues': values
+            }
+            if update:
+                game_write['UpdateExpression'] = 'SET ' + ', '.join(update)
+            try:
+                if separate_bids:
+                    with metrics.span('dynamodb.active_games.transact_write_items'):
+                        client.transact_write_items(TransactItems=[
+                            {'Update' if update else 'ConditionCheck': game_write},
+                            {'Put': {'TableName': 'bids', 'Item': to_bid_item(key['team_id'], bid)}}
+                        ])
+                else:
+                    with metrics.span('dynamodb.active_games.update_item'):
+                        client.update_item(**game_write)
+                return
+            except ClientError as e:
+                # another bid changed the game since it was read
+                if e.response['Error']['Code'] not in ('ConditionalCheckFailedException',
+                                                       'TransactionCanceledException'):
+                    raise
+            metrics.count('bid_conflicts')
+
+        raise ConditionFailedException('bid on ' + bid.game_name + ' kept conflicting with other bids')
+
+    def put_bids(self, team_id, bids, now):
+        # bids of one command are in different games, each is put on its own thread
+        return self.get_write_pool().map(lambda bid: self.try_put_bid(team_id, bid, now), bids)
+
+    def get_completed_games(self, now):
+        return self.query_expiry_index(Key('end_date').lt(now))
+
+    def get_games_ending_before(self, end_date):
+        games = []
+        for items in self.query_expiry_index(Key('end_date').lt(end_date),
+                                             ProjectionExpression='team_id, #name, end_date',
+                                             ExpressionAttributeNames={'#name': 'name'}):
+            games.extend((item['team_id'], item['name'], int(item['end_date'])) for item in items)
+        return games
+
+    def query_expiry_index(self, end_date_condition, **kwargs):
+        # queries every shard of end_date-index in parallel and yields their next pages
+        # merged by end_date, shards are followed until they run out of LastEvaluatedKey
+        client = db.get_resource().meta.client
+        queries = {}
+        for shard in range(1, get_expiry_shards() + 1):
+            queries[shard] = dict(kwargs, **{
+                'TableName': 'active_games',
+                'IndexName': 'end_date-index',
+                'KeyConditionExpression': Key('index').eq(shard) & end_date_condition
+            })
+        while queries:
+            shards = sorted(queries)
+            with metrics.span('dynamodb.active_games.query'):
+                responses = self.get_query_pool().map(lambda shard: client.query(**queries[shard]), shards)
+            metrics.count('shards_queried', len(shards))
+
+            pages = []
+            for shard, response in zip(shards, responses):
+                pages.append(response['Items'])
+                last_key = response.get('LastEvaluatedKey', None)
+                if last_key:
+                    queries[shard]['ExclusiveStartKey'] = last_key
+                else:
+                    del queries[shard]
+
+            items = merge_by_end_date(pages)
+            metrics.count('items_read', len(items))
+            yield items
+
+    def reshard_games(self, shards):
+        # moves every active game to its shard of end_date-index for the given shard count,
+        # including games still written with the constant index = 1. before lowering
+        # config.expiry_shards run this with the new count, the running code keeps
+        # querying all shards the games are moved to
+        table_games = db.get_table('active_games')
+        scan = {
+            'ProjectionExpression': 'team_id, #name, #index',
+            'ExpressionAttributeNames': {'#name': 'name', '#index': 'index'}
+        }
+        moved = 0
+        while True:
+            response = table_games.scan(**scan)
+            for item in response['Items']:
+                shard = get_expiry_shard(item['team_id'], item['name'], shards)
+                if item.get('index', None) == shard:
+                    continue
+                try:
+                    table_games.update_item(
+                        Key={'team_id': item['team_id'], 'name': item['name']},
+                        UpdateExpression='SET #index = :shard',
+                        ConditionExpression=Attr('name').exists(),
+                        ExpressionAttributeNames={'#index': 'index'},
+                        ExpressionAttributeValues={':shard': shard}
+                    )
+                    moved += 1
+                except ClientError as e:
+                    # the game was settled while we were scanning
+                    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                        raise
+
+            last_key = response.get('LastEvaluatedKey', None)
+            if not last_key:
+                return moved
+            scan['ExclusiveStartKey'] = last_key
+
+    def watch_created_games(self, add_game, stopped):
+        # follows the stream of active_games, it has to be on with StreamViewType NEW_IMAGE or
+        # NEW_AND_OLD_IMAGES. reading a stream takes none of the table's read capacity
+        client = db.get_resource().meta.client
+        stream_arn = client.describe_table(TableName='active_games')['Table'].get('LatestStreamArn', None)
+        if stream_arn is None:
+            logger.info('active_games has no stream, created games are found by querying it')
+            return False
+        streams = db.get_streams_client()
+        deserializer = TypeDeserializer()
+        iterators = {}  # shard id -> its next iterator, None once the shard is closed and read
+        listed_at = None
+        while not stopped.is_set():
+            if listed_at is None or time.time() - listed_at >= STREAM_SHARDS_SECONDS:
+                # shards are split and closed as the table grows, the ones opened since
+                # the last listing are read from their start
+                for shard in list_stream_shards(streams, stream_arn):
+                    shard_id = shard['ShardId']
+                    if shard_id in iterators:
+                        continue
+                    if listed_at is None and 'EndingSequenceNumber' in shard['SequenceNumberRange']:
+                        iterators[shard_id] = None
+                        continue
+                    iterators[shard_id] = get_shard_iterator(streams, stream_arn, shard_id,
+                                                             'LATEST' if listed_at is None else 'TRIM_HORIZON')
+                listed_at = time.time()
+
+            for shard_id, iterator in iterators.items():
+                if iterator is None:
+                    continue
+                try:
+                    response = streams.get_records(ShardIterator=iterator, Limit=STREAM_RECORDS_LIMIT)
+                except ClientError as e:
+                    if e.response['Error']['Code'] not in ('ExpiredIteratorException', 'TrimmedDataAccessException'):
+                        raise
+                    # the games missed meanwhile are left to the caller's next query
+                    iterators[shard_id] = get_shard_iterator(streams, stream_arn, shard_id, 'LATEST')
+                    continue
+                for record in response['Records']:
+                    if record['eventName'] == 'INSERT':
+                        image = record['dynamodb']['NewImage']
+                        add_game(deserializer.deserialize(image['team_id']), deserializer.deserialize(image['name']),
+                                 int(deserializer.deserialize(image['end_date'])))
+                iterators[shard_id] = response.get('NextShardIterator', None)
+                if iterators[shard_id] is None:
+                    # its children are listed right away
+                    listed_at = 0
+            stopped.wait(STREAM_POLL_SECONDS)
+        return True
+
+    def claim_games(self, keys, owner, now, until):
+        client = db.get_resource().meta.client
+
+        def claim(key):
+            try:
+                response = client.update_item(
+                    TableName='active_games',
+                    Key={'team_id': key[0], 'name': key[1]},
+                    UpdateExpression='SET #lease_owner = :owner, #lease_until = :until',
+                    ConditionExpression='attribute_exists(#name) AND (attribute_not_exists(#lease_until) OR '
+                                        '#lease_until < :now OR #lease_owner = :owner)',
+                    ExpressionAttributeNames={'#name': 'name', '#lease_owner': 'lease_owner',
+                                              '#lease_until': 'lease_until'},
+                    ExpressionAttributeValues={':owner': owner, ':until': until, ':now': now},
+                    ReturnValues='UPDATED_OLD'
+                )
+            except ClientError as e:
+                # another scheduler holds the game or already settled it
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                return None
+            return response.get('Attributes', {}).get('lease_owner', owner) != owner
+
+        keys = list(keys)
+        with metrics.span('dynamodb.active_games.update_item'):
+            leased_before = self.get_write_pool().map(claim, keys)
+        return dict((key, before) for key, before in zip(keys, leased_before) if before is not None)
+
+    def get_archived_games(self, ids):
+        # only the outcome, not the archived bids map of games stored with one
+        items = batch_get_items(db.get_resource().meta.client, 'completed_games',
+                                [{'id': game_id} for game_id in ids], **to_projection(OUTCOME_FIELDS))
+        return dict((item['id'], item) for item in items)
+
+    def archive_games(self, items):
+        # bids are copied under the archived game's id before the game itself is written
+        client = db.get_resource().meta.client
+        bid_games = [item for item in items if 'bids' not in item]
+        if bid_games:
+            with metrics.span('dynamodb.completed_bids.batch_write_item'):
+                self.get_write_pool().map(lambda item: copy_game_bids(client, item), bid_games)
+        with metrics.span('dynamodb.completed_games.batch_write_item'):
+            self.batch_write(wrap_dynamo_batch_insert(items, 'completed_games'))
+
+    def mark_notified(self, items):
+        with metrics.span('dynamodb.completed_games.batch_write_item'):
+            self.batch_write(wrap_dynamo_batch_insert(items, 'completed_games'))
+
+    def delete_games(self, keys):
+        # a game's bids go first, a game is never left gone with its bids still there
+        client = db.get_resource().meta.client
+        keys = list(keys)
+        with metrics.span('dynamodb.bids.batch_write_item'):
+            self.get_write_pool().map(lambda key: delete_game_bids(client, key[0], key[1]), keys)
+        with metrics.span('dynamodb.active_games.batch_write_item'):
+            self.batch_write(wrap_dynamo_batch_delete(keys, 'active_games'))
+
+        team_names = {}
+        for team_id, name in keys:
+            team_names.setdefault(team_id, []).append(name)
+        with metrics.span('dynamodb.team_summaries.update_item'):
+            self.get_write_pool().map(lambda team: remove_from_summary(client, team[0], team[1]), team_names.items())
+
+    def get_settings(self, team_id):
+        # consistent, the result is cached for a while and this read follows every change of the
+        # settings in the same container, e.g. /set_timezone invalidates them
+        with metrics.span('dynamodb.settings.get_item'):
+            return db.get_table('settings').get_item(Key={'team_id': team_id}, ConsistentRead=True).get('Item')
+
+    def put_settings(self, item):
+        with metrics.span('dynamodb.settings.put_item'):
+            return db.get_table('settings').put_item(Item=item)
+
+    def set_timezone(self, team_id, utc_offset, team_domain):
+        with metrics.span('dynamodb.settings.update_item'):
+            response = db.get_table('settings').update_item(
+                Key={'team_id': team_id},
+                UpdateExpression='SET utc_offset = :offset, team_domain = :team_domain',
+                ExpressionAttributeValues={
+                    ':offset': utc_offset,
+                    ':team_domain': team_domain,
+                },
+                ReturnValues='UPDATED_NEW'
+            )
+        return response.get('Attributes', {})
+
+    def put_oauth(self, item):
+        with metrics.span('dynamodb.oauth.put_item'):
+            return db.get_table('oauth').put_item(Item=item)
+
+    def get_webhook_urls(self, team_ids):
+        team2url = {}
+        client = db.get_resource().meta.client
+        for i in range(0, len(team_ids), BATCH_GET_LIMIT):
+            teams = team_ids[i:i + BATCH_GET_LIMIT]
+            with metrics.span('dynamodb.oauth.batch_get_item'):
+                response = client.batch_get_item(RequestItems={
+                    'oauth': {
+                        'Keys': [{'team_id': team} for team in teams],
+                        'ProjectionExpression': 'team_id, webhook_url'
+                    }
+                })
+            loaded = {team_info['team_id']: team_info['webhook_url']
+                      for team_info in response['Responses']['oauth']}
+            if response['UnprocessedKeys']:
+                logger.info('UnprocessedKeys for team-url oauth: ' + str(response['UnprocessedKeys']))
+
+            unprocessed = response['UnprocessedKeys'].get('oauth', {}).get('Keys', [])
+            unprocessed = set(key['team_id'] for key in unprocessed)
+            for team in teams:
+                if team not in unprocessed:
+                    team2url[team] = loaded.get(team, None)
+        return team2url
+
+    def take_token(self, team_id, now, interval, tolerance, full_at=None):
+        # a bucket is either full, its full_at passed or missing, and is refilled to one token
+        # taken, or it's draining and full_at is moved on. one of the two conditional updates
+        # goes through unless the bucket is empty, the one full_at suggests is tried first.
+        # expires is the table's ttl attribute, a bucket that's full is as good as none
+        names = {'#full_at': 'full_at', '#expires': 'expires'}
+        expires = (now + tolerance) // 1000 + 1
+        refill = {
+            'UpdateExpression': 'SET #full_at = :next, #expires = :expires',
+            'ConditionExpression': 'attribute_not_exists(#full_at) OR #full_at < :now',
+            'ExpressionAttributeValues': {':next': now + interval, ':now': now, ':expires': expires}
+        }
+        drain = {
+            'UpdateExpression': 'SET #full_at = #full_at + :interval, #expires = :expires',
+            'ConditionExpression': '#full_at >= :now AND #full_at <= :latest',
+            'ExpressionAttributeValues': {':interval': interval, ':now': now, ':latest': now + tolerance - interval,
+                                          ':expires': expires}
+        }
+        table_limits = db.get_table('rate_limits')
+        for update in ([drain, refill] if full_at is not None and full_at >= now else [refill, drain]):
+            try:
+                with metrics.span('dynamodb.rate_limits.update_item'):
+                    response = table_limits.update_item(Key={'team_id': str(team_id)},
+                                                        ExpressionAttributeNames=names, ReturnValues='UPDATED_NEW',
+                                                        **update)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                continue
+            return int(response['Attributes']['full_at'])
+        return None
+
+    def is_throttled(self, error):
+        return isinstance(error, ClientError) and error.response['Error']['Code'] in THROTTLING_CODES
+
+    def batch_write(self, request_items):
+        # splits request items into 25-item chunks and writes them concurrently,
+        # the resource's client is used since resource objects are not thread safe
+        client = db.get_resource().meta.client
+        chunks = []
+        for table_name, items in request_items.items():
+            for i in range(0, len(items), BATCH_WRITE_LIMIT):
+                chunks.append({table_name: items[i:i + BATCH_WRITE_LIMIT]})
+
+        self.get_write_pool().map(lambda chunk: write_chunk(client, chunk), chunks)
+
+
+def bid_condition(bid, now, names, values):
+    # the game exists, hasn't ended and offers every option of the bid
+    names.update({'#name': 'name', '#end_date': 'end_date', '#options': 'options'})
+    values[':now'] = now
+    condition = 'attribute_exists(#name) AND #end_date > :now'
+    bid_options = bid.get_options()
+    if not bid_options:
+        return condition + ' AND attribute_not_exists(#options)'
+
+    # legacy games keep their options as a json encoded string
+    values.update({':list': 'L', ':string': 'S'})
+    in_list = ['attribute_type(#options, :list)']
+    in_legacy_string = ['attribute_type(#options, :string)']
+    for i, option in enumerate(bid_options):
+        values[':option%d' % i] = option
+        values[':json%d' % i] = json.dumps(option)
+        in_list.append('contains(#options, :option%d)' % i)
+        in_legacy_string.append('contains(#options, :json%d)' % i)
+    return condition + ' AND ((' + ' AND '.join(in_list) + ') OR (' + ' AND '.join(in_legacy_string) + '))'
+
+
+def list_stream_shards(streams, stream_arn):
+    shards = []
+    request = {'StreamArn': stream_arn}
+    while True:
+        description = streams.describe_stream(**request)['StreamDescription']
+        shards.extend(description['Shards'])
+        last_shard_id = description.get('LastEvaluatedShardId', None)
+        if not last_shard_id:
+            return shards
+        request['ExclusiveStartShardId'] = last_shard_id
+
+
+def get_shard_iterator(streams, stream_arn, shard_id, iterator_type):
+    return streams.get_shard_iterator(StreamArn=stream_arn, ShardId=shard_id,
+                                      ShardIteratorType=iterator_type)['ShardIterator']
+
+
+def get_expiry_shards():
+    return int(getattr(config, 'expiry_shards', EXPIRY_SHARDS))
+
+
+def get_expiry_shard(team_id, name, shards):
+    # shards are numbered from 1, so games from before sharding sit in shard 1.
+    # crc32 is stable across processes and python versions, unlike hash()
+    key = team_id + '/' + name
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % shards + 1
+
+
+def to_projection(fields):
+    # every field through a placeholder, some of them are reserved words
+    return {'ProjectionExpression': ', '.join('#' + field for field in fields),
+            'ExpressionAttributeNames': dict(('#' + field, field) for field in fields)}
+
+
+def get_game_key(team_id, name):
+    # hash key of a game's bids, team ids never contain '#'
+    return team_id + '#' + name
+
+
+def to_bid_item(team_id, bid):
+    return dict(bid.to_json_encoded(), game=get_game_key(team_id, bid.game_name))
+
+
+def query_game_bids(client, team_id, name, **kwargs):
+    # yields the pages of a game's bids, consistent so that no bid put before the game
+    # ended is missed
+    query = dict(kwargs, TableName='bids', KeyConditionExpression=Key('game').eq(get_game_key(team_id, name)),
+                 ConsistentRead=True)
+    while True:
+        with metrics.span('dynamodb.bids.query'):
+            response = client.query(**query)
+        metrics.count('bids_read', len(response['Items']))
+        yield response['Items']
+
+        last_key = response.get('LastEvaluatedKey', None)
+        if not last_key:
+            return
+        query['ExclusiveStartKey'] = last_key
+
+
+def copy_game_bids(client, item):
+    for bids in query_game_bids(client, item['team_id'], item['name']):
+        for i in range(0, len(bids), BATCH_WRITE_LIMIT):
+            write_chunk(client, {'completed_bids': [{'PutRequest': {'Item': to_completed_bid(item['id'], bid)}}
+                                                    for bid in bids[i:i + BATCH_WRITE_LIMIT]]})
+
+
+def to_completed_bid(game_id, bid):
+    completed_bid = dict(bid, id=game_id)
+    del completed_bid['game']
+    return completed_bid
+
+
+def delete_game_bids(client, team_id, name):
+    for bids in query_game_bids(client, team_id, name, ProjectionExpression='game, #user',
+                                ExpressionAttributeNames={'#user': 'user'}):
+        for i in range(0, len(bids), BATCH_WRITE_LIMIT):
+            write_chunk(client, {'bids': [{'DeleteRequest': {'Key': bid}} for bid in bids[i:i + BATCH_WRITE_LIMIT]]})
+
+
+def from_returned_item(reason):
+    # the item a write of a cancelled transaction returned with ReturnValuesOnConditionCheckFailure,
+    # None when there was none. cancellation reasons are left as dynamodb's attribute values
+    item = reason.get('Item', None)
+    if item is None:
+        return None
+    deserializer = TypeDeserializer()
+    return dict((name, deserializer.deserialize(value)) for name, value in item.items())
+
+
+def is_cancelled_for(error, code):
+    return error.response['Error']['Code'] == 'TransactionCanceledException' and \
+        any(reason.get('Code', None) == code for reason in error.response.get('CancellationReasons', []))
+
+
+def from_summary_item(item):
+    return sorted((dict(entry, team_id=item['team_id']) for attribute, entry in item.items()
+                   if attribute.startswith(SUMMARY_PREFIX)), key=lambda entry: entry['name'])
+
+
+def remove_from_summary(client, team_id, names):
+    for i in range(0, len(names), SUMMARY_REMOVE_LIMIT):
+        chunk = names[i:i + SUMMARY_REMOVE_LIMIT]
+        attribute_names = {'#team_id': 'team_id', '#version': 'version'}
+        for j, name in enumerate(chunk):
+            attribute_names['#game%d' % j] = SUMMARY_PREFIX + name
+        try:
+            # the version tells a rebuild running meanwhile that the summary changed
+            client.update_item(
+                TableName='team_summaries',
+                Key={'team_id': team_id},
+                UpdateExpression='REMOVE ' + ', '.join('#game%d' % j for j in range(len(chunk))) + ' ADD #version :one',
+                ConditionExpression='attribute_exists(#team_id)',
+                ExpressionAttributeNames=attribute_names,
+                ExpressionAttributeValues={':one': 1}
+            )
+        except ClientError as e:
+            # no summary to remove them from, it's rebuilt when it's next read
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return
+
+
+def batch_get_items(client, table_name, keys, **request):
+    # consistent reads of the items with the given keys, those not found are left out
+    items = []
+    for i in range(0, len(keys), BATCH_GET_LIMIT):
+        request_items = {table_name: dict(request, ConsistentRead=True, Keys=keys[i:i + BATCH_GET_LIMIT])}
+        for attempt in range(WRITE_ATTEMPTS):
+            with metrics.span('dynamodb.' + table_name + '.batch_get_item'):
+                response = client.batch_get_item(RequestItems=request_items)
+            items.extend(response['Responses'].get(table_name, []))
+            request_items = response.get('UnprocessedKeys', None)
+            if not request_items:
+                break
+            time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+        else:
+            raise StorageException(table_name + ' items left unread after ' + str(WRITE_ATTEMPTS) + ' attempts: ' +
+                                   str(request_items))
+    return items
+
+
+def merge_by_end_date(pages):
+    # every page is already sorted by end_date, the range key of the index
+    decorated = [[(item['end_date'], i, j, item) for j, item in enumerate(page)] for i, page in enumerate(pages)]
+    return [item for end_date, i, j, item in heapq.merge(*decorated)]
+
+
+def wrap_dynamo_batch_insert(items, table_name):
+    items_array = []
+    for item in items:
+        items_array.append({'PutRequest': {'Item': item}})
+    return {table_name: items_array}
+
+
+def wrap_dynamo_batch_delete(keys, table_name):
+    items_array = []
+    for team, name in keys:
+        items_array.append({'DeleteRequest': {'Key': {'team_id': team, 'name': name}}})
+    return {table_name: items_array}
+
+
+def write_chunk(client, request_items):
+    for attempt in range(WRITE_ATTEMPTS):
+        response = client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems', None)
+        if not request_items:
+            return
+
+        if attempt + 1 == WRITE_ATTEMPTS:
+            break
+        unprocessed = sum(len(items) for items in request_items.values())
+        logger.info('Retrying ' + str(unprocessed) + ' unprocessed items, attempt ' + str(attempt + 2))
+        # exponential backoff with full jitter
+        time.sleep(random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)))
+
+    raise StorageException('items left unprocessed after ' + str(WRITE_ATTEMPTS) + ' attempts: ' +
+                           str(request_items))
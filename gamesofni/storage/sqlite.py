@@ -0,0 +1,395 @@
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from metrics import metrics
+from vcg.bid import Bid
+from vcg.codec import encode_bid, decode_bid, decode_options
+from vcg.stats import GameStats
+from .base import Storage, ConditionFailedException, bid_fits_game
+
+PAGE_SIZE = 500  # completed games per page, a page is settled before the next one is read
+VARIABLES_LIMIT = 500  # stays below SQLITE_MAX_VARIABLE_NUMBER of older builds
+BUSY_TIMEOUT_SECONDS = 10
+
+# games and bids are clustered on their primary keys, so all bids of a game and all
+# games of a team are read from neighbouring pages. bids are normalized into one row
+# per (user, option), position orders the values of a bid on several options and is
+# null for a plain bid. stats holds the json encoded GameStats. settled games' bids are
+# moved to completed_bids under the id of the archived game. lease_owner holds a game
+# for the scheduler settling it until lease_until
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS active_games (
+    team_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    creator TEXT NOT NULL,
+    start_date INTEGER NOT NULL,
+    end_date INTEGER NOT NULL,
+    options TEXT,
+    units INTEGER NOT NULL DEFAULT 1,
+    utc_offset,
+    stats TEXT,
+    lease_owner TEXT,
+    lease_until INTEGER,
+    PRIMARY KEY (team_id, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS active_games_end_date ON active_games (end_date);
+CREATE TABLE IF NOT EXISTS bids (
+    team_id TEXT NOT NULL,
+    game_name TEXT NOT NULL,
+    user TEXT NOT NULL,
+    option TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    position INTEGER,
+    PRIMARY KEY (team_id, game_name, user, option)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bids_amount ON bids (team_id, game_name, amount);
+CREATE TABLE IF NOT EXISTS completed_games (
+    id TEXT PRIMARY KEY,
+    team_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    end_date INTEGER NOT NULL,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS completed_bids (
+    id TEXT NOT NULL,
+    user TEXT NOT NULL,
+    option TEXT NOT NULL,
+    amount INTEGER NOT NULL,
+    position INTEGER,
+    PRIMARY KEY (id, user, option)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS settings (
+    team_id TEXT PRIMARY KEY,
+    utc_offset,
+    team_domain TEXT,
+    joined INTEGER
+);
+CREATE TABLE IF NOT EXISTS oauth (
+    team_id TEXT PRIMARY KEY,
+    webhook_url TEXT,
+    item TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rate_limits (
+    team_id TEXT PRIMARY KEY,
+    full_at INTEGER NOT NULL
+);
+'''
+
+# statements are kept as constants, sqlite3 caches the prepared statement of every sql text
+GAME_COLUMNS = 'team_id, name, creator, start_date, end_date, options, units, utc_offset, stats'
+SELECT_TEAM_GAMES = 'SELECT ' + GAME_COLUMNS + ' FROM active_games WHERE team_id = ?'
+SELECT_GAME = 'SELECT ' + GAME_COLUMNS + ' FROM active_games WHERE team_id = ? AND name = ?'
+SELECT_GAME_BIDS = 'SELECT team_id, game_name, user, option, amount, position FROM bids ' \
+                   'WHERE team_id = ? AND game_name = ?'
+SELECT_BID_CONDITION = 'SELECT end_date, options, stats FROM active_games WHERE team_id = ? AND name = ?'
+SELECT_USER_BIDS = SELECT_GAME_BIDS + ' AND user = ?'
+# the primary key already orders them, the rows of one bid come together
+SELECT_GAME_BIDS_BY_USER = SELECT_GAME_BIDS + ' ORDER BY user'
+SELECT_TOP_BIDS = "SELECT amount, user FROM bids WHERE team_id = ? AND game_name = ? AND option = '' " \
+                  'ORDER BY amount DESC LIMIT 2'
+UPDATE_STATS = 'UPDATE active_games SET stats = ? WHERE team_id = ? AND name = ?'
+INSERT_GAME = 'INSERT INTO active_games (' + GAME_COLUMNS + ') VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+INSERT_BID = 'INSERT OR REPLACE INTO bids (team_id, game_name, user, option, amount, position) ' \
+             'VALUES (?, ?, ?, ?, ?, ?)'
+SELECT_LEASE = 'SELECT lease_owner, lease_until FROM active_games WHERE team_id = ? AND name = ?'
+UPDATE_LEASE = 'UPDATE active_games SET lease_owner = ?, lease_until = ? WHERE team_id = ? AND name = ?'
+DELETE_USER_BIDS = 'DELETE FROM bids WHERE team_id = ? AND game_name = ? AND user = ?'
+DELETE_GAME_BIDS = 'DELETE FROM bids WHERE team_id = ? AND game_name = ?'
+DELETE_GAME = 'DELETE FROM active_games WHERE team_id = ? AND name = ?'
+# keyset pagination over the end_date index, which also holds the primary key columns
+COMPLETED_PAGE = 'SELECT team_id, name FROM active_games WHERE end_date < ? AND ' \
+                 '(end_date > ? OR (end_date = ? AND (team_id > ? OR (team_id = ? AND name > ?)))) ' \
+                 'ORDER BY end_date, team_id, name LIMIT ?'
+SELECT_COMPLETED_GAMES = 'SELECT ' + ', '.join('g.' + column for column in GAME_COLUMNS.split(', ')) + \
+                         ' FROM active_games g JOIN (' + COMPLETED_PAGE + ') page ' \
+                         'ON g.team_id = page.team_id AND g.name = page.name ORDER BY g.end_date, g.team_id, g.name'
+SELECT_GAMES_ENDING_BEFORE = 'SELECT team_id, name, end_date FROM active_games WHERE end_date < ? ORDER BY end_date'
+INSERT_COMPLETED_GAME = 'INSERT OR REPLACE INTO completed_games (id, team_id, name, end_date, item) ' \
+                        'VALUES (?, ?, ?, ?, ?)'
+SELECT_ARCHIVED_GAMES = 'SELECT id, item FROM completed_games WHERE id IN (%s)'
+ARCHIVE_GAME_BIDS = 'INSERT OR REPLACE INTO completed_bids (id, user, option, amount, position) ' \
+                    'SELECT ?, user, option, amount, position FROM bids WHERE team_id = ? AND game_name = ?'
+SELECT_SETTINGS = 'SELECT team_id, utc_offset, team_domain, joined FROM settings WHERE team_id = ?'
+INSERT_SETTINGS = 'INSERT OR REPLACE INTO settings (team_id, utc_offset, team_domain, joined) VALUES (?, ?, ?, ?)'
+UPSERT_TIMEZONE = 'INSERT INTO settings (team_id, utc_offset, team_domain) VALUES (?, ?, ?) ' \
+                  'ON CONFLICT (team_id) DO UPDATE SET utc_offset = excluded.utc_offset, ' \
+                  'team_domain = excluded.team_domain'
+INSERT_OAUTH = 'INSERT OR REPLACE INTO oauth (team_id, webhook_url, item) VALUES (?, ?, ?)'
+SELECT_WEBHOOK_URLS = 'SELECT team_id, webhook_url FROM oauth WHERE team_id IN (%s)'
+TAKE_TOKEN = 'INSERT INTO rate_limits (team_id, full_at) VALUES (?, ?) ' \
+             'ON CONFLICT (team_id) DO UPDATE SET full_at = MAX(full_at, ?) + ? ' \
+             'WHERE MAX(full_at, ?) + ? <= ?'
+SELECT_FULL_AT = 'SELECT full_at FROM rate_limits WHERE team_id = ?'
+
+
+class SqliteStorage(Storage):
+    # one connection per thread to a database file in wal mode, so readers never
+    # wait for the writer. every write is a single transaction
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.get_connection().executescript(SCHEMA)
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # autocommit mode, transactions are started explicitly
+            connection = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS, isolation_level=None,
+                                         check_same_thread=False, cached_statements=256)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            self.local.connection = connection
+        return connection
+
+    @contextmanager
+    def transaction(self, begin='BEGIN IMMEDIATE'):
+        connection = self.get_connection()
+        connection.execute(begin)
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def get_team_games(self, team_id):
+        team_id = str(team_id)
+        with metrics.span('sqlite.active_games.query'):
+            games = self.get_connection().execute(SELECT_TEAM_GAMES, (team_id,)).fetchall()
+        metrics.count('items_read', len(games))
+        return to_game_items(games)
+
+    def get_game(self, team_id, name, consistent=True):
+        # reads are always consistent here
+        key = (str(team_id), name)
+        with metrics.span('sqlite.active_games.query'):
+            games = self.get_connection().execute(SELECT_GAME, key).fetchall()
+        metrics.count('items_read', len(games))
+        items = to_game_items(games)
+        return items[0] if items else None
+
+    def create_game(self, item):
+        options = decode_options(item.get('options', None))
+        row = (item['team_id'], item['name'], item['creator'], item['start_date'], item['end_date'],
+               json.dumps(options) if options else None, item.get('units', 1), item['utc_offset'],
+               json.dumps(item['stats']) if item.get('stats', None) else None)
+        bid_rows = []
+        for stored_bid in item.get('bids', {}).values():
+            bid_rows.extend(to_bid_rows(item['team_id'], item['name'], decode_bid(stored_bid)))
+
+        try:
+            with metrics.span('sqlite.active_games.put_item'):
+                with self.transaction() as connection:
+                    connection.execute(DELETE_GAME_BIDS, row[:2])
+                    connection.execute(INSERT_GAME, row)
+                    connection.executemany(INSERT_BID, bid_rows)
+        except sqlite3.IntegrityError:
+            # a game of that name is still active, its bids were left as they were
+            raise ConditionFailedException('game ' + item['name'] + ' is already active')
+        return {}
+
+    def get_game_bids(self, team_id, name):
+        key = (str(team_id), name)
+        with metrics.span('sqlite.bids.query'):
+            rows = self.get_connection().execute(SELECT_GAME_BIDS_BY_USER, key)
+        # the cursor is read as the bids are consumed, one bid's rows at a time
+        user_rows = []
+        for row in rows:
+            if user_rows and row[2] != user_rows[0][2]:
+                yield to_json_bids(user_rows)[key][user_rows[0][2]]
+                user_rows = []
+            user_rows.append(row)
+        if user_rows:
+            yield to_json_bids(user_rows)[key][user_rows[0][2]]
+
+    def put_bid(self, team_id, bid, now):
+        # the checks, the bid and the game's aggregates share one transaction
+        key = (team_id, bid.game_name)
+        with metrics.span('sqlite.active_games.update_item'):
+            with self.transaction() as connection:
+                game = connection.execute(SELECT_BID_CONDITION, key).fetchone()
+                if game is None or not bid_fits_game(bid, game[0], json.loads(game[1]) if game[1] else None, now):
+                    raise ConditionFailedException('bid on ' + bid.game_name + ' was rejected')
+
+                stats = GameStats.decode(json.loads(game[2])) if game[2] else None
+                if stats is not None:
+                    old_bids = to_json_bids(connection.execute(SELECT_USER_BIDS, key + (bid.user,)).fetchall())
+                    old_bid = old_bids.get(key, {}).get(bid.user, None)
+                    old_bid = Bid.parse_bids([decode_bid(old_bid)])[0] if old_bid is not None else None
+                    stats.replace_bid(bid, old_bid)
+
+                connection.execute(DELETE_USER_BIDS, key + (bid.user,))
+                connection.executemany(INSERT_BID, to_bid_rows(team_id, bid.game_name, bid.to_json_encoded()))
+
+                if stats is not None:
+                    if stats.stale:
+                        # the index on amount finds the real top two right away
+                        stats.top = [[amount, user] for amount, user in connection.execute(SELECT_TOP_BIDS, key)]
+                        stats.stale = False
+                    connection.execute(UPDATE_STATS, (json.dumps(stats.encode()),) + key)
+
+    def get_completed_games(self, now):
+        # keyset pages ordered by end_date, bids are streamed with get_game_bids
+        last = (-1, '', '')
+        while True:
+            page = (now, last[0], last[0], last[1], last[1], last[2], PAGE_SIZE)
+            with metrics.span('sqlite.active_games.query'):
+                games = self.get_connection().execute(SELECT_COMPLETED_GAMES, page).fetchall()
+            metrics.count('items_read', len(games))
+            yield to_game_items(games)
+
+            if len(games) < PAGE_SIZE:
+                return
+            last = (games[-1][4], games[-1][0], games[-1][1])
+
+    def get_games_ending_before(self, end_date):
+        with metrics.span('sqlite.active_games.query'):
+            return self.get_connection().execute(SELECT_GAMES_ENDING_BEFORE, (end_date,)).fetchall()
+
+    def claim_games(self, keys, owner, now, until):
+        claimed = {}
+        with metrics.span('sqlite.active_games.update_item'):
+            with self.transaction() as connection:
+                for key in keys:
+                    lease = connection.execute(SELECT_LEASE, key).fetchone()
+                    if lease is None:
+                        continue
+                    lease_owner, lease_until = lease
+                    if lease_until is not None and lease_until >= now and lease_owner != owner:
+                        continue
+                    connection.execute(UPDATE_LEASE, (owner, until) + tuple(key))
+                    claimed[key] = lease_owner is not None and lease_owner != owner
+        return claimed
+
+    def get_archived_games(self, ids):
+        archived = {}
+        connection = self.get_connection()
+        for i in range(0, len(ids), VARIABLES_LIMIT):
+            page = ids[i:i + VARIABLES_LIMIT]
+            with metrics.span('sqlite.completed_games.query'):
+                rows = connection.execute(SELECT_ARCHIVED_GAMES % ', '.join('?' * len(page)), page).fetchall()
+            archived.update((game_id, json.loads(item)) for game_id, item in rows)
+        return archived
+
+    def archive_games(self, items):
+        rows = [(item['id'], item['team_id'], item['name'], item['end_date'], json.dumps(item, sort_keys=True))
+                for item in items]
+        bid_games = [(item['id'], item['team_id'], item['name']) for item in items if 'bids' not in item]
+        with metrics.span('sqlite.completed_games.batch_write_item'):
+            with self.transaction() as connection:
+                connection.executemany(INSERT_COMPLETED_GAME, rows)
+                connection.executemany(ARCHIVE_GAME_BIDS, bid_games)
+
+    def mark_notified(self, items):
+        rows = [(item['id'], item['team_id'], item['name'], item['end_date'], json.dumps(item, sort_keys=True))
+                for item in items]
+        with metrics.span('sqlite.completed_games.batch_write_item'):
+            with self.transaction() as connection:
+                connection.executemany(INSERT_COMPLETED_GAME, rows)
+
+    def delete_games(self, keys):
+        keys = list(keys)
+        with metrics.span('sqlite.active_games.batch_write_item'):
+            with self.transaction() as connection:
+                connection.executemany(DELETE_GAME_BIDS, keys)
+                connection.executemany(DELETE_GAME, keys)
+
+    def get_settings(self, team_id):
+        with metrics.span('sqlite.settings.query'):
+            row = self.get_connection().execute(SELECT_SETTINGS, (str(team_id),)).fetchone()
+        if row is None:
+            return None
+        columns = ('team_id', 'utc_offset', 'team_domain', 'joined')
+        # like dynamodb items, attributes that were never set are left out
+        return {column: value for column, value in zip(columns, row) if value is not None}
+
+    def put_settings(self, item):
+        row = (item['team_id'], item.get('utc_offset', None), item.get('team_domain', None), item.get('joined', None))
+        with metrics.span('sqlite.settings.put_item'):
+            with self.transaction() as connection:
+                connection.execute(INSERT_SETTINGS, row)
+        return {}
+
+    def set_timezone(self, team_id, utc_offset, team_domain):
+        with metrics.span('sqlite.settings.update_item'):
+            with self.transaction() as connection:
+                connection.execute(UPSERT_TIMEZONE, (team_id, utc_offset, team_domain))
+        return {'utc_offset': utc_offset, 'team_domain': team_domain}
+
+    def put_oauth(self, item):
+        with metrics.span('sqlite.oauth.put_item'):
+            with self.transaction() as connection:
+                connection.execute(INSERT_OAUTH, (item['team_id'], item.get('webhook_url', None),
+                                                  json.dumps(item, sort_keys=True)))
+        return {}
+
+    def get_webhook_urls(self, team_ids):
+        team2url = dict.fromkeys(team_ids)
+        connection = self.get_connection()
+        for i in range(0, len(team_ids), VARIABLES_LIMIT):
+            teams = team_ids[i:i + VARIABLES_LIMIT]
+            with metrics.span('sqlite.oauth.query'):
+                rows = connection.execute(SELECT_WEBHOOK_URLS % ', '.join('?' * len(teams)), teams).fetchall()
+            team2url.update(rows)
+        return team2url
+
+    def take_token(self, team_id, now, interval, tolerance, full_at=None):
+        # one upsert, it leaves the row alone when the bucket is empty
+        with metrics.span('sqlite.rate_limits.update_item'):
+            with self.transaction() as connection:
+                taken = connection.execute(TAKE_TOKEN, (str(team_id), now + interval, now, interval, now, interval,
+                                                        now + tolerance)).rowcount
+                if not taken:
+                    return None
+                return connection.execute(SELECT_FULL_AT, (str(team_id),)).fetchone()[0]
+
+    def is_throttled(self, error):
+        # the writer held the database for longer than the busy timeout
+        return isinstance(error, sqlite3.OperationalError) and 'locked' in str(error)
+
+
+def to_bid_rows(team_id, game_name, json_bid):
+    values = json_bid.get('values', None)
+    if values is not None:
+        return [(team_id, game_name, json_bid['user'], option, amount, position)
+                for position, (option, amount) in enumerate(values)]
+    return [(team_id, game_name, json_bid['user'], json_bid.get('option', None) or '', json_bid['amount'], None)]
+
+
+def to_game_items(games):
+    # rebuilds dynamodb shaped items from game rows, their bids are rows of their own
+    items = []
+    for team_id, name, creator, start_date, end_date, options, units, utc_offset, stats in games:
+        item = {'team_id': team_id,
+                'name': name,
+                'creator': creator,
+                'start_date': start_date,
+                'end_date': end_date,
+                'utc_offset': utc_offset}
+        if options:
+            item['options'] = json.loads(options)
+        if units > 1:
+            item['units'] = units
+        if stats:
+            item['stats'] = json.loads(stats)
+        items.append(item)
+    return items
+
+
+def to_json_bids(bids):
+    # {(team_id, game_name): {user: encoded bid}} from bid rows
+    game_bids = {}
+    values = {}
+    for team_id, game_name, user, option, amount, position in bids:
+        if position is None:
+            game_bids.setdefault((team_id, game_name), {})[user] = encode_bid(user, amount, option or None)
+        else:
+            values.setdefault((team_id, game_name, user), []).append((position, option, amount))
+
+    for (team_id, game_name, user), user_values in values.items():
+        user_values.sort()
+        game_bids.setdefault((team_id, game_name), {})[user] = encode_bid(
+            user, None, values=[(option, amount) for position, option, amount in user_values])
+    return game_bids
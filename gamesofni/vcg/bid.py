@@ -1,21 +1,36 @@
 from utils import VcgException
+from .codec import encode_bid, decode_bid
+
+
+MAX_VALUES = 47
+MAX_BATCH_BIDS = 25
+BATCH_SEPARATOR = ';'
 
 
 class Bid(object):
-    def __init__(self, user=None, option=None, amount=None, game_name=None):
+    # games may hold tens of thousands of bids, slots keep every one of them small
+    __slots__ = ('user', 'option', 'amount', 'game_name', 'values')
+
+    def __init__(self, user=None, option=None, amount=None, game_name=None, values=None):
         self.user = user
         self.option = option
         self.amount = amount
         self.game_name = game_name
+        # [(option, amount), ...] when the user valued several options at once
+        self.values = values
 
     def __str__(self):
-        return 'User ' + self.user + ' bid ' + str(self.amount) + self.get_options_message()
+        return self.get_bid_info()
 
     def get_bid_info(self):
+        if self.values is not None:
+            return 'User ' + self.user + ' bid ' + self.get_values_message('')
         return 'User ' + self.user + ' bid ' + str(self.amount) + \
                self.get_options_message()
 
     def get_bid_response_info(self):
+        if self.values is not None:
+            return 'you bid ' + self.get_values_message('*') + ' in game *' + self.game_name + '*'
         return 'you ' + ' bid *' + str(self.amount) + '*' + \
                self.get_options_message() + \
                ' in game *' + self.game_name + '*'
@@ -23,13 +38,20 @@ class Bid(object):
     def get_options_message(self):
         return ' for option *' + self.option + '*' if self.option else ''
 
-    def to_json_encoded(self):
-        json_bid = {'user': self.user,
-                    'amount': self.amount}
-        if self.option:
-            json_bid['option'] = self.option
+    def get_values_message(self, emphasis):
+        return ', '.join(emphasis + str(amount) + emphasis + ' for option *' + option + '*'
+                         for option, amount in self.values)
+
+    def get_values(self):
+        if self.values is not None:
+            return self.values
+        return [(self.option, self.amount)]
 
-        return str(json_bid)
+    def get_options(self):
+        return [option for option, amount in self.get_values() if option]
+
+    def to_json_encoded(self):
+        return encode_bid(self.user, self.amount, self.option, self.values)
 
     @staticmethod
     def parse_from_command(command, username):
@@ -38,6 +60,10 @@ class Bid(object):
 
         commands = command.split()
         # expected command format: game_name bid_amount [option]
+        #                      or: game_name option1:amount1 [option2:amount2 ...]
+        if len(commands) >= 2 and ':' in commands[1]:
+            return Bid.parse_values_from_command(commands, username)
+
         if len(commands) < 2 or len(commands) > 3:
             raise VcgException('not enough or too many words in command, something is wrong')
 
@@ -52,6 +78,72 @@ class Bid(object):
 
         return Bid(user=username, option=(commands[2] if with_option else None), amount=bid_amount, game_name=commands[0])
 
+    @staticmethod
+    def parse_batch_from_command(command, username):
+        # expected command format: bid [; bid ...], every bid as parse_from_command expects it
+        parts = [part for part in command.split(BATCH_SEPARATOR) if part.strip()]
+        if len(parts) <= 1:
+            return [Bid.parse_from_command(parts[0] if parts else command, username)]
+        if len(parts) > MAX_BATCH_BIDS:
+            raise VcgException('you can place at most ' + str(MAX_BATCH_BIDS) + ' bids at once')
+
+        bids = []
+        games = set()
+        for number, part in enumerate(parts, 1):
+            try:
+                bid = Bid.parse_from_command(part, username)
+            except VcgException as e:
+                raise VcgException('bid number ' + str(number) + ' (' + part.strip() + '): ' + str(e))
+            if bid.game_name in games:
+                raise VcgException('you bid in game *' + bid.game_name + '* twice')
+            games.add(bid.game_name)
+            bids.append(bid)
+        return bids
+
+    @staticmethod
+    def parse_values_from_command(commands, username):
+        if len(commands) > MAX_VALUES + 1:
+            raise VcgException('too many options in your bid, something is wrong')
+
+        values = []
+        seen = set()
+        for word in commands[1:]:
+            option, _, amount = word.rpartition(':')
+            if not option:
+                raise VcgException('every option in your bid should look like option:amount')
+            if option in seen:
+                raise VcgException('you valued option *' + option + '* twice')
+            seen.add(option)
+            try:
+                amount = int(amount)
+            except ValueError:
+                raise VcgException('your bid amount for option *' + option + '* is not an integer')
+            if amount < 0:
+                raise VcgException('you can\'t bid non-positive amounts')
+            values.append((option, amount))
+
+        return Bid(user=username, game_name=commands[0], values=values)
+
     @staticmethod
     def parse_bids(bids):
-        return [(Bid(user=bid['user'], option=bid.get('option', None), amount=bid['amount'])) for bid in bids]
+        return [Bid.parse_bid(bid) for bid in bids]
+
+    @staticmethod
+    def parse_bid(bid):
+        return Bid(user=bid['user'], option=bid.get('option', None), amount=bid.get('amount', None),
+                   values=bid.get('values', None))
+
+
+class BidStream(object):
+    # bids of a game stored as items of their own. every iteration reads them from
+    # the store again, page by page, so they are never all held in memory
+    __slots__ = ('load_bids', 'team', 'name')
+
+    def __init__(self, load_bids, team, name):
+        self.load_bids = load_bids
+        self.team = team
+        self.name = name
+
+    def __iter__(self):
+        for stored_bid in self.load_bids(self.team, self.name):
+            yield Bid.parse_bid(decode_bid(stored_bid))
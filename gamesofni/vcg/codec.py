@@ -0,0 +1,51 @@
+import ast
+import json
+
+# version 1 (legacy): bids stored as str(dict), options as json.dumps(list)
+# version 2: bids stored as native dynamodb maps, options as native lists,
+#            bids on several options keep their values as a list of [option, amount]
+BID_CODEC_VERSION = 2
+
+
+def encode_bid(user, amount, option=None, values=None):
+    json_bid = {'v': BID_CODEC_VERSION,
+                'user': user}
+    if values is not None:
+        json_bid['values'] = [[value_option, value_amount] for value_option, value_amount in values]
+        return json_bid
+
+    json_bid['amount'] = amount
+    if option:
+        json_bid['option'] = option
+    return json_bid
+
+
+def decode_bid(stored_bid):
+    if isinstance(stored_bid, dict):
+        # dynamodb numbers are read back as Decimal
+        values = stored_bid.get('values', None)
+        if values is not None:
+            return {'user': stored_bid['user'], 'values': [(option, int(amount)) for option, amount in values]}
+
+        json_bid = {'user': stored_bid['user'], 'amount': int(stored_bid['amount'])}
+        option = stored_bid.get('option', None)
+        if option:
+            json_bid['option'] = option
+        return json_bid
+    return ast.literal_eval(stored_bid)
+
+
+def decode_bids(stored_bids):
+    return [decode_bid(stored_bid) for stored_bid in stored_bids]
+
+
+def encode_options(options):
+    return list(options)
+
+
+def decode_options(stored_options):
+    if not stored_options:
+        return None
+    if isinstance(stored_options, list):
+        return stored_options
+    return json.loads(stored_options)
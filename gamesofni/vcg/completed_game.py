@@ -1,97 +1,189 @@
 import random
-from operator import attrgetter
 
+from .settlement import BidColumns, top_two, clarke_payments, multi_unit_allocation, \
+    stream_clarke_payments, stream_top_two
+from .render import render_messages, MRKDWN
+from .stats import GameStats
 
-class CompletedGame:
-    def __init__(self, game=None, option=None, winner=None, amount=None, message=None):
+
+class CompletedGame(object):
+    __slots__ = ('game', 'option', 'winner', 'amount', 'message', 'winners')
+
+    def __init__(self, game=None, option=None, winner=None, amount=None, message=None, winners=None):
         self.game = game
         self.option = option
         self.winner = winner
         self.amount = amount
         self.message = message
+        self.winners = winners
 
     def get_completed_info(self):
         return 'Game *' + self.game.name + '* just finished' + \
                ('\noption *' + self.option + '* has won' if self.option else '') + \
                ('\nwinner is *' + self.winner + '*' if self.winner else '') + \
+               ('\nwinners are *' + ', '.join(self.winners) + '*' if self.winners else '') + \
                ('\namount to pay: *' + str(self.amount) + '*' if self.amount else '') + \
                ('\n' + self.message + '\n' if self.message else '') + \
                '\nGame info: ' + self.game.get_short_info()
 
     def to_json_encoded(self):
         json_completed_game = self.game.to_json_encoded()
-        json_completed_game['id'] = self.game.team + self.game.name + str(self.game.start_date)
+        json_completed_game['id'] = CompletedGame.get_id(self.game)
         if self.winner:
             json_completed_game['winner'] = self.winner
+        if self.winners:
+            json_completed_game['winners'] = self.winners
         if self.amount:
             json_completed_game['amount'] = self.amount
+        # the outcome is archived in full, a game settled again is restored from it
+        if self.option:
+            json_completed_game['option'] = self.option
+        if self.message:
+            json_completed_game['message'] = self.message
 
         return json_completed_game
 
+    @staticmethod
+    def get_id(game):
+        return game.team + game.name + str(game.start_date)
+
+    @staticmethod
+    def parse_completed_game(game, item):
+        amount = item.get('amount', None)
+        return CompletedGame(game=game, option=item.get('option', None), winner=item.get('winner', None),
+                             amount=int(amount) if amount is not None else None, message=item.get('message', None),
+                             winners=item.get('winners', None))
+
     @staticmethod
     def get_completed_games(games):
+        # settles a whole batch, each game's bids are aggregated in one pass
         return [CompletedGame.finalize_game(game) for game in games]
 
     @staticmethod
     def finalize_game(game):
-        if not game.bids:
+        # options tied for the most go to the one listed first in the game, whichever way the
+        # game is settled
+        if game.stats is not None and not game.stats.stale and game.units == 1:
+            completed_game = CompletedGame.finalize_from_stats(game, game.stats)
+            if completed_game is not None:
+                return completed_game
+
+        if game.bid_stream is not None and game.stats is not None:
+            return CompletedGame.finalize_streamed_game(game, game.stats)
+
+        # stored bids are decoded one at a time into what settling needs, they're never all
+        # turned into Bid objects at once
+        bids_count = game.get_bids_count()
+        if bids_count == 0:
             return CompletedGame(game=game, message='No bids were made in this game, game is closed without a winner.')
 
-        if len(game.bids) == 1:
-            return CompletedGame(game=game, winner=game.bids[0].user, amount=0, option=game.bids[0].option,
+        if game.units > 1:
+            return CompletedGame.finalize_multi_unit_game(game, game.iter_bids(), bids_count)
+
+        if not game.options:
+            # the two highest bids are all a plain game needs
+            return CompletedGame.finalize_from_stats(game, GameStats(bids=bids_count,
+                                                                     top=stream_top_two(game.iter_bids())))
+
+        columns = BidColumns(game.iter_bids(), game.options)
+        first, second = top_two(columns.totals)
+        winner_option = columns.options[first]
+        if bids_count == 1:
+            return CompletedGame(game=game, winner=columns.users[0], amount=0, option=winner_option,
                                  message='There was only one bid made in this game. The winner doesn\'t pay.')
+
+        winner_amount = columns.totals[first]
+        second_amount = columns.totals[second] if second is not None else 0
+        if winner_amount == second_amount:
+            return CompletedGame(game=game, option=winner_option, message='Nobody pays')
+
+        payers = clarke_payments(columns, first)
+        if not payers:
+            return CompletedGame(game=game, option=winner_option, message='Nobody pays')
+
+        message = ''.join('user *' + payer + '* pays *' + str(amount) + '*\n' for payer, amount in payers)
+        return CompletedGame(game=game, option=winner_option, message=message)
+
+    @staticmethod
+    def finalize_from_stats(game, stats):
+        # settles from the aggregates alone where they are enough, None when the bids are needed:
+        # single bids on options, clarke payments and stale top bids
+        if stats.bids == 0:
+            return CompletedGame(game=game, message='No bids were made in this game, game is closed without a winner.')
+
         if game.options:
-            bid_options = {}
-            for bid in game.bids:
-                bid_options[bid.option] = bid_options.get(bid.option, 0) + bid.amount
-
-            option_amounts = list(bid_options.values())
-            winner_option = list(bid_options.keys())[option_amounts.index(max(option_amounts))]
-            winner_amount = bid_options[winner_option]
-            winner_bids = [bid for bid in game.bids if bid.option == winner_option]
-
-            del bid_options[winner_option]
-            option_amounts_without_winner = list(bid_options.values())
-            second_option = list(bid_options.keys())[option_amounts_without_winner.index(max(option_amounts_without_winner))]
-            second_amount = bid_options[second_option]
-
-            if winner_amount == second_amount:
-                return CompletedGame(game=game, option=winner_option, message='Nobody pays')
-
-            winner_bids.sort(key=lambda b: b.amount, reverse=True)
-            payers = {}
-            for bid in winner_bids:
-                effect = second_amount - (winner_amount - bid.amount)
-                if effect > 0:
-                    payers[bid.user] = effect
-                else:
-                    break
-
-            if len(payers.keys()) == 0:
-                return CompletedGame(game=game, option=winner_option, message='Nobody pays')
-
-            message = ''
-            for payer, amount in payers.items():
-                message += 'user *' + payer + '* pays *' + str(amount) + '*\n'
-
-            return CompletedGame(game=game, option=winner_option, message=message)
-        else:
-            winners_bid = max(game.bids, key=attrgetter('amount'))
-            bids_without_winner = filter(lambda bid: bid.user != winners_bid.user, game.bids)
-            second_bid = max(bids_without_winner, key=attrgetter('amount'))
-
-            if winners_bid.amount == second_bid.amount:
-                if bool(random.getrandbits(1)):
-                    winner_name = winners_bid.user
-                else:
-                    winner_name = second_bid.user
-                return CompletedGame(game=game, winner=winner_name, amount=second_bid.amount,
-                                     message='Two persons bid same amount, tie was broken at random.')
-
-            return CompletedGame(game=game, winner=winners_bid.user, amount=second_bid.amount)
+            if stats.bids == 1:
+                return None
+            totals = [stats.totals.get(option, 0) for option in game.options]
+            first, second = top_two(totals)
+            if second is not None and totals[first] == totals[second]:
+                return CompletedGame(game=game, option=game.options[first], message='Nobody pays')
+            return None
+
+        if stats.bids == 1:
+            return CompletedGame(game=game, winner=stats.top[0][1], amount=0,
+                                 message='There was only one bid made in this game. The winner doesn\'t pay.')
+
+        (first_amount, winner_name), (second_amount, second_name) = stats.top
+        if first_amount == second_amount:
+            if not bool(random.getrandbits(1)):
+                winner_name = second_name
+            return CompletedGame(game=game, winner=winner_name, amount=second_amount,
+                                 message='Two persons bid same amount, tie was broken at random.')
+
+        return CompletedGame(game=game, winner=winner_name, amount=second_amount)
+
+    @staticmethod
+    def finalize_streamed_game(game, stats):
+        # bids kept apart from the game are streamed past the aggregates once or twice,
+        # only the top bids and the payers are held
+        if stats.bids == 0:
+            return CompletedGame(game=game, message='No bids were made in this game, game is closed without a winner.')
+
+        if game.units > 1:
+            return CompletedGame.finalize_multi_unit_game(game, game.bid_stream, stats.bids)
+
+        if not game.options:
+            # the top two went stale, they are found again
+            stats.top = stream_top_two(game.bid_stream)
+            stats.stale = False
+            return CompletedGame.finalize_from_stats(game, stats)
+
+        totals = [stats.totals.get(option, 0) for option in game.options]
+        first, second = top_two(totals)
+        if stats.bids == 1:
+            bid = next(iter(game.bid_stream))
+            return CompletedGame(game=game, winner=bid.user, amount=0, option=game.options[first],
+                                 message='There was only one bid made in this game. The winner doesn\'t pay.')
+
+        if second is not None and totals[first] == totals[second]:
+            return CompletedGame(game=game, option=game.options[first], message='Nobody pays')
+
+        payers = stream_clarke_payments(game.bid_stream, game.options, totals, first)
+        if not payers:
+            return CompletedGame(game=game, option=game.options[first], message='Nobody pays')
+
+        message = ''.join('user *' + payer + '* pays *' + str(amount) + '*\n' for payer, amount in payers)
+        return CompletedGame(game=game, option=game.options[first], message=message)
+
+    @staticmethod
+    def finalize_multi_unit_game(game, bids, bids_count):
+        # bids may be a BidStream, it's read once for the top bids and again only for a tie
+        winners, price, tie = multi_unit_allocation(bids, game.units)
+        winners = [bid.user for bid in winners]
+        if bids_count <= game.units:
+            return CompletedGame(game=game, winners=winners, amount=0,
+                                 message='There were no more bids than units in this game. The winners don\'t pay.')
+        if tie:
+            return CompletedGame(game=game, winners=winners, amount=price,
+                                 message='Several persons bid same amount for the last units, '
+                                         'tie was broken at random. Every winner pays the amount.')
+
+        return CompletedGame(game=game, winners=winners, amount=price,
+                             message='Every winner pays the amount.')
 
     @staticmethod
-    def get_completed_games_info(completed_games):
-        if not completed_games:
-            return ''
-        return '\n\n'.join(completed_game.get_completed_info() for completed_game in completed_games) + '\n\n\n'
+    def get_completed_games_messages(completed_games, message_format=MRKDWN):
+        # slack payloads announcing the games, split into several messages when they don't fit one
+        return list(render_messages((completed_game.get_completed_info() for completed_game in completed_games),
+                                    message_format))
@@ -1,28 +1,80 @@
-import json
+import re
 import time
-import ast
 
 import utils
 from utils import VcgException
-from .bid import Bid
+from .bid import Bid, BidStream
+from .codec import decode_bid, encode_options, decode_options
+from .stats import GameStats
+from .render import render_page, MRKDWN
+
+
+UNITS_REGEX = re.compile(r'^units=(\d+)$', re.I)
+MAX_UNITS = 1000
 
 
 class Game(object):
+    __slots__ = ('team', 'name', 'creator', 'start_date', 'end_date', 'options', 'stored_bids', 'bid_stream',
+                 'parsed_bids', 'utc_offset', 'units', 'stats', 'dates_info')
+
     def __init__(self, team, name, creator, start_date,
-                 end_date, options, bids, utc_offset):
+                 end_date, options, bids, utc_offset, units=1, stats=None, stored_bids=None, bid_stream=None):
         self.team = team
         self.name = name
         self.creator = creator
         self.start_date = start_date
         self.end_date = end_date
         self.options = options
-        self.bids = Bid.parse_bids(bids) if bids else []
+        # bids read from the db are only decoded when something asks for them. games created
+        # since bids became items of their own have no stored bids, their bids are streamed
+        # from the store by bid_stream instead
+        self.stored_bids = stored_bids
+        self.bid_stream = bid_stream
+        if (stored_bids is not None or bid_stream is not None) and not bids:
+            self.parsed_bids = None
+        else:
+            self.parsed_bids = Bid.parse_bids(bids) if bids else []
         self.utc_offset = utc_offset
+        self.units = units
+        self.stats = stats
+        self.dates_info = None
+
+    @property
+    def bids(self):
+        if self.parsed_bids is None:
+            if self.stored_bids is not None:
+                self.parsed_bids = [Bid.parse_bid(decode_bid(stored_bid)) for stored_bid in self.stored_bids.values()]
+            else:
+                # reads every bid at once, settlement streams them where it can
+                self.parsed_bids = list(self.bid_stream)
+        return self.parsed_bids
+
+    @bids.setter
+    def bids(self, bids):
+        self.parsed_bids = bids
+        self.stored_bids = None
+        self.bid_stream = None
+
+    def iter_bids(self):
+        # the bids without holding them all, stored bids are decoded again on every
+        # iteration unless something already asked for the bids
+        if self.parsed_bids is not None:
+            return self.parsed_bids
+        if self.bid_stream is not None:
+            return self.bid_stream
+        stored_bids = self.stored_bids
+        return BidStream(lambda team, name: stored_bids.values(), self.team, self.name)
+
+    def get_bids_count(self):
+        # counted without decoding any bid
+        if self.parsed_bids is not None:
+            return len(self.parsed_bids)
+        if self.stored_bids is not None:
+            return len(self.stored_bids)
+        return self.stats.bids if self.stats is not None else 0
 
     def get_short_info(self):
-        message = 'Name of the game: ' + '*' + self.name + '*' \
-                  + '\nstarted on ' + utils.get_formatted_time(utils.get_local_time(self.start_date, self.utc_offset)) \
-                  + '\nends on ' + utils.get_formatted_time(utils.get_local_time(self.end_date, self.utc_offset))
+        message = 'Name of the game: ' + '*' + self.name + '*' + self.get_dates_info()
 
         message += '\n' + self.get_options_info()
 
@@ -32,54 +84,94 @@ class Game(object):
                 message += 'current bids are: ' + ', '.join(map(lambda bid: bid.get_bid_info(), self.bids))
             else:
                 message += 'there are no bids yet'
+            if self.stats is not None:
+                message += ', standings: ' + self.get_standings_info()
             message += ', game creator: ' + self.creator
 
         return message
 
+    def get_dates_info(self):
+        # formatted once per game, the dates don't change
+        if self.dates_info is None:
+            self.dates_info = \
+                '\nstarted on ' + utils.get_formatted_time(utils.get_local_time(self.start_date, self.utc_offset)) \
+                + '\nends on ' + utils.get_formatted_time(utils.get_local_time(self.end_date, self.utc_offset))
+        return self.dates_info
+
+    def get_bids_count_info(self):
+        # read from the aggregates, bids aren't decoded for it
+        if self.stats is None:
+            return ''
+        return '\nbids so far: *' + str(self.stats.bids) + '*'
+
+    def get_standings_info(self):
+        if self.stats.totals is not None:
+            return ', '.join(option + ' ' + str(self.stats.totals.get(option, 0)) for option in self.options or [])
+        return ', '.join(user + ' ' + str(amount) for amount, user in self.stats.top) + \
+               (' (stale)' if self.stats.stale else '')
+
     def get_options_info(self):
         if self.options:
             return 'options to vote for: ' + '*' + ', '.join(self.options) + '*'
+        elif self.units > 1:
+            return 'voting for this game is *without options*, *' + str(self.units) + '* units go to the top bids'
         else:
             return 'voting for this game is *without options*'
 
     def to_json_encoded(self):
-        bids = {bid.user: bid.to_json_encoded() for bid in self.bids} if self.bids else {}
         json_game = {'team_id': self.team,
                      'name': self.name,
                      'creator': self.creator,
                      'start_date': self.start_date,
                      'end_date': self.end_date,
-                     'bids': bids,
                      'utc_offset': self.utc_offset
                      }
+        # streamed bids stay items of their own, the store moves them along with the game
+        if self.bid_stream is None:
+            if self.parsed_bids is None:
+                # never decoded, stored bids are passed through as they are
+                json_game['bids'] = dict(self.stored_bids)
+            elif self.parsed_bids or self.stored_bids is not None:
+                json_game['bids'] = {bid.user: bid.to_json_encoded() for bid in self.parsed_bids}
         if self.options:
-            json_game['options'] = json.dumps(self.options)
+            json_game['options'] = encode_options(self.options)
+        if self.units > 1:
+            json_game['units'] = self.units
+        if self.stats is not None:
+            json_game['stats'] = self.stats.encode()
         return json_game
 
     @staticmethod
-    def get_active_db_games_info(db_games):
-        now = int(time.time())
-        return '\n\n'.join([Game.parse_game(db_game).get_short_info() for db_game in db_games
-                            if Game.parse_game(db_game).end_date > now]) + '\n\n'
-
-    @staticmethod
-    def get_active_games_info(db_games):
-        if not db_games:
-            return 'There are no games in progress.'
-        games_info = ''
-        now = int(time.time())
+    def iter_active_games(db_games, now):
+        # every game is parsed exactly once, and only when it's reached
         for db_game in db_games:
             game = Game.parse_game(db_game)
             if game.end_date > now:
-                games_info += game.get_short_info() + '\n\n'
-        return 'Games in progress are:\n' + games_info
+                yield game
 
     @staticmethod
-    def parse_game(db_game):
-        bids = list(db_game['bids'].values())
-        options = db_game.get('options', None)
-        if options:
-            options = ast.literal_eval(options)
+    def get_active_db_games_info(db_games):
+        return '\n\n'.join(game.get_short_info()
+                           for game in Game.iter_active_games(db_games, int(time.time()))) + '\n\n'
+
+    @staticmethod
+    def get_active_games_info(db_games, page=1, message_format=MRKDWN, next_page_info=None):
+        # returns the slack payload of one page of games in progress
+        sections = (game.get_short_info() + game.get_bids_count_info()
+                    for game in Game.iter_active_games(db_games, int(time.time())))
+        payload = render_page(sections, page, message_format, header='Games in progress are:',
+                              next_page_info=next_page_info)
+        if payload is None:
+            if page == 1:
+                return {'text': 'There are no games in progress.'}
+            return {'text': 'There is no page ' + str(page) + ' of games in progress.'}
+        return payload
+
+    @staticmethod
+    def parse_game(db_game, load_bids=None):
+        # load_bids(team_id, name) streams the stored bids of games that keep them apart
+        options = decode_options(db_game.get('options', None))
+        stored_bids = db_game.get('bids', None)
         return Game(
             team=db_game['team_id'],
             name=db_game['name'],
@@ -87,8 +179,13 @@ class Game(object):
             start_date=db_game['start_date'],
             end_date=db_game['end_date'],
             options=options,
-            bids=map(ast.literal_eval, bids) if bids else [],
-            utc_offset=db_game['utc_offset']
+            bids=None,
+            utc_offset=db_game['utc_offset'],
+            units=int(db_game.get('units', 1)),
+            stats=GameStats.decode(db_game.get('stats', None)),
+            stored_bids=stored_bids,
+            bid_stream=BidStream(load_bids, db_game['team_id'], db_game['name'])
+            if stored_bids is None and load_bids is not None else None
         )
 
     @staticmethod
@@ -96,7 +193,7 @@ class Game(object):
         if not username:
             raise VcgException('empty username, how come 0_o')
 
-        # expected command format: game_name end_time(DD-MM-YY HH:MM) [option1 option2....]
+        # expected command format: game_name end_time(DD-MM-YY HH:MM) [units=K | option1 option2....]
         commands = command.split()
         if len(commands) < 3 or len(commands) > 50:
             raise VcgException('not enough or too many words in command, something is wrong')
@@ -112,14 +209,27 @@ class Game(object):
         if start_date > game_end_time_utc:
             raise VcgException('end time of your game seems to be in the past')
 
-        with_options = len(commands) > 3
+        units = 1
+        options = commands[3:]
+        if options:
+            units_match = UNITS_REGEX.match(options[0])
+            if units_match:
+                if len(options) > 1:
+                    raise VcgException('games with several units can\'t have options')
+                units = int(units_match.group(1))
+                if units < 1 or units > MAX_UNITS:
+                    raise VcgException('number of units should be between 1 and ' + str(MAX_UNITS))
+                options = []
+
         return Game(
             team=team,
             name=commands[0],
             creator=username,
             start_date=start_date,
             end_date=game_end_time_utc,
-            options=commands[3:] if with_options else None,
+            options=options if options else None,
             bids=[],
-            utc_offset=utc_offset
+            utc_offset=utc_offset,
+            units=units,
+            stats=GameStats.new(options)
         )
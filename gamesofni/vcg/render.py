@@ -0,0 +1,68 @@
+from itertools import islice
+
+# slack truncates message text past 4000 characters and rejects block kit messages with more
+# than 50 blocks or section texts past 3000 characters
+MAX_MESSAGE_CHARS = 3800
+MAX_BLOCKS = 50
+MAX_SECTION_CHARS = 3000
+# room left in every page for its header and footer
+FRAME_CHARS = 300
+
+MRKDWN = 'mrkdwn'
+BLOCKS = 'blocks'
+
+SEPARATOR = '\n\n'
+ELLIPSIS = '\n...'
+
+
+def truncate(text, max_chars):
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars - len(ELLIPSIS)] + ELLIPSIS
+
+
+def split_sections(sections, max_chars=MAX_MESSAGE_CHARS, max_sections=MAX_BLOCKS):
+    # streams sections into pages, a page is yielded as soon as the next section wouldn't fit,
+    # so only one page is held at a time no matter how many sections there are
+    page = []
+    size = 0
+    for section in sections:
+        section = truncate(section, min(max_chars, MAX_SECTION_CHARS))
+        if page and (size + len(SEPARATOR) + len(section) > max_chars or len(page) == max_sections):
+            yield page
+            page = []
+            size = 0
+        size += (len(SEPARATOR) if page else 0) + len(section)
+        page.append(section)
+    if page:
+        yield page
+
+
+def to_payload(sections, message_format, context=None):
+    # context is a small trailing note, e.g. how to get the next page
+    if message_format == BLOCKS:
+        blocks = [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': section}} for section in sections]
+        if context:
+            blocks.append({'type': 'context', 'elements': [{'type': 'mrkdwn', 'text': context}]})
+        # text is only shown in notifications when blocks are present
+        return {'text': truncate(sections[0], MAX_SECTION_CHARS), 'blocks': blocks}
+    return {'text': SEPARATOR.join(sections + [context] if context else sections)}
+
+
+def render_messages(sections, message_format=MRKDWN, header=None):
+    # yields as many payloads as it takes to fit every section, each within slack's limits
+    for page in split_sections(sections, MAX_MESSAGE_CHARS - FRAME_CHARS, MAX_BLOCKS - 2):
+        yield to_payload([header] + page if header else page, message_format)
+
+
+def render_page(sections, page_number, message_format=MRKDWN, header=None, next_page_info=None):
+    # payload of the page_number-th page (from 1) of sections or None past the last page,
+    # next_page_info(page_number + 1) is added when there are more pages
+    pages = split_sections(sections, MAX_MESSAGE_CHARS - FRAME_CHARS, MAX_BLOCKS - 2)
+    current = next(islice(pages, page_number - 1, None), None)
+    if current is None:
+        return None
+    context = None
+    if next_page_info is not None and next(pages, None) is not None:
+        context = next_page_info(page_number + 1)
+    return to_payload([header] + current if header else current, message_format, context)
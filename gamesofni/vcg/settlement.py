@@ -0,0 +1,150 @@
+import heapq
+import random
+from array import array
+from operator import attrgetter
+
+
+class BidColumns(object):
+    # sparse users x options matrix of a game's bids, built in a single pass:
+    # parallel user/amount/option-id arrays with one entry per (bid, option) value,
+    # per-option totals (column sums) and where every bid's entries start (rows).
+    # option ids and row starts are machine integers rather than python objects,
+    # amounts stay python ints since bids aren't bounded to 64 bits
+    __slots__ = ('users', 'amounts', 'option_ids', 'options', 'totals', 'row_starts', 'ids')
+
+    def __init__(self, bids, options=None):
+        self.users = []
+        self.amounts = []
+        self.option_ids = array('l')
+        self.options = []
+        self.totals = []
+        self.row_starts = array('l')
+
+        # the game's options take the first ids, options tied for the most are decided by
+        # their order in the game like on the other paths. options nobody supported still
+        # compete with a total of 0
+        self.ids = {}
+        for option in options or []:
+            self.get_option_id(option)
+        for bid in bids:
+            self.row_starts.append(len(self.amounts))
+            for option, amount in bid.get_values():
+                option_id = self.get_option_id(option)
+                self.users.append(bid.user)
+                self.amounts.append(amount)
+                self.option_ids.append(option_id)
+                self.totals[option_id] += amount
+
+    def get_option_id(self, option):
+        option_id = self.ids.get(option)
+        if option_id is None:
+            option_id = self.ids[option] = len(self.options)
+            self.options.append(option)
+            self.totals.append(0)
+        return option_id
+
+    def __len__(self):
+        return len(self.amounts)
+
+    def iter_rows(self):
+        # (start, end) of the entries of every bid
+        start = None
+        for next_start in self.row_starts:
+            if start is not None:
+                yield start, next_start
+            start = next_start
+        if start is not None:
+            yield start, len(self.amounts)
+
+
+def top_two(values):
+    # indexes of the largest and second largest values, first occurrence wins ties;
+    # second index is None when there is only one value
+    first = second = None
+    for i, value in enumerate(values):
+        if first is None or value > values[first]:
+            first, second = i, first
+        elif second is None or value > values[second]:
+            second = i
+    return first, second
+
+
+def clarke_payments(columns, winner):
+    # every bidder pays the welfare the others lose because of them:
+    #   max over options o of (total_o - value_io) - (total_winner - value_i,winner)
+    # options the bidder didn't value contribute their plain total, so the best of
+    # those is found walking the options by total, skipping at most the bidder's own ones
+    by_total = sorted(range(len(columns.totals)), key=lambda o: columns.totals[o], reverse=True)
+
+    payers = []
+    for start, end in columns.iter_rows():
+        values = {}
+        for entry in range(start, end):
+            values[columns.option_ids[entry]] = columns.amounts[entry]
+
+        payment = get_payment(values, columns.totals, by_total, winner)
+        if payment > 0:
+            payers.append((columns.users[start], payment))
+
+    payers.sort(key=lambda payer: payer[1], reverse=True)
+    return payers
+
+
+def stream_clarke_payments(bids, options, totals, winner):
+    # clarke_payments in a single pass over bids, for when every option's total is known
+    # up front. totals and winner are indexed like options
+    by_total = sorted(range(len(totals)), key=lambda o: totals[o], reverse=True)
+    option_ids = dict((option, o) for o, option in enumerate(options))
+
+    payers = []
+    for bid in bids:
+        values = dict((option_ids[option], amount) for option, amount in bid.get_values() if option in option_ids)
+        if not values:
+            continue
+        payment = get_payment(values, totals, by_total, winner)
+        if payment > 0:
+            payers.append((bid.user, payment))
+
+    payers.sort(key=lambda payer: payer[1], reverse=True)
+    return payers
+
+
+def get_payment(values, totals, by_total, winner):
+    # values are the bidder's {option id: amount}
+    best_without = max(totals[o] - value for o, value in values.items())
+    for o in by_total:
+        if o not in values:
+            best_without = max(best_without, totals[o])
+            break
+    return best_without - (totals[winner] - values.get(winner, 0))
+
+
+def stream_top_two(bids):
+    # [amount, user] of the two highest plain bids in a single pass, highest first,
+    # the earlier bid wins ties like top_two does
+    top = []
+    for bid in bids:
+        if not top or bid.amount > top[0][0]:
+            top.insert(0, [bid.amount, bid.user])
+        elif len(top) == 1 or bid.amount > top[1][0]:
+            top.insert(1, [bid.amount, bid.user])
+        del top[2:]
+    return top
+
+
+def multi_unit_allocation(bids, units):
+    # k identical units for unit-demand bidders: the top k bids win and each
+    # winner's externality is the best losing bid, so all of them pay it.
+    # returns winning bids, price and whether a tie at the boundary was broken at random
+    top = heapq.nlargest(units + 1, bids, key=attrgetter('amount'))
+    if len(top) <= units:
+        return top, 0, False
+
+    price = top[units].amount
+    if top[units - 1].amount > price:
+        return top[:units], price, False
+
+    winners = [bid for bid in top[:units] if bid.amount > price]
+    tied = [bid for bid in bids if bid.amount == price]
+    winners += random.sample(tied, units - len(winners))
+    return winners, price, True
@@ -0,0 +1,71 @@
+class GameStats(object):
+    # running aggregates of a game's bids, updated together with every bid so that
+    # most games settle without decoding their bids:
+    #   bids   - number of bidders
+    #   totals - sum of amounts per option, games with options only
+    #   top    - the two highest plain bids as [amount, user], highest first
+    #   stale  - top can't be trusted anymore, a top bidder lowered their bid
+    #   version - increases with every change, writers compare and swap on it
+    __slots__ = ('version', 'bids', 'totals', 'top', 'stale')
+
+    def __init__(self, version=0, bids=0, totals=None, top=None, stale=False):
+        self.version = version
+        self.bids = bids
+        self.totals = totals
+        self.top = top if top is not None else []
+        self.stale = stale
+
+    @staticmethod
+    def new(options):
+        return GameStats(totals=dict((option, 0) for option in options) if options else None)
+
+    def get_floor(self):
+        # a new plain bid below or equal to this can't change the top two
+        return self.top[1][0] if len(self.top) == 2 else -1
+
+    def replace_bid(self, bid, old_bid=None):
+        self.version += 1
+        if old_bid is None:
+            self.bids += 1
+
+        if self.totals is not None:
+            for option, amount in old_bid.get_values() if old_bid is not None else []:
+                if option in self.totals:
+                    self.totals[option] -= amount
+            for option, amount in bid.get_values():
+                if option:
+                    self.totals[option] = self.totals.get(option, 0) + amount
+            return
+
+        top = [entry for entry in self.top if entry[1] != bid.user]
+        if len(top) < len(self.top) and old_bid is not None and bid.amount < old_bid.amount \
+                and self.bids > len(self.top):
+            # a bidder outside the top two may be ahead of the lowered bid now
+            self.stale = True
+        top.append([bid.amount, bid.user])
+        # sort is stable, earlier top bids stay ahead of equal new ones
+        top.sort(key=lambda entry: entry[0], reverse=True)
+        self.top = top[:2]
+
+    def encode(self):
+        stored = {'version': self.version,
+                  'bids': self.bids,
+                  'top': [[amount, user] for amount, user in self.top],
+                  'floor': self.get_floor(),
+                  'stale': self.stale}
+        if self.totals is not None:
+            stored['totals'] = dict(self.totals)
+        return stored
+
+    @staticmethod
+    def decode(stored):
+        if not stored:
+            return None
+        # dynamodb numbers are read back as Decimal
+        totals = stored.get('totals', None)
+        return GameStats(version=int(stored['version']),
+                         bids=int(stored['bids']),
+                         totals=dict((option, int(total)) for option, total in totals.items())
+                         if totals is not None else None,
+                         top=[[int(amount), user] for amount, user in stored.get('top', [])],
+                         stale=bool(stored.get('stale', False)))
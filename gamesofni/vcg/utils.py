@@ -1,19 +1,60 @@
-import time
+import calendar
 import datetime
+import re
+import time
+
+# iana zones come from zoneinfo (python 3.9+) or pytz, without either only utc offsets work
+try:
+    from zoneinfo import ZoneInfo as get_zone
+
+    def localize(zone, local_datetime):
+        return local_datetime.replace(tzinfo=zone)
+except ImportError:
+    try:
+        from pytz import timezone as get_zone
+
+        def localize(zone, local_datetime):
+            return zone.localize(local_datetime)
+    except ImportError:
+        get_zone = None
+        localize = None
 
 
 DEBUGGING = False
 
+EVENT_TIME_REGEX = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z$')
+DATE_REGEX = re.compile(r'^(\d\d?)-(\d\d?)-(\d\d?) (\d\d?):(\d\d?)$')
+# stored offsets: '+3', '-10', '0', '+5:30', or an iana zone name
+OFFSET_REGEX = re.compile(r'^([+-]?)(\d\d?)(?::(\d\d))?$')
+MAX_OFFSET_SECONDS = 14 * 60 * 60
+
+zones = {}  # stored offset -> Zone
+
 
 def get_unix_time_of_event(event):
     # scheduled format
-    return str(int(time.mktime(datetime.datetime.strptime(
-        event.get('time'), '%Y-%m-%dT%H:%M:%SZ').timetuple())))
+    match = EVENT_TIME_REGEX.match(event.get('time'))
+    if not match:
+        raise ValueError('unexpected event time ' + str(event.get('time')))
+    return str(to_unix_time(*[int(field) for field in match.groups()]))
 
 
 def get_unix_time_from_date(date):
-    # create_game command format
-    return str(int(time.mktime(datetime.datetime.strptime(date, '%d-%m-%y %H:%M').timetuple())))
+    # create_game command format DD-MM-YY HH:MM, read as if it was utc
+    match = DATE_REGEX.match(date)
+    if not match:
+        raise ValueError('unexpected date ' + date)
+    day, month, year, hour, minute = [int(field) for field in match.groups()]
+    # same century pivot as strptime's %y
+    year += 1900 if year >= 69 else 2000
+    return str(to_unix_time(year, month, day, hour, minute, 0))
+
+
+def to_unix_time(year, month, day, hour, minute, second):
+    if not 1 <= month <= 12 or not 1 <= day <= calendar.monthrange(year, month)[1] \
+            or hour > 23 or minute > 59 or second > 59:
+        raise ValueError('date out of range')
+    return calendar.timegm((year, month, day, hour, minute, second))
 
 
 def get_formatted_time(unix_time):
@@ -21,13 +62,76 @@ def get_formatted_time(unix_time):
 
 
 def get_utc_time(timestamp, offset):
-    offset_seconds = int(offset) * 60 * 60
-    return timestamp - offset_seconds
+    # timestamp is a local time read as if it was utc
+    return timestamp - get_timezone(offset).get_offset_of_local(timestamp)
 
 
 def get_local_time(timestamp, offset):
-    offset_seconds = int(offset) * 60 * 60
-    return timestamp + offset_seconds
+    return timestamp + get_timezone(offset).get_offset_of_utc(timestamp)
+
+
+def get_timezone(offset):
+    # zones are parsed once per stored offset, iana zone objects are loaded once
+    key = str(offset)
+    zone = zones.get(key, None)
+    if zone is None:
+        zone = parse_timezone(key)
+        zones[key] = zone
+    return zone
+
+
+def parse_timezone(offset):
+    match = OFFSET_REGEX.match(offset)
+    if match:
+        sign, hours, minutes = match.groups()
+        seconds = int(hours) * 60 * 60 + int(minutes or 0) * 60
+        if int(minutes or 0) > 59 or seconds > MAX_OFFSET_SECONDS:
+            raise VcgException('utc offset ' + offset + ' is out of range')
+        return FixedZone(-seconds if sign == '-' else seconds)
+
+    if get_zone is None:
+        raise VcgException('timezone names like ' + offset + ' are not supported here, use utc offsets instead')
+    try:
+        return NamedZone(get_zone(offset))
+    except Exception:
+        raise VcgException('unknown timezone ' + offset)
+
+
+def get_timezone_info(offset):
+    zone = get_timezone(offset)
+    if isinstance(zone, NamedZone):
+        return str(offset)
+    sign = '-' if zone.seconds < 0 else '+'
+    hours, minutes = divmod(abs(zone.seconds) // 60, 60)
+    return 'utc' + sign + str(hours) + (':%02d' % minutes if minutes else '')
+
+
+class FixedZone(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def get_offset_of_utc(self, timestamp):
+        return self.seconds
+
+    def get_offset_of_local(self, timestamp):
+        return self.seconds
+
+
+class NamedZone(object):
+    # offsets change with daylight saving time, they are looked up for every timestamp
+    def __init__(self, zone):
+        self.zone = zone
+
+    def get_offset_of_utc(self, timestamp):
+        return to_seconds(datetime.datetime.fromtimestamp(timestamp, self.zone).utcoffset())
+
+    def get_offset_of_local(self, timestamp):
+        local_datetime = datetime.datetime.utcfromtimestamp(timestamp)
+        return to_seconds(localize(self.zone, local_datetime).utcoffset())
+
+
+def to_seconds(delta):
+    return delta.days * 24 * 60 * 60 + delta.seconds
 
 
 class VcgException(Exception):
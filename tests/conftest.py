@@ -0,0 +1,14 @@
+# run from the repository root with python 2.7: python -m pytest tests
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+for directory in ('gamesofni', 'benchmarks'):
+    path = os.path.join(ROOT_DIR, directory)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# the handler modules import config, the stand-in one is used unless a real one is on the path
+import fakes  # noqa: E402
+
+fakes.install_config()
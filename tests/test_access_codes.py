@@ -0,0 +1,25 @@
+import logging
+
+import data
+import fakes
+import scheduled
+from metrics import metrics
+
+logger = logging.getLogger()
+
+
+def test_webhook_cache_counts_are_per_call():
+    import storage
+    fakes.install()
+    storage = storage.get_storage()
+    teams = ['T1', 'T2', 'T3']
+    for team in teams:
+        data.add_team(storage, team)
+
+    for attempt in range(3):
+        metrics.start('scheduled', 'request%d' % attempt)
+        urls = scheduled.get_access_codes(teams, storage, logger)
+        assert sorted(urls) == teams
+        # the first call reads every team, the ones after find them all in the cache
+        assert metrics.counters['webhook_cache_misses'] == (len(teams) if attempt == 0 else 0)
+        assert metrics.counters['webhook_cache_hits'] == (0 if attempt == 0 else len(teams))
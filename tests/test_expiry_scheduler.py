@@ -0,0 +1,101 @@
+import json
+import random
+import threading
+import time
+
+import pytest
+
+import data
+import fakes
+from expiry_scheduler import ExpiryScheduler
+
+TIMEOUT_SECONDS = 10
+
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def backend(request, tmpdir):
+    # (storage, webhook session, dynamodb stand-in or None)
+    if request.param == 'sqlite':
+        storage, session = fakes.install_sqlite(str(tmpdir.join('games.db')))
+        return storage, session, None
+    import storage
+    resource, session = fakes.install()
+    return storage.get_storage(), session, resource
+
+
+def wait_for(condition):
+    deadline = time.time() + TIMEOUT_SECONDS
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def count_queries(storage):
+    queried = []
+    get_games_ending_before = storage.get_games_ending_before
+
+    def counted(end_date):
+        queried.append(end_date)
+        return get_games_ending_before(end_date)
+    storage.get_games_ending_before = counted
+    return queried
+
+
+def test_created_games_are_settled_by_key(backend):
+    storage, session, resource = backend
+    data.add_team(storage, 'T1')
+    queried = count_queries(storage)
+    scheduler = ExpiryScheduler(storage, horizon_seconds=60, refresh_seconds=0.2, reconcile_seconds=60)
+    runner = threading.Thread(target=scheduler.run)
+    runner.start()
+    try:
+        if resource is not None:
+            # games created before the stream is read from are left to the next reconciliation
+            wait_for(lambda: resource.calls['get_shard_iterator'] > 0)
+        storage.create_game(data.make_db_game('T1', 'game', 3, 0, int(time.time()) + 1, random.Random(0)))
+        wait_for(lambda: session.posts)
+    finally:
+        scheduler.stop()
+        runner.join()
+
+    assert storage.get_game('T1', 'game') is None
+    assert 'Game *game*' in json.loads(session.posts[0][1])['text']
+    if resource is not None:
+        # the game came from the stream, the index was queried only when the scheduler started
+        assert scheduler.watching
+        assert len(queried) == 1
+        assert resource.calls['scan'] == 0
+    else:
+        # sqlite has no feed of created games and is queried every refresh_seconds
+        assert not scheduler.watching
+        assert len(queried) > 1
+
+
+def test_games_ending_past_the_loaded_horizon_wait_for_the_store(backend):
+    storage, session, resource = backend
+    scheduler = ExpiryScheduler(storage, horizon_seconds=60, refresh_seconds=5, reconcile_seconds=60)
+    # as if following the created games, the store was read up to 1000 + 60 + 60
+    scheduler.watching = True
+    scheduler.refresh(1000)
+    scheduler.add_created_game('T1', 'soon', 1100)
+    scheduler.add_created_game('T1', 'later', 1200)
+    assert scheduler.pop_due(1300) == [('T1', 'soon')]
+
+
+def test_failed_settlements_are_due_again(backend, monkeypatch):
+    storage, session, resource = backend
+    data.add_team(storage, 'T1')
+    storage.create_game(data.make_db_game('T1', 'game', 3, 0, int(time.time()) - 10, random.Random(0)))
+
+    def fail(*args):
+        raise RuntimeError('settling failed')
+    monkeypatch.setattr('expiry_scheduler.settle_due_games', fail)
+    scheduler = ExpiryScheduler(storage)
+    scheduler.refresh(time.time())
+    keys = scheduler.pop_due(time.time())
+    assert keys == [('T1', 'game')]
+    scheduler.settle(keys)
+
+    assert scheduler.pop_due(time.time()) == []
+    assert scheduler.pop_due(time.time() + 60) == [('T1', 'game')]
+    assert storage.get_game('T1', 'game') is not None
@@ -0,0 +1,177 @@
+import json
+import logging
+import threading
+import time
+
+import pytest
+
+import config
+import data
+import fakes
+import scheduled
+from storage.base import OUTCOME_FIELDS
+from vcg.completed_game import CompletedGame
+
+logger = logging.getLogger()
+
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def backend(request, tmpdir):
+    # (storage, webhook session) with 3 teams of 10 games each that ended a minute ago
+    if request.param == 'sqlite':
+        storage, session = fakes.install_sqlite(str(tmpdir.join('games.db')))
+    else:
+        import storage
+        resource, session = fakes.install()
+        storage = storage.get_storage()
+    games = data.populate(storage, teams=3, games_per_team=10, bids_per_game=4, options_per_game=2, ended=True)
+    return storage, session, games
+
+
+def notified_games(session):
+    # 'url Game *name*' of every game the teams were told about
+    return [url + ' ' + line for url, body in session.posts for line in json.loads(body)['text'].split('\n')
+            if line.startswith('Game *')]
+
+
+def get_game_ids(storage, games):
+    # the ids the games are archived under, see CompletedGame.get_id
+    return [team_id + name + str(storage.get_game(team_id, name)['start_date']) for team_id, name in games]
+
+
+def crash(*args):
+    raise RuntimeError('scheduler stopped')
+
+
+def test_a_lease_keeps_other_owners_out_until_it_expires(backend):
+    storage, session, games = backend
+    now = int(time.time())
+    assert storage.claim_games(games, 'a', now, now + 60) == dict((key, False) for key in games)
+    assert storage.claim_games(games, 'b', now, now + 60) == {}
+    # the owner may renew its own lease
+    assert storage.claim_games(games[:2], 'a', now, now + 120) == dict((key, False) for key in games[:2])
+
+    # leases that ran out are taken over and reported as leased before
+    assert storage.claim_games(games[:2], 'b', now + 121, now + 180) == dict((key, True) for key in games[:2])
+    assert storage.claim_games(games[2:4], 'b', now + 61, now + 180) == dict((key, True) for key in games[2:4])
+    assert storage.claim_games(games[:4], 'a', now + 150, now + 200) == {}
+
+
+def test_a_running_scheduler_keeps_its_games(backend, monkeypatch):
+    storage, session, games = backend
+    # the first scheduler archives the games and stops before telling the teams
+    monkeypatch.setattr(scheduled, 'notify_teams', crash)
+    with pytest.raises(RuntimeError):
+        scheduled.settle_completed_games(storage, logger)
+    monkeypatch.undo()
+
+    # for all the next one knows it's still going
+    assert scheduled.settle_completed_games(storage, logger) == 0
+    assert session.posts == []
+
+
+def test_games_already_settled_are_not_claimed(backend):
+    storage, session, games = backend
+    storage.delete_games(games[:3])
+    now = int(time.time())
+    assert sorted(storage.claim_games(games[:5], 'a', now, now + 60)) == sorted(games[3:5])
+
+
+def test_racing_schedulers_settle_every_game_once(backend):
+    storage, session, games = backend
+    settled = []
+    threads = [threading.Thread(target=lambda: settled.append(scheduled.settle_completed_games(storage, logger)))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(settled) == len(games)
+    names = notified_games(session)
+    assert len(names) == len(games)
+    assert len(set(names)) == len(games)
+    assert next(storage.get_completed_games(int(time.time()))) == []
+
+
+def test_due_games_leased_by_another_scheduler_are_left_to_it(backend):
+    storage, session, games = backend
+    now = int(time.time())
+    storage.claim_games(games[:5], 'other', now, now + 60)
+
+    assert scheduled.settle_due_games(storage, logger, games[:10]) == 5
+    assert storage.get_games(games[:5]) != []
+    assert storage.get_games(games[5:10]) == []
+    assert scheduled.settle_due_games(storage, logger, games[:5]) == 0
+
+
+def test_an_expired_lease_restores_the_archived_outcome_without_settling_again(backend, monkeypatch):
+    storage, session, games = backend
+    ids = get_game_ids(storage, games)
+    # the first scheduler archives the games and stops before telling the teams, its leases
+    # have run out by the time the next one starts
+    monkeypatch.setattr(config, 'settle_lease_seconds', -5, raising=False)
+    with monkeypatch.context() as patched:
+        patched.setattr(scheduled, 'notify_teams', crash)
+        with pytest.raises(RuntimeError):
+            scheduled.settle_completed_games(storage, logger)
+    archived = storage.get_archived_games(ids)
+    assert sorted(archived) == sorted(ids)
+    assert not any(item.get('notified', False) for item in archived.values())
+
+    # a game can't be settled again, some of its bids may be gone by now
+    settle_again = []
+
+    def settle(games):
+        settle_again.extend(games)
+        return []
+    monkeypatch.setattr(CompletedGame, 'finalize_game', staticmethod(lambda game: settle([game])))
+    monkeypatch.setattr(CompletedGame, 'get_completed_games', staticmethod(settle))
+    assert scheduled.settle_completed_games(storage, logger) == len(games)
+    assert settle_again == []
+
+    names = notified_games(session)
+    assert len(names) == len(games)
+    assert len(set(names)) == len(games)
+    for item in storage.get_archived_games(ids).values():
+        assert item['notified']
+        for field in OUTCOME_FIELDS:
+            if field != 'notified':
+                assert item.get(field, None) == archived[item['id']].get(field, None)
+
+
+def test_games_already_notified_are_deleted_without_telling_the_teams_again(backend, monkeypatch):
+    storage, session, games = backend
+    ids = get_game_ids(storage, games)
+    # the first scheduler tells the teams and stops before deleting the games
+    monkeypatch.setattr(config, 'settle_lease_seconds', -5, raising=False)
+    with monkeypatch.context() as patched:
+        patched.setattr(storage, 'delete_games', crash)
+        with pytest.raises(RuntimeError):
+            scheduled.settle_completed_games(storage, logger)
+    assert len(notified_games(session)) == len(games)
+    assert all(item['notified'] for item in storage.get_archived_games(ids).values())
+
+    assert scheduled.settle_completed_games(storage, logger) == len(games)
+    assert len(notified_games(session)) == len(games)
+    assert next(storage.get_completed_games(int(time.time()))) == []
+
+
+def test_only_the_teams_not_told_before_are_notified(backend, monkeypatch):
+    storage, session, games = backend
+    # one team's webhook failed, its games are left unnotified
+    notify_teams = scheduled.notify_teams
+
+    def notify_all_but_one(team_messages, team2url, logger):
+        return [team for team in notify_teams(team_messages, team2url, logger) if team != 'T00000']
+    monkeypatch.setattr(config, 'settle_lease_seconds', -5, raising=False)
+    with monkeypatch.context() as patched:
+        patched.setattr(scheduled, 'notify_teams', notify_all_but_one)
+        patched.setattr(storage, 'delete_games', crash)
+        with pytest.raises(RuntimeError):
+            scheduled.settle_completed_games(storage, logger)
+    first_posts = len(session.posts)
+
+    assert scheduled.settle_completed_games(storage, logger) == len(games)
+    assert [url for url, body in session.posts[first_posts:]] == ['https://hooks.example/T00000']
+    assert next(storage.get_completed_games(int(time.time()))) == []
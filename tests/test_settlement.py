@@ -0,0 +1,308 @@
+import random
+import re
+from operator import attrgetter
+
+import pytest
+
+from vcg.bid import Bid, BidStream
+from vcg.completed_game import CompletedGame
+from vcg.game import Game
+from vcg.stats import GameStats
+
+OPTIONS = ['red', 'green', 'blue', 'black']
+PAYMENT_REGEX = re.compile(r'^user \*(.+)\* pays \*(\d+)\*$')
+
+
+def make_game(bids, options=None, units=1, source='stored'):
+    # the same bids as a game read with a bids map (stored), with a bids map and its aggregates
+    # (stats) or with its bids as items of their own streamed past the aggregates (streamed)
+    stored_bids = dict((bid.user, bid.to_json_encoded()) for bid in bids)
+    stats = None
+    if source != 'stored':
+        stats = GameStats.new(options)
+        for bid in bids:
+            stats.replace_bid(bid)
+    encoded = list(stored_bids.values())
+    return Game(team='T1', name='game', creator='creator', start_date=0, end_date=1, options=options, bids=None,
+                utc_offset='0', units=units, stats=stats,
+                stored_bids=stored_bids if source != 'streamed' else None,
+                bid_stream=BidStream(lambda team, name: encoded, 'T1', 'game') if source == 'streamed' else None)
+
+
+def get_payments(completed_game):
+    payments = {}
+    for line in (completed_game.message or '').splitlines():
+        match = PAYMENT_REGEX.match(line)
+        if match:
+            payments[match.group(1)] = int(match.group(2))
+    return payments
+
+
+def get_outcome(completed_game):
+    return (completed_game.option, completed_game.winner, completed_game.amount, completed_game.message,
+            completed_game.winners)
+
+
+def baseline_option_game(bids):
+    # the settlement of single option games before the column aggregates, returns
+    # (winning option, {user: payment}) or (winning option, None) when nobody pays
+    bid_options = {}
+    for bid in bids:
+        bid_options[bid.option] = bid_options.get(bid.option, 0) + bid.amount
+
+    winner_option = max(bid_options, key=lambda option: bid_options[option])
+    winner_amount = bid_options.pop(winner_option)
+    second_amount = max(bid_options.values())
+    if winner_amount == second_amount:
+        return winner_option, None
+
+    payers = {}
+    for bid in sorted((bid for bid in bids if bid.option == winner_option), key=attrgetter('amount'), reverse=True):
+        effect = second_amount - (winner_amount - bid.amount)
+        if effect <= 0:
+            break
+        payers[bid.user] = effect
+    return winner_option, payers or None
+
+
+def baseline_plain_game(bids):
+    # (winner candidates, amount) of a plain game before the column aggregates
+    winners_bid = max(bids, key=attrgetter('amount'))
+    second_bid = max((bid for bid in bids if bid.user != winners_bid.user), key=attrgetter('amount'))
+    if winners_bid.amount == second_bid.amount:
+        return set([winners_bid.user, second_bid.user]), second_bid.amount
+    return set([winners_bid.user]), second_bid.amount
+
+
+def brute_force_clarke(bids, options):
+    # the welfare maximizing option and what every bidder's presence costs the others
+    totals = dict((option, 0) for option in options)
+    for bid in bids:
+        for option, amount in bid.get_values():
+            totals[option] += amount
+    winner = max(options, key=lambda option: totals[option])
+
+    payments = {}
+    for bid in bids:
+        others = dict(totals)
+        for option, amount in bid.get_values():
+            others[option] -= amount
+        payment = max(others.values()) - others[winner]
+        if payment > 0:
+            payments[bid.user] = payment
+    return winner, totals, payments
+
+
+def has_top_tie(totals):
+    ordered = sorted(totals.values(), reverse=True)
+    return len(ordered) > 1 and ordered[0] == ordered[1]
+
+
+def random_option_bids(rng, options):
+    return [Bid(user='user%d' % i, option=rng.choice(options), amount=rng.randint(0, 20))
+            for i in range(rng.randint(2, 12))]
+
+
+def random_vector_bids(rng, options):
+    bids = []
+    for i in range(rng.randint(2, 10)):
+        valued = rng.sample(options, rng.randint(1, len(options)))
+        bids.append(Bid(user='user%d' % i, values=[(option, rng.randint(0, 20)) for option in valued]))
+    return bids
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_single_option_games_settle_like_the_baseline(seed):
+    rng = random.Random(seed)
+    options = OPTIONS[:rng.randint(2, 4)]
+    bids = random_option_bids(rng, options)
+    if len(set(bid.option for bid in bids)) < 2:
+        # the baseline needed bids on two options at least
+        bids.append(Bid(user='other', option=[option for option in options if option != bids[0].option][0],
+                        amount=0))
+
+    option, payers = baseline_option_game(bids)
+    completed_game = CompletedGame.finalize_game(make_game(bids, options))
+
+    totals = {}
+    for bid in bids:
+        totals[bid.option] = totals.get(bid.option, 0) + bid.amount
+    if payers is None:
+        assert completed_game.message == 'Nobody pays'
+        assert totals.get(completed_game.option, 0) == max(totals.values())
+    else:
+        assert completed_game.option == option
+        assert get_payments(completed_game) == payers
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_vector_bids_pay_their_externality(seed):
+    rng = random.Random(seed)
+    options = OPTIONS[:rng.randint(2, 4)]
+    bids = random_vector_bids(rng, options)
+    winner, totals, payments = brute_force_clarke(bids, options)
+    if has_top_tie(totals):
+        return
+
+    completed_game = CompletedGame.finalize_game(make_game(bids, options))
+    assert completed_game.option == winner
+    if payments:
+        assert get_payments(completed_game) == payments
+    else:
+        assert completed_game.message == 'Nobody pays'
+
+
+def test_options_nobody_bid_on_compete_with_zero():
+    options = ['red', 'green', 'blue']
+    bids = [Bid(user='u1', option='red', amount=5), Bid(user='u2', option='red', amount=3)]
+    completed_game = CompletedGame.finalize_game(make_game(bids, options))
+    assert completed_game.option == 'red'
+    assert completed_game.message == 'Nobody pays'
+
+    # u1 alone outweighs green, which nobody else valued
+    bids = [Bid(user='u1', values=[('red', 10), ('blue', 1)]), Bid(user='u2', option='green', amount=4),
+            Bid(user='u3', values=[('red', 1), ('green', 2)])]
+    winner, totals, payments = brute_force_clarke(bids, options)
+    completed_game = CompletedGame.finalize_game(make_game(bids, options))
+    assert (completed_game.option, get_payments(completed_game)) == (winner, payments) == ('red', {'u1': 5})
+
+
+def test_a_bid_that_decides_alone_pays_the_runner_up_total():
+    bids = [Bid(user='u1', option='red', amount=10), Bid(user='u2', option='green', amount=4)]
+    completed_game = CompletedGame.finalize_game(make_game(bids, ['red', 'green']))
+    assert (completed_game.option, get_payments(completed_game)) == ('red', {'u1': 4})
+
+
+@pytest.mark.parametrize('source', ['stored', 'stats', 'streamed'])
+def test_tied_options_nobody_pays(source):
+    bids = [Bid(user='u1', option='red', amount=4), Bid(user='u2', option='green', amount=3),
+            Bid(user='u3', option='green', amount=1), Bid(user='u4', option='blue', amount=2)]
+    completed_game = CompletedGame.finalize_game(make_game(bids, ['red', 'green', 'blue'], source=source))
+    assert completed_game.option == 'red'
+    assert completed_game.message == 'Nobody pays'
+
+    # the game's order decides, not the order of the bids
+    completed_game = CompletedGame.finalize_game(make_game(bids[::-1], ['green', 'red', 'blue'], source=source))
+    assert completed_game.option == 'green'
+
+
+@pytest.mark.parametrize('source', ['stored', 'stats', 'streamed'])
+def test_plain_tie_is_broken_between_the_two_highest(source):
+    bids = [Bid(user='u1', amount=7), Bid(user='u2', amount=9), Bid(user='u3', amount=9)]
+    for seed in range(20):
+        random.seed(seed)
+        completed_game = CompletedGame.finalize_game(make_game(bids, source=source))
+        assert completed_game.winner in ('u2', 'u3')
+        assert completed_game.amount == 9
+        assert completed_game.message == 'Two persons bid same amount, tie was broken at random.'
+
+
+@pytest.mark.parametrize('seed', range(100))
+def test_plain_games_settle_like_the_baseline(seed):
+    rng = random.Random(seed)
+    bids = [Bid(user='user%d' % i, amount=rng.randint(0, 30)) for i in range(rng.randint(2, 12))]
+    winners, amount = baseline_plain_game(bids)
+    completed_game = CompletedGame.finalize_game(make_game(bids))
+    assert completed_game.winner in winners
+    assert completed_game.amount == amount
+
+
+@pytest.mark.parametrize('options', [None, ['red', 'green']])
+@pytest.mark.parametrize('source', ['stored', 'stats', 'streamed'])
+def test_a_single_bid_wins_for_free(options, source):
+    bid = Bid(user='u1', option='green' if options else None, amount=5)
+    completed_game = CompletedGame.finalize_game(make_game([bid], options, source=source))
+    assert completed_game.winner == 'u1'
+    assert completed_game.amount == 0
+    assert completed_game.option == (options and 'green')
+    assert completed_game.message == 'There was only one bid made in this game. The winner doesn\'t pay.'
+
+
+def test_no_bids_no_winner():
+    completed_game = CompletedGame.finalize_game(make_game([], ['red', 'green']))
+    assert completed_game.winner is None
+    assert completed_game.message == 'No bids were made in this game, game is closed without a winner.'
+
+
+def plain_bids(*amounts):
+    return [Bid(user='user%d' % i, amount=amount) for i, amount in enumerate(amounts)]
+
+
+@pytest.mark.parametrize('source', ['stored', 'streamed'])
+def test_multi_unit_winners_pay_the_first_losing_bid(source):
+    completed_game = CompletedGame.finalize_game(make_game(plain_bids(10, 9, 8, 7, 1), units=3, source=source))
+    assert sorted(completed_game.winners) == ['user0', 'user1', 'user2']
+    assert completed_game.amount == 7
+    assert completed_game.message == 'Every winner pays the amount.'
+
+
+@pytest.mark.parametrize('source', ['stored', 'streamed'])
+def test_multi_unit_tie_below_the_boundary_is_no_tie(source):
+    completed_game = CompletedGame.finalize_game(make_game(plain_bids(10, 9, 7, 7), units=2, source=source))
+    assert sorted(completed_game.winners) == ['user0', 'user1']
+    assert completed_game.amount == 7
+    assert completed_game.message == 'Every winner pays the amount.'
+
+
+@pytest.mark.parametrize('amounts,units,sure', [((10, 7, 7, 7, 1), 2, ['user0']), ((7, 7, 7), 2, []),
+                                                ((9, 8, 5, 5, 5, 5), 3, ['user0', 'user1'])])
+@pytest.mark.parametrize('source', ['stored', 'streamed'])
+def test_multi_unit_tie_at_the_boundary_is_broken_at_random(amounts, units, sure, source):
+    bids = plain_bids(*amounts)
+    price = sorted(amounts, reverse=True)[units]
+    seen = set()
+    for seed in range(30):
+        random.seed(seed)
+        completed_game = CompletedGame.finalize_game(make_game(bids, units=units, source=source))
+        assert len(completed_game.winners) == units
+        assert set(sure) <= set(completed_game.winners)
+        assert all(bids[int(user[len('user'):])].amount >= price for user in completed_game.winners)
+        assert completed_game.amount == price
+        assert completed_game.message.startswith('Several persons bid same amount for the last units')
+        seen.update(set(completed_game.winners) - set(sure))
+    # every tied bid gets its chance
+    assert seen == set(bid.user for bid in bids if bid.amount == price)
+
+
+@pytest.mark.parametrize('source', ['stored', 'streamed'])
+def test_multi_unit_with_no_more_bids_than_units_is_free(source):
+    completed_game = CompletedGame.finalize_game(make_game(plain_bids(4, 2), units=3, source=source))
+    assert sorted(completed_game.winners) == ['user0', 'user1']
+    assert completed_game.amount == 0
+
+
+@pytest.mark.parametrize('seed', range(150))
+def test_streamed_and_in_memory_settlements_agree(seed):
+    rng = random.Random(seed)
+    kind = seed % 4
+    units = 1
+    options = None
+    if kind == 0:
+        bids = [Bid(user='user%d' % i, amount=rng.randint(0, 20)) for i in range(rng.randint(1, 12))]
+    elif kind == 1:
+        units = rng.randint(2, 4)
+        bids = [Bid(user='user%d' % i, amount=rng.randint(0, 10)) for i in range(rng.randint(1, 12))]
+    elif kind == 2:
+        options = OPTIONS[:rng.randint(2, 4)]
+        bids = random_option_bids(rng, options)
+    else:
+        options = OPTIONS[:rng.randint(2, 4)]
+        bids = random_vector_bids(rng, options)
+
+    outcomes = []
+    for source in ('stored', 'stats', 'streamed'):
+        random.seed(seed)
+        outcome = get_outcome(CompletedGame.finalize_game(make_game(bids, options, units, source)))
+        if outcome[3] == 'Two persons bid same amount, tie was broken at random.':
+            # a bids map has no order, the tied pair may be met the other way round
+            tied = max(bid.amount for bid in bids)
+            assert [bid.amount for bid in bids if bid.user == outcome[1]] == [tied]
+            outcome = outcome[:1] + (None,) + outcome[2:]
+        outcomes.append(outcome)
+    if options:
+        # tied options go to the one listed first in the game on every path
+        winner, totals, payments = brute_force_clarke(bids, options)
+        if has_top_tie(totals):
+            top = max(totals.values())
+            assert outcomes[0][0] == [option for option in options if totals[option] == top][0]
+    assert outcomes[0] == outcomes[1] == outcomes[2]
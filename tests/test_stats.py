@@ -0,0 +1,309 @@
+import random
+import threading
+import time
+from decimal import Decimal
+
+import pytest
+
+import data
+import fakes
+from vcg.bid import Bid
+from vcg.codec import decode_bid
+from vcg.completed_game import CompletedGame
+from vcg.game import Game
+from vcg.stats import GameStats
+from storage.base import ConditionFailedException
+
+END_DATE = int(time.time()) + 86400
+
+
+@pytest.fixture(params=['dynamodb', 'sqlite'])
+def backend(request, tmpdir):
+    # (storage, dynamodb stand-in or None)
+    if request.param == 'sqlite':
+        storage, session = fakes.install_sqlite(str(tmpdir.join('games.db')))
+        return storage, None
+    import storage
+    resource, session = fakes.install()
+    return storage.get_storage(), resource
+
+
+def create_game(storage, name, options_per_game):
+    storage.create_game(data.make_db_game('T1', name, 0, options_per_game, END_DATE, random.Random(0)))
+
+
+def get_stats(storage, name):
+    return GameStats.decode(storage.get_game('T1', name)['stats'])
+
+
+def recount(storage, name):
+    # {user: bid} of the bids as stored, the aggregates are checked against them
+    bids = [Bid.parse_bid(decode_bid(stored_bid)) for stored_bid in storage.get_game_bids('T1', name)]
+    return dict((bid.user, bid) for bid in bids)
+
+
+def check_stats(stats, bids, options=None):
+    assert stats.bids == len(bids)
+    if options:
+        totals = dict((option, 0) for option in options)
+        for bid in bids.values():
+            for option, amount in bid.get_values():
+                totals[option] += amount
+        assert stats.totals == totals
+        return
+
+    assert stats.totals is None
+    if stats.stale:
+        return
+    amounts = sorted((bid.amount for bid in bids.values()), reverse=True)
+    assert [amount for amount, user in stats.top] == amounts[:2]
+    for amount, user in stats.top:
+        assert bids[user].amount == amount
+
+
+def plain_bid(user, amount, game_name=None):
+    return Bid(user=user, amount=amount, game_name=game_name)
+
+
+def test_new_plain_bids_keep_the_top_two():
+    stats = GameStats.new(None)
+    for user, amount in [('a', 5), ('b', 9), ('c', 7), ('d', 1)]:
+        stats.replace_bid(plain_bid(user, amount))
+    assert stats.bids == 4
+    assert stats.version == 4
+    assert stats.top == [[9, 'b'], [7, 'c']]
+    assert stats.get_floor() == 7
+    assert not stats.stale
+
+
+def test_equal_bids_keep_the_earlier_one_ahead():
+    stats = GameStats.new(None)
+    for user in ['a', 'b', 'c']:
+        stats.replace_bid(plain_bid(user, 5))
+    assert stats.top == [[5, 'a'], [5, 'b']]
+
+
+def test_raising_a_bid_moves_it_up_without_counting_a_bidder():
+    stats = GameStats.new(None)
+    stats.replace_bid(plain_bid('a', 5))
+    stats.replace_bid(plain_bid('b', 3))
+    stats.replace_bid(plain_bid('b', 8), plain_bid('b', 3))
+    assert stats.bids == 2
+    assert stats.version == 3
+    assert stats.top == [[8, 'b'], [5, 'a']]
+    assert not stats.stale
+
+
+def test_lowering_a_top_bid_makes_top_stale_only_with_bidders_outside_it():
+    stats = GameStats.new(None)
+    stats.replace_bid(plain_bid('a', 9))
+    stats.replace_bid(plain_bid('b', 7))
+    stats.replace_bid(plain_bid('a', 1), plain_bid('a', 9))
+    # both bidders are in the top two, nobody else could be ahead
+    assert stats.top == [[7, 'b'], [1, 'a']]
+    assert not stats.stale
+
+    stats.replace_bid(plain_bid('c', 0))
+    stats.replace_bid(plain_bid('b', 0), plain_bid('b', 7))
+    assert stats.stale
+
+
+def test_option_totals_follow_replaced_bids():
+    options = ['red', 'green']
+    stats = GameStats.new(options)
+    stats.replace_bid(Bid(user='a', option='red', amount=5))
+    stats.replace_bid(Bid(user='b', values=[('red', 2), ('green', 4)]))
+    stats.replace_bid(Bid(user='a', option='green', amount=1), Bid(user='a', option='red', amount=5))
+    assert stats.totals == {'red': 2, 'green': 5}
+    assert stats.bids == 2
+    assert stats.top == []
+
+
+def test_encode_and_decode_round_trip_dynamodb_numbers():
+    stats = GameStats.new(['red'])
+    stats.replace_bid(Bid(user='a', option='red', amount=5))
+    encoded = fakes.to_dynamo(stats.encode())
+    assert isinstance(encoded['totals']['red'], Decimal)
+    decoded = GameStats.decode(encoded)
+    assert (decoded.version, decoded.bids, decoded.totals, decoded.top, decoded.stale) == \
+        (stats.version, stats.bids, stats.totals, stats.top, stats.stale)
+    assert GameStats.decode(None) is None
+
+
+@pytest.mark.parametrize('options_per_game', [0, 3])
+def test_repeated_and_lowered_bids_match_a_recount(backend, options_per_game):
+    storage, resource = backend
+    create_game(storage, 'game', options_per_game)
+    options = data.OPTION_NAMES[:options_per_game]
+    rng = random.Random(options_per_game)
+    now = int(time.time())
+    for i in range(300):
+        user = 'user%d' % rng.randint(0, 12)
+        if options and rng.random() < 0.3:
+            bid = Bid(user=user, game_name='game',
+                      values=[(option, rng.randint(0, 50)) for option in rng.sample(options, 2)])
+        else:
+            # mostly repeated bidders, raising and lowering their bids
+            bid = Bid(user=user, game_name='game', option=rng.choice(options) if options else None,
+                      amount=rng.randint(0, 50))
+        storage.put_bid('T1', bid, now)
+
+        stats = get_stats(storage, 'game')
+        assert stats.version == i + 1
+        check_stats(stats, recount(storage, 'game'), options)
+        if resource is None:
+            # the index on amount rebuilds the top two in the same transaction
+            assert not stats.stale
+
+
+def test_rejected_bids_leave_the_aggregates_alone(backend):
+    storage, resource = backend
+    create_game(storage, 'game', 2)
+    now = int(time.time())
+    storage.put_bid('T1', Bid(user='a', option='option0', amount=5, game_name='game'), now)
+    with pytest.raises(ConditionFailedException):
+        storage.put_bid('T1', Bid(user='a', option='nope', amount=7, game_name='game'), now)
+    with pytest.raises(ConditionFailedException):
+        storage.put_bid('T1', Bid(user='a', option='option1', amount=7, game_name='game'), END_DATE + 1)
+
+    stats = get_stats(storage, 'game')
+    assert stats.version == 1
+    assert stats.totals == {'option0': 5, 'option1': 0}
+
+
+def test_a_game_created_again_while_active_keeps_its_bids(backend):
+    storage, resource = backend
+    create_game(storage, 'game', 2)
+    now = int(time.time())
+    storage.put_bid('T1', Bid(user='a', option='option0', amount=5, game_name='game'), now)
+    storage.put_bid('T1', Bid(user='b', option='option1', amount=3, game_name='game'), now)
+    before = storage.get_game('T1', 'game')
+
+    # the second game brings bids of its own, none of them may end up in the active one
+    with pytest.raises(ConditionFailedException):
+        storage.create_game(data.make_db_game('T1', 'game', 4, 2, END_DATE + 60, random.Random(1)))
+    assert storage.get_game('T1', 'game') == before
+    bids = recount(storage, 'game')
+    assert sorted(bids) == ['a', 'b']
+    check_stats(get_stats(storage, 'game'), bids, ['option0', 'option1'])
+
+
+def test_swaps_compare_the_version_read(backend):
+    storage, resource = backend
+    if resource is None:
+        pytest.skip('sqlite writes bids in a transaction, there is no version to compare')
+    create_game(storage, 'game', 0)
+    now = int(time.time())
+    storage.put_bid('T1', plain_bid('a', 10, 'game'), now)
+
+    # another container bids right after the failed transaction returned the game, the write over
+    # what was returned has to fail and be redone over the game read again
+    client = resource.meta.client
+    transact_write_items = client.transact_write_items
+    get_item = client.get_item
+    reads = []
+
+    def racing_transact_write_items(**kwargs):
+        try:
+            return transact_write_items(**kwargs)
+        except Exception:
+            client.transact_write_items = transact_write_items
+            storage.put_bid('T1', plain_bid('b', 20, 'game'), now)
+            raise
+
+    def counted_get_item(TableName, **kwargs):
+        reads.append(TableName)
+        return get_item(TableName=TableName, **kwargs)
+    client.transact_write_items = racing_transact_write_items
+    client.get_item = counted_get_item
+    try:
+        storage.put_bid('T1', plain_bid('a', 3, 'game'), now)
+    finally:
+        client.transact_write_items = transact_write_items
+        client.get_item = get_item
+
+    assert reads == ['active_games', 'bids']
+    stats = get_stats(storage, 'game')
+    assert stats.version == 3
+    assert stats.top == [[20, 'b'], [3, 'a']]
+    check_stats(stats, recount(storage, 'game'))
+
+
+@pytest.mark.parametrize('options_per_game', [0, 2])
+def test_changed_bids_take_two_round_trips(backend, options_per_game):
+    storage, resource = backend
+    if resource is None:
+        pytest.skip('sqlite has no round trips to count')
+    create_game(storage, 'game', options_per_game)
+    options = data.OPTION_NAMES[:options_per_game]
+    option = options[0] if options else None
+    now = int(time.time())
+    for user, amount in [('a', 10), ('b', 5), ('c', 1)]:
+        storage.put_bid('T1', Bid(user=user, option=option, amount=amount, game_name='game'), now)
+
+    # a top bid raised and a bid outside the top two changed, the failed transactions
+    # return the game and the old bid and neither is read
+    calls = []
+    for user, amount in [('a', 12), ('c', 3)]:
+        resource.reset_calls()
+        storage.put_bid('T1', Bid(user=user, option=option, amount=amount, game_name='game'), now)
+        calls.append(dict(resource.calls))
+    assert calls == [{'transact_write_items': 2}] * 2
+
+    resource.reset_calls()
+    with pytest.raises(ConditionFailedException):
+        storage.put_bid('T1', Bid(user='a', option='nope', amount=7, game_name='game'), now)
+    assert dict(resource.calls) == {'transact_write_items': 1}
+    check_stats(get_stats(storage, 'game'), recount(storage, 'game'), options)
+
+
+@pytest.mark.parametrize('options_per_game', [0, 2])
+def test_concurrent_bids_match_a_recount(backend, options_per_game):
+    storage, resource = backend
+    create_game(storage, 'game', options_per_game)
+    options = data.OPTION_NAMES[:options_per_game]
+    now = int(time.time())
+    stored = []
+
+    def bid(thread):
+        rng = random.Random(thread)
+        for i in range(40):
+            bid = Bid(user='user%d' % rng.randint(0, 5), game_name='game',
+                      option=rng.choice(options) if options else None, amount=rng.randint(0, 50))
+            # a bid that kept conflicting is rejected, the aggregates have to hold either way
+            if storage.try_put_bid('T1', bid, now) is None:
+                stored.append(bid)
+    threads = [threading.Thread(target=bid, args=(thread,)) for thread in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = get_stats(storage, 'game')
+    assert stats.version == len(stored)
+    check_stats(stats, recount(storage, 'game'), options)
+
+
+def test_tied_options_go_to_the_first_in_the_game_on_every_path(backend):
+    storage, resource = backend
+    create_game(storage, 'game', 2)
+    now = int(time.time())
+    # option1 is bid on first, the totals end up tied
+    storage.put_bid('T1', Bid(user='a', option='option1', amount=5, game_name='game'), now)
+    storage.put_bid('T1', Bid(user='b', option='option0', amount=3, game_name='game'), now)
+    storage.put_bid('T1', Bid(user='c', option='option0', amount=2, game_name='game'), now)
+    assert get_stats(storage, 'game').totals == {'option0': 5, 'option1': 5}
+
+    def read_game():
+        return Game.parse_game(storage.get_game('T1', 'game'), storage.get_game_bids)
+    from_stats = CompletedGame.finalize_game(read_game())
+    streamed = CompletedGame.finalize_streamed_game(read_game(), read_game().stats)
+    # without the aggregates the bids are read into columns, in the order they're stored in
+    game = read_game()
+    game.parsed_bids = list(game.bid_stream)
+    game.stats = None
+    assert game.parsed_bids[0].option == 'option1'
+    from_columns = CompletedGame.finalize_game(game)
+    outcomes = [(completed_game.option, completed_game.message)
+                for completed_game in (from_stats, streamed, from_columns)]
+    assert outcomes == [('option0', 'Nobody pays')] * 3
@@ -0,0 +1,80 @@
+import random
+import time
+
+import data
+import fakes
+import storage
+
+END_DATE = int(time.time()) + 86400
+
+
+def install():
+    resource, session = fakes.install()
+    return resource, storage.get_storage()
+
+
+def create_games(storage, names):
+    for name in names:
+        storage.create_game(data.make_db_game('T1', name, 0, 2, END_DATE, random.Random(0)))
+
+
+def test_a_summary_past_the_size_limit_is_dropped_and_the_game_stored_alone():
+    resource, storage = install()
+    resource.item_size_limit = 2000
+    names = ['game%02d' % i for i in range(20)]
+    create_games(storage, names)
+
+    # the summary's update cancelled the transaction with a ValidationError, the game
+    # was written on its own after the summary was deleted
+    assert resource.calls['transact_write_items'] == len(names)
+    assert resource.calls['delete_item'] > 0
+    assert resource.calls['put_item'] == resource.calls['delete_item']
+    assert all(storage.get_game('T1', name) is not None for name in names)
+
+    # a summary too big to store is built again for every listing
+    assert [entry['name'] for entry in storage.get_team_summary('T1')] == names
+    assert resource.Table('team_summaries').items.get(('T1', None), {}).get('built', None) is None
+
+
+def race_rebuild(resource, change):
+    # change runs once, right after the rebuild queried active_games and before it stores the summary
+    table = resource.Table('active_games')
+    query = table.query
+
+    def racing_query(**kwargs):
+        response = query(**kwargs)
+        if kwargs.get('IndexName', None) is None:
+            del table.query
+            change()
+        return response
+    table.query = racing_query
+
+
+def test_a_game_created_during_a_rebuild_is_kept_in_the_summary():
+    resource, storage = install()
+    create_games(storage, ['game0', 'game1'])
+    race_rebuild(resource, lambda: create_games(storage, ['game2']))
+
+    # create_game's summary, without built, is rebuilt when it's read
+    names = [entry['name'] for entry in storage.get_team_summary('T1')]
+    assert names == ['game0', 'game1', 'game2']
+    assert resource.calls['query'] == 2
+    stored = resource.Table('team_summaries').items[('T1', None)]
+    assert sorted(attribute for attribute in stored if attribute.startswith('game#')) == \
+        ['game#game0', 'game#game1', 'game#game2']
+
+    # the stored summary is used from now on
+    resource.reset_calls()
+    assert [entry['name'] for entry in storage.get_team_summary('T1')] == names
+    assert resource.calls['query'] == 0
+
+
+def test_a_game_settled_during_a_rebuild_is_left_out_of_the_summary():
+    resource, storage = install()
+    create_games(storage, ['game0', 'game1'])
+    race_rebuild(resource, lambda: storage.delete_games([('T1', 'game0')]))
+
+    assert [entry['name'] for entry in storage.get_team_summary('T1')] == ['game1']
+    stored = resource.Table('team_summaries').items[('T1', None)]
+    assert 'game#game0' not in stored
+    assert stored['built'] > 0